@@ -0,0 +1,123 @@
+"""
+    ADCSampler
+
+    Samples two ADC channels from a machine.Timer
+    callback into preallocated blocks of raw read_u16
+    values, each pair stamped with ticks_us. The
+    callback only moves integers around, so it never
+    touches the heap; statistics and scaling happen in
+    thread context when the samples are drained.
+
+    Samples are handed over in two blocks: the ISR fills
+    one while the consumer reads the other. The swap is
+    done by the ISR itself, the only writer of the block
+    indices: drain() raises a request flag, and the next
+    sample flips the filling block to ready and starts on
+    the other one before clearing the flag. The consumer
+    only ever writes the flag, so there is no lock and no
+    disable_irq on either side, and a block is never
+    written while it is being read.
+
+"""
+
+from array import array
+
+from Ticks import ticks_us, ticks_diff
+
+
+class ADCSampler:
+    '''Double-buffered raw (adc0, adc1) sample pairs filled from a timer ISR'''
+
+    def __init__(self, adc0, adc1, size=512):
+        # size: sample pairs per block, enough for the longest time between drains
+        self.adc0 = adc0
+        self.adc1 = adc1
+        self._size = size
+        self._bufs = (array('H', (0 for _ in range(2 * size))), array('H', (0 for _ in range(2 * size))))
+        self._times = (array('I', (0 for _ in range(size))), array('I', (0 for _ in range(size))))
+        self._count = array('I', (0, 0))    # pairs in each block
+        self._fill = 0          # block the ISR writes, written only by the ISR
+        self._ready = 1         # block handed over by the last flip, written only by the ISR
+        self._request = False   # set by drain(), cleared by the ISR once it has flipped
+        self._pending = False   # drain() is waiting for a flip it asked for
+        self._drop_before = None    # ticks_us stamp set by discard()
+        self._timer = None
+        self._isr_hist = None
+        self.overruns = 0
+
+    def instrument(self, hist):
+        '''Times every ISR run into hist (an Instrument.Histogram), takes effect on start()'''
+        self._isr_hist = hist
+
+    def start(self, freq):
+        '''Starts sampling at freq Hz'''
+        import machine
+        self.stop()
+        callback = self._sample if self._isr_hist is None else self._sample_timed
+        self._timer = machine.Timer(freq=freq, mode=machine.Timer.PERIODIC, callback=callback)
+
+    def stop(self):
+        '''Stops sampling'''
+        if self._timer is not None:
+            self._timer.deinit()
+            self._timer = None
+
+    def _sample(self, t):
+        '''ISR: stores one raw sample pair, flipping blocks if asked to, no allocation'''
+        fill = self._fill
+        if self._request:
+            self._ready = fill
+            fill ^= 1
+            self._count[fill] = 0
+            self._fill = fill
+            self._request = False   # last: the consumer may take the ready block now
+        n = self._count[fill]
+        if n == self._size:
+            self.overruns += 1
+            return
+        self._times[fill][n] = ticks_us()
+        buf = self._bufs[fill]
+        buf[2 * n] = self.adc0.read_u16()
+        buf[2 * n + 1] = self.adc1.read_u16()
+        self._count[fill] = n + 1
+
+    def _sample_timed(self, t):
+        start = ticks_us()
+        self._sample(t)
+        self._isr_hist.add(ticks_diff(ticks_us(), start))
+
+    def drain(self, *sinks):
+        '''Hands the block flipped since the last call to sink.add_pairs(buf, times, start, end)
+
+        buf holds interleaved (adc0, adc1) pairs, times[i//2] is the
+        ticks_us stamp of the pair at buf[i]. Then asks the ISR for
+        the next flip, so samples reach the sinks one drain interval
+        late at most. Returns the number of pairs handed over. Only
+        one thread may drain.
+        '''
+        if self._request:
+            return 0            # the ISR hasn't flipped yet (or isn't running)
+        n = 0
+        if self._pending:
+            ready = self._ready
+            buf = self._bufs[ready]
+            times = self._times[ready]
+            end = self._count[ready]
+            start = 0
+            cut = self._drop_before
+            if cut is not None:
+                while start < end and ticks_diff(times[start], cut) < 0:
+                    start += 1
+                if start < end and self._drop_before is cut:
+                    self._drop_before = None    # past the cut, before ticks_us wraps onto it
+            if start < end:
+                for sink in sinks:
+                    sink.add_pairs(buf, times, 2 * start, 2 * end)
+            n = end - start
+        self._pending = True
+        self._request = True
+        return n
+
+    def discard(self):
+        '''Drops every sample taken before now, callable from any thread or IRQ'''
+        self._drop_before = ticks_us()
@@ -7,6 +7,16 @@ import time
 import sys
 import os
 
+try:
+    import errno
+except ImportError:
+    import uerrno as errno
+
+try:
+    import select
+except ImportError:
+    import uselect as select
+
 try:
     import machine
     gettime = lambda: time.ticks_ms()
@@ -36,6 +46,11 @@ MSG_EVENT_LOG = const(64)
 MSG_REDIRECT  = const(41)  # TODO: not implemented
 MSG_DBG_PRINT  = const(55) # TODO: not implemented
 
+TXQ_DROP = 'drop'      # full queue: discard the new write
+TXQ_OLDEST = 'oldest'  # full queue: discard the oldest queued writes
+TXQ_MERGE = 'merge'    # full queue: replace the last queued write to the same pins,
+                       # falling back to TXQ_OLDEST
+
 STA_SUCCESS = const(200)
 STA_INVALID_TOKEN = const(9)
 
@@ -43,7 +58,13 @@ DISCONNECTED = const(0)
 CONNECTING = const(1)
 CONNECTED = const(2)
 
-print("""
+_banner = True   # printed by the first BlynkProtocol, not at import
+
+def _print_banner():
+    global _banner
+    if _banner:
+        _banner = False
+        print("""
     ___  __          __
    / _ )/ /_ _____  / /__
   / _  / / // / _ \\/  '_/
@@ -68,20 +89,178 @@ class EventEmitter:
             self._cbks[evt](*a, **kv)
 
 
+def _put_int(buf, pos, end, n):
+    # writes n in decimal to buf[pos:end], returns the new pos, -1 if it doesn't fit
+    if n < 0:
+        if pos >= end: return -1
+        buf[pos] = 45   # '-'
+        pos += 1
+        n = -n
+    k = 1
+    t = n // 10
+    while t:
+        k += 1
+        t //= 10
+    if pos + k > end: return -1
+    i = pos + k
+    while True:
+        i -= 1
+        buf[i] = 48 + n % 10
+        n //= 10
+        if not n: break
+    return pos + k
+
+def _put_fixed(buf, pos, end, n, digits):
+    # writes n / 10**digits in decimal, dropping trailing zeros of the
+    # fraction but keeping at least one, like _put_int
+    if n < 0:
+        if pos >= end: return -1
+        buf[pos] = 45
+        pos += 1
+        n = -n
+    while digits > 1 and n % 10 == 0:
+        n //= 10
+        digits -= 1
+    k = 1
+    t = n // 10
+    while t:
+        k += 1
+        t //= 10
+    if k <= digits:
+        k = digits + 1      # 0.xxx
+    if pos + k + 1 > end: return -1
+    i = pos + k + 1
+    for _ in range(digits):
+        i -= 1
+        buf[i] = 48 + n % 10
+        n //= 10
+    i -= 1
+    buf[i] = 46             # '.'
+    while i > pos:
+        i -= 1
+        buf[i] = 48 + n % 10
+        n //= 10
+    return pos + k + 1
+
+def _field_end(buf, pos, end):
+    # index of the \0 ending the field at pos, end for the last one
+    while pos < end and buf[pos]:
+        pos += 1
+    return pos
+
+def _get_int(buf, pos, end):
+    # the decimal integer buf[pos:end], None if it isn't one
+    neg = pos < end and buf[pos] == 45
+    if neg:
+        pos += 1
+    if pos >= end: return None
+    n = 0
+    while pos < end:
+        c = buf[pos] - 48
+        if c < 0 or c > 9: return None
+        n = n*10 + c
+        pos += 1
+    return -n if neg else n
+
+def _str_fields(buf, pos, end):
+    # the \0 separated fields of buf[pos:end] as str, [] if pos is past end
+    out = []
+    while pos <= end:
+        sep = _field_end(buf, pos, end)
+        out.append(str(buf[pos:sep], 'utf8'))
+        pos = sep + 1
+    return out
+
+_PARSERS = (None, int, float, bool, str)
+
+def _put_bytes(buf, pos, end, data):
+    # byte by byte: a slice assignment would allocate a slice object
+    if pos + len(data) > end: return -1
+    for c in data:
+        buf[pos] = c
+        pos += 1
+    return pos
+
 class BlynkProtocol(EventEmitter):
-    def __init__(self, auth, tmpl_id=None, fw_ver=None, heartbeat=50, buffin=1024, log=None):
+    def __init__(self, auth, tmpl_id=None, fw_ver=None, heartbeat=50, buffin=1024, buffout=0, flush_ms=100, log=None, float_digits=4, autoconnect=True):
+        # autoconnect=False leaves connecting to run_forever()/run_async()
+        # (or an explicit connect()), so construction never touches the network
+        _print_banner()
         EventEmitter.__init__(self)
+        self._vpins = []    # pin -> (handler, parse) or None, see on_virtual()
         self.heartbeat = heartbeat*1000
         self.buffin = buffin
+        # with buffout > 0, outgoing frames are coalesced and written in one
+        # go by flush(): at the end of run(), when the next frame would not
+        # fit or when the oldest queued frame is flush_ms old. None of this is
+        # locked: only the thread that runs the connection may send
+        self.buffout = buffout
+        self.flush_ms = flush_ms
+        self._tx = bytearray(buffout)
+        self._txv = memoryview(self._tx)
+        self._tx_len = 0
+        self._tx_since = 0
+        # frames are encoded in place, into _tx or (unbuffered) into _enc;
+        # ints, and floats rounded to float_digits decimals, are written
+        # without allocating as long as they fit a small int
+        self._enc = bytearray(0 if buffout else 128)
+        self._encv = memoryview(self._enc)
+        self.float_digits = float_digits
+        self._fscale = 10 ** float_digits
+        self._fmax = float((1 << 30) // self._fscale)
+        self._vw_prefix = {}    # pin -> b'vw\0<pin>'
         self.log = log or dummy
         self.auth = auth
         self.tmpl_id = tmpl_id
         self.fw_ver = fw_ver
         self.state = DISCONNECTED
-        self.connect()
+        self.msg_id = 1
+        (self.lastRecv, self.lastSend, self.lastPing) = (gettime(), 0, 0)
+        # receive ring: frames are decoded in place between _rx_head and
+        # _rx_tail, unconsumed bytes are moved to the front only when the
+        # free space at the end can no longer take a full read
+        self._rx = bytearray(2*buffin + 8)
+        self._rxv = memoryview(self._rx)
+        self._rx_head = 0
+        self._rx_tail = 0
+        self._wake = None   # asyncio.Event while run_async() is running
+        if autoconnect:
+            self.connect()
+
+    def on(self, evt, f=None, parse=None):
+        # "V<pin>" handlers live in the pin table, the rest are events
+        if evt[:1] == 'V' and evt[1:].isdigit():
+            return self.on_virtual(int(evt[1:]), f, parse)
+        return EventEmitter.on(self, evt, f)
+
+    def on_virtual(self, pin, f=None, parse=None):
+        '''Registers f(value) for dashboard writes to virtual pin, or returns a decorator
+
+        value is the list of str arguments with parse=None (what
+        on("V<pin>") has always passed), otherwise the first argument
+        as an int, float, bool or str. int and bool are read straight
+        from the receive buffer without allocating. Lookup is by pin
+        number, so it costs the same however many pins have handlers.
+        '''
+        if f is None:
+            def D(f):
+                self.on_virtual(pin, f, parse)
+                return f
+            return D
+        if parse not in _PARSERS:
+            raise ValueError("parse must be one of None, int, float, bool, str")
+        while len(self._vpins) <= pin:
+            self._vpins.append(None)
+        self._vpins[pin] = (f, parse)
 
     def virtual_write(self, pin, *val):
-        self._send(MSG_HW, 'vw', pin, *val)
+        prefix = self._vw_prefix.get(pin)
+        if prefix is None:
+            prefix = self._vw_prefix[pin] = ('vw\0' + str(pin)).encode('utf8')
+        id = self._next_id()
+        if self.log is not dummy:
+            self.log('<', MSG_HW, id, '|', 'vw', pin, *val)
+        self._frame(MSG_HW, id, prefix, val)
 
     def send_internal(self, pin, *val):
         self._send(MSG_INTERNAL,  pin, *val)
@@ -95,38 +274,137 @@ class BlynkProtocol(EventEmitter):
     def log_event(self, *val):
         self._send(MSG_EVENT_LOG, *val)
 
+    def _next_id(self):
+        id = self.msg_id
+        self.msg_id = id + 1 if id < 0xFFFF else 1
+        return id
+
     def _send(self, cmd, *args, **kwargs):
-        if 'id' in kwargs:
-            id = kwargs.get('id')
-        else:
-            id = self.msg_id
-            self.msg_id += 1
-            if self.msg_id > 0xFFFF:
-                self.msg_id = 1
-                
+        id = kwargs['id'] if 'id' in kwargs else self._next_id()
+        if self.log is not dummy:
+            self.log('<', cmd, id, '|', *args)
         if cmd == MSG_RSP:
-            data = b''
-            dlen = args[0]
+            self._frame(cmd, id, b'', (), args[0])
         else:
-            data = ('\0'.join(map(str, args))).encode('utf8')
-            dlen = len(data)
-        
-        self.log('<', cmd, id, '|', *args)
-        msg = struct.pack("!BHH", cmd, id, dlen) + data
+            self._frame(cmd, id, b'', args)
+
+    def _arg(self, a):
+        # anything _put can't write in place
+        if type(a) is float and self._fmax <= abs(a) < 1e15:
+            # the same text _put_fixed would write: trailing zeros of the fraction dropped, one kept
+            a = ('%.' + str(self.float_digits) + 'f') % a
+            if '.' in a:
+                a = a.rstrip('0')
+                if a[-1] == '.':
+                    a += '0'
+        return str(a).encode('utf8')
+
+    def _encode(self, buf, start, end, cmd, id, prefix, args, dlen):
+        # writes a whole frame to buf[start:end], returns its length, -1 if it doesn't fit
+        pos = _put_bytes(buf, start + 5, end, prefix) if start + 5 <= end else -1
+        if dlen is None:
+            sep = len(prefix) > 0
+            fmax = self._fmax
+            for a in args:
+                if pos < 0 or (sep and pos >= end): return -1
+                if sep:
+                    buf[pos] = 0
+                    pos += 1
+                sep = True
+                t = type(a)
+                if t is int:
+                    pos = _put_int(buf, pos, end, a)
+                elif t is float and -fmax < a < fmax:
+                    pos = _put_fixed(buf, pos, end, round(a * self._fscale), self.float_digits)
+                else:
+                    pos = _put_bytes(buf, pos, end, a if t is bytes or t is bytearray else self._arg(a))
+            if pos < 0: return -1
+            dlen = pos - start - 5
+        elif pos < 0: return -1
+        struct.pack_into("!BHH", buf, start, cmd, id, dlen)
+        return pos - start
+
+    def _frame(self, cmd, id, prefix, args, dlen=None):
+        # dlen: a status to send in the length field of a payload-less RSP
         self.lastSend = gettime()
-        self._write(msg)
+        if self.buffout:
+            start = self._tx_len
+            n = self._encode(self._tx, start, self.buffout, cmd, id, prefix, args, dlen)
+            if n < 0 and start:
+                self.flush()
+                start = 0
+                n = self._encode(self._tx, 0, self.buffout, cmd, id, prefix, args, dlen)
+            if n >= 0:
+                if not start:
+                    self._tx_since = self.lastSend
+                    if self._wake:
+                        self._wake.set()
+                self._tx_len = start + n
+                if self.lastSend - self._tx_since >= self.flush_ms:
+                    self.flush()
+                return
+        else:
+            n = self._encode(self._enc, 0, len(self._enc), cmd, id, prefix, args, dlen)
+            if n >= 0:
+                self._write(self._encv[:n])
+                return
+        # bigger than the buffer
+        parts = [prefix] if prefix else []
+        for a in args:
+            parts.append(a if type(a) is bytes or type(a) is bytearray else self._arg(a))
+        data = b'\0'.join(parts)
+        msg = struct.pack("!BHH", cmd, id, len(data) if dlen is None else dlen) + data
+        if self.buffout:
+            self._queue(msg)
+        else:
+            self._write(msg)
+
+    def _queue(self, msg):
+        n = len(msg)
+        if self._tx_len + n > self.buffout:
+            self.flush()
+            if n > self.buffout:
+                return self._write(msg)
+        if not self._tx_len:
+            self._tx_since = self.lastSend
+            if self._wake:
+                self._wake.set()
+        self._txv[self._tx_len:self._tx_len+n] = msg
+        self._tx_len += n
+        if self.lastSend - self._tx_since >= self.flush_ms:
+            self.flush()
+
+    def flush(self):
+        if self._tx_len:
+            n = self._tx_len
+            self._tx_len = 0
+            self._write(self._txv[:n])
+
+    def time_until_next(self):
+        # ms until process() has something to do (ping, flush, heartbeat
+        # timeout), None while disconnected
+        if not (self.state == CONNECTING or self.state == CONNECTED): return None
+        hb = self.heartbeat
+        due = min(self.lastRecv + hb + hb//2 + 1,
+                  max(self.lastPing + hb//10 + 1, min(self.lastSend, self.lastRecv) + hb + 1))
+        if self._tx_len:
+            due = min(due, self._tx_since + self.flush_ms)
+        return max(0, due - gettime())
 
     def connect(self):
         if self.state != DISCONNECTED: return
         self.msg_id = 1
         (self.lastRecv, self.lastSend, self.lastPing) = (gettime(), 0, 0)
-        self.bin = b""
+        self._rx_head = self._rx_tail = 0
+        self._tx_len = 0
         self.state = CONNECTING
         self._send(MSG_HW_LOGIN, self.auth)
+        self.flush()
 
     def disconnect(self):
         if self.state == DISCONNECTED: return
-        self.bin = b""
+        self._rx_head = self._rx_tail = 0
+        self._tx_len = 0
         self.state = DISCONNECTED
         self.emit('disconnected')
 
@@ -140,20 +418,47 @@ class BlynkProtocol(EventEmitter):
              now - self.lastRecv > self.heartbeat)):
             self._send(MSG_PING)
             self.lastPing = now
-        
-        if data != None and len(data):
-            self.bin += data
+        if self._tx_len and now - self._tx_since >= self.flush_ms:
+            self.flush()
 
-        while True:
-            if len(self.bin) < 5:
-                break
+        if data != None and len(data):
+            n = self._rx_put(data)
+            if n < len(data):
+                mv = memoryview(data)
+                while n < len(mv):
+                    if not self._rx_parse(now):
+                        return
+                    n += self._rx_put(mv[n:])
+        self._rx_parse(now)
+
+    def _rx_put(self, data):
+        # copies as much of data as fits into the receive ring, returns count
+        head, tail = self._rx_head, self._rx_tail
+        size = len(self._rx)
+        if head == tail:
+            head = tail = 0
+        elif size - tail < len(data) and head:
+            self._rx[0:tail-head] = self._rxv[head:tail]
+            head, tail = 0, tail-head
+        n = min(len(data), size - tail)
+        self._rxv[tail:tail+n] = data[:n]
+        self._rx_head, self._rx_tail = head, tail+n
+        return n
+
+    def _rx_parse(self, now):
+        # decodes all complete frames, returns False if the link was dropped
+        buf = self._rx
+        unpack_from = struct.unpack_from
+        while self._rx_tail - self._rx_head >= 5:
+            head = self._rx_head
+            cmd, i, dlen = unpack_from("!BHH", buf, head)
+            if i == 0:
+                self.disconnect()
+                return False
 
-            cmd, i, dlen = struct.unpack("!BHH", self.bin[:5])
-            if i == 0: return self.disconnect()
-                      
             self.lastRecv = now
             if cmd == MSG_RSP:
-                self.bin = self.bin[5:]
+                self._rx_head = head + 5
 
                 self.log('>', cmd, i, '|', dlen)
                 if self.state == CONNECTING and i == 1:
@@ -175,84 +480,349 @@ class BlynkProtocol(EventEmitter):
                         if dlen == STA_INVALID_TOKEN:
                             self.emit("invalid_auth")
                             print("Invalid auth token")
-                        return self.disconnect()
+                        self.disconnect()
+                        return False
             else:
                 if dlen >= self.buffin:
                     print("Cmd too big: ", dlen)
-                    return self.disconnect()
+                    self.disconnect()
+                    return False
 
-                if len(self.bin) < 5+dlen:
+                if self._rx_tail - head < 5+dlen:
                     break
 
-                data = self.bin[5:5+dlen]
-                self.bin = self.bin[5+dlen:]
-
-                args = list(map(lambda x: x.decode('utf8'), data.split(b'\0')))
-
-                self.log('>', cmd, i, '|', ','.join(args))
+                start = head + 5
+                end = self._rx_head = start + dlen
+                if self.log is not dummy:
+                    self.log('>', cmd, i, '|', ','.join(_str_fields(buf, start, end)))
                 if cmd == MSG_PING:
                     self._send(MSG_RSP, STA_SUCCESS, id=i)
                 elif cmd == MSG_HW or cmd == MSG_BRIDGE:
-                    if args[0] == 'vw':
-                        self.emit("V"+args[1], args[2:])
-                        self.emit("V*", args[1], args[2:])
+                    # only vw is handled, and decoded no further than its handler needs
+                    if dlen > 3 and buf[start] == 118 and buf[start+1] == 119 and buf[start+2] == 0:
+                        self._dispatch_vw(buf, start + 3, end)
                 elif cmd == MSG_INTERNAL:
+                    args = _str_fields(buf, start, end)
                     self.emit("internal:"+args[0], args[1:])
                 elif cmd == MSG_REDIRECT:
+                    args = _str_fields(buf, start, end)
                     self.emit("redirect", args[0], int(args[1]))
                 else:
                     print("Unexpected command: ", cmd)
-                    return self.disconnect()
+                    self.disconnect()
+                    return False
+
+            if self.state == DISCONNECTED:
+                return False
+
+        if self._rx_head == self._rx_tail:
+            self._rx_head = self._rx_tail = 0
+        return True
+
+    def _dispatch_vw(self, buf, pos, end):
+        # buf[pos:end] is "<pin>\0<value>\0..."
+        sep = _field_end(buf, pos, end)
+        pin = _get_int(buf, pos, sep)
+        vpins = self._vpins
+        entry = vpins[pin] if pin is not None and 0 <= pin < len(vpins) else None
+        wild = self._cbks.get('V*')
+        if entry is not None:
+            f, parse = entry
+            if parse is None:
+                f(_str_fields(buf, sep + 1, end))
+            else:
+                try:
+                    value = self._parse(buf, sep + 1, _field_end(buf, sep + 1, end), parse)
+                except ValueError:
+                    print("Bad value for V%d: %s" % (pin, ','.join(_str_fields(buf, sep + 1, end))))
+                else:
+                    f(value)
+        if wild is not None:
+            wild(str(buf[pos:sep], 'utf8'), _str_fields(buf, sep + 1, end))
+
+    def _parse(self, buf, pos, end, parse):
+        if parse is int or parse is bool:
+            n = _get_int(buf, pos, end)
+            if n is not None:
+                return n if parse is int else n != 0
+        s = str(buf[pos:end], 'utf8')
+        if parse is str:
+            return s
+        # "1.0" from a slider with decimals is still an int
+        v = float(s)
+        if parse is int:
+            return int(v)
+        return v if parse is float else v != 0
+
+def _vw_pins(data):
+    # pins written by a run of virtual_write frames, None for anything else
+    pins = b''
+    pos = 0
+    while pos + 5 <= len(data):
+        cmd, i, dlen = struct.unpack_from("!BHH", data, pos)
+        if cmd != MSG_HW or data[pos+5:pos+8] != b'vw\0':
+            return None
+        end = data.find(b'\0', pos+8, pos+5+dlen)
+        pins += data[pos+8:end if end >= 0 else pos+5+dlen] + b','
+        pos += 5 + dlen
+    return pins if pos == len(data) else None
 
 import socket
 
 class Blynk(BlynkProtocol):
+    _rx_fut = None  # the CPython readability wait of run_async()
+
     def __init__(self, auth, **kwargs):
         self.insecure = kwargs.pop('insecure', False)
         self.server = kwargs.pop('server', 'blynk.cloud')
         self.port = kwargs.pop('port', 80 if self.insecure else 443)
+        # outbound queue: writes the socket can't take right away wait here
+        # (up to txq bytes) and are drained by later _write()/run() calls
+        self.txq = kwargs.pop('txq', 2048)
+        self.txq_policy = kwargs.pop('txq_policy', TXQ_MERGE)
+        self._txq = []
+        self._txq_off = 0
+        self._txq_bytes = 0
+        self.txq_peak = 0
+        self.txq_partial = 0
+        self.txq_dropped = 0
+        self.txq_merged = 0
+        # run_forever()/run_async() reconnect this often after a disconnect
+        self.reconnect_ms = kwargs.pop('reconnect_ms', 5000)
+        self._retry_at = 0
+        # run_forever() opens the connection without blocking, giving up after connect_ms
+        self.connect_ms = kwargs.pop('connect_ms', 10000)
+        self._addr = None       # the server's address, looked up once: the lookup blocks
+        self._opening = None    # socket run_forever() is connecting (and securing), not yet logged in
+        self._open_until = 0
+        self._handshake = None  # CPython ssl: handshake step of the socket being opened
+        self._want = ()         # CPython ssl: what a handshake step raises while it waits
+        self._open_ev = 0       # the poll() event the socket being opened waits for
+        self._nonblocking = False
         BlynkProtocol.__init__(self, auth, **kwargs)
         self.on('redirect', self.redirect)
 
     def redirect(self, server, port):
         self.server = server
         self.port = port
+        self._addr = None
         self.disconnect()
-        self.connect()
+        if self._nonblocking:
+            self._retry_at = gettime()  # run_forever() opens the new server next
+        else:
+            self.connect()
 
     def connect(self):
+        '''Connects and logs in, blocking until the socket (and TLS) is up'''
         print('Connecting to %s:%d...' % (self.server, self.port))
         s = socket.socket()
-        s.connect(socket.getaddrinfo(self.server, self.port)[0][-1])
+        s.connect(self._resolve())
+        self._login(self._secure(s, True), s)
+
+    def _resolve(self):
+        if self._addr is None:
+            self._addr = socket.getaddrinfo(self.server, self.port)[0][-1]
+        return self._addr
+
+    def _secure(self, s, blocking):
+        # the connection to talk over: s, or s wrapped in TLS; without
+        # blocking the handshake is left to _handshake or the first write
         try:
             s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         except:
             pass
         if self.insecure:
-            self.conn = s
-        else:
-            try:
-                import ussl
-                ssl_context = ussl
-            except ImportError:
-                import ssl
-                ssl_context = ssl.create_default_context()
-            self.conn = ssl_context.wrap_socket(s, server_hostname=self.server)
+            return s
+        try:
+            import ussl
+            if blocking:
+                return ussl.wrap_socket(s, server_hostname=self.server)
+            return ussl.wrap_socket(s, server_hostname=self.server, do_handshake=False)
+        except ImportError:
+            import ssl
+        conn = ssl.create_default_context().wrap_socket(s, server_hostname=self.server, do_handshake_on_connect=blocking)
+        if not blocking:
+            self._handshake = conn.do_handshake
+            self._want = (ssl.SSLWantReadError, ssl.SSLWantWriteError)
+        return conn
+
+    def _login(self, conn, s):
+        self.conn = conn
         try:
             self.conn.settimeout(SOCK_TIMEOUT)
         except:
             s.settimeout(SOCK_TIMEOUT)
+        # MicroPython and ssl sockets have read/write, plain CPython ones send/recv
+        self._cwrite = getattr(self.conn, 'write', None) or self.conn.send
+        self._cread = getattr(self.conn, 'read', None) or self.conn.recv
+        self._txq_clear()
         BlynkProtocol.connect(self)
 
+    def _open(self):
+        # starts connecting without blocking, run_forever() waits for it in poll()
+        print('Connecting to %s:%d...' % (self.server, self.port))
+        addr = self._resolve()
+        s = socket.socket()
+        s.setblocking(False)
+        try:
+            s.connect(addr)
+        except OSError as e:
+            code = e.args[0] if e.args else 0
+            if code != errno.EINPROGRESS and code != errno.EAGAIN:
+                s.close()
+                raise
+        self._opening = s
+        self._open_ev = select.POLLOUT     # connected shows as writable
+        self._handshake = None
+        self._open_until = gettime() + self.connect_ms
+
+    def _open_step(self, ev):
+        # poll() reported the socket being opened: carries on connecting, logs in once it is up
+        s = self._opening
+        if ev & (select.POLLHUP | select.POLLERR):
+            return self._open_failed("refused")
+        if self._handshake is None:
+            # connected: the TCP part is done
+            err = 0
+            if hasattr(socket, 'SO_ERROR'):
+                err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                return self._open_failed(OSError(err))
+            self._opening = self._secure(s, False)
+            if self._handshake is None:
+                return self._opened(s)
+        try:
+            self._handshake()
+        except self._want as e:
+            self._open_ev = select.POLLOUT if isinstance(e, self._want[1]) else select.POLLIN
+            return
+        except OSError as e:
+            return self._open_failed(e)
+        self._opened(s)
+
+    def _opened(self, s):
+        conn = self._opening
+        self._opening = None
+        self._handshake = None
+        self._login(conn, s)
+
+    def _open_failed(self, why):
+        print("Connect failed: ", why)
+        try:
+            self._opening.close()
+        except:
+            pass
+        self._opening = None
+        self._handshake = None
+
+    def disconnect(self):
+        self._txq_clear()
+        if self.state != DISCONNECTED:
+            try:
+                self.conn.close()
+            except:
+                pass
+            # a closed socket never polls readable on CPython
+            if self._rx_fut is not None and not self._rx_fut.done():
+                self._rx_fut.set_result(None)
+        BlynkProtocol.disconnect(self)
+
+    def tx_stats(self):
+        return {
+            'depth': len(self._txq),
+            'bytes': self._txq_bytes - self._txq_off,
+            'peak': self.txq_peak,
+            'partial': self.txq_partial,
+            'dropped': self.txq_dropped,
+            'merged': self.txq_merged,
+        }
+
+    def _txq_clear(self):
+        self._txq = []
+        self._txq_off = 0
+        self._txq_bytes = 0
+
+    def _conn_write(self, data):
+        # returns bytes written, 0 if the socket would block, None if lost
+        try:
+            n = self._cwrite(data)
+        except OSError as e:
+            code = e.args[0] if e.args else 0
+            # CPython reports timeouts with a message instead of an errno
+            if code == errno.EAGAIN or code == errno.ETIMEDOUT or not isinstance(code, int):
+                return 0
+            print("Write failed: ", e)
+            self.disconnect()
+            return None
+        if n is None:
+            return 0
+        if n < len(data):
+            self.txq_partial += 1
+        return n
+
+    def _drain(self):
+        while self._txq:
+            head = self._txq[0]
+            n = self._conn_write(memoryview(head)[self._txq_off:])
+            if not n:
+                return
+            self._txq_off += n
+            if self._txq_off < len(head):
+                return
+            self._txq.pop(0)
+            self._txq_bytes -= len(head)
+            self._txq_off = 0
+
     def _write(self, data):
         #print('<', data)
-        self.conn.write(data)
-        # TODO: handle disconnect
+        if self.state == DISCONNECTED:
+            return
+        if not self._txq:
+            n = self._conn_write(data)
+            if n is None or n == len(data):
+                return
+            self._txq.append(bytes(data))
+            self._txq_off = n
+            self._txq_bytes = len(data)
+            if self._wake:
+                self._wake.set()
+        else:
+            self._drain()
+            self._txq_put(bytes(data))
+        if self._txq_bytes > self.txq_peak:
+            self.txq_peak = self._txq_bytes
+
+    def _txq_put(self, data):
+        if self._txq_bytes + len(data) <= self.txq:
+            self._txq.append(data)
+            self._txq_bytes += len(data)
+            return
+        # the head may be half sent, it can't be dropped or replaced
+        first = 1 if self._txq_off else 0
+        if self.txq_policy == TXQ_MERGE:
+            pins = _vw_pins(data)
+            if pins is not None:
+                for i in range(len(self._txq)-1, first-1, -1):
+                    if _vw_pins(self._txq[i]) == pins:
+                        self._txq_bytes += len(data) - len(self._txq[i])
+                        self._txq[i] = data
+                        self.txq_merged += 1
+                        return
+        if self.txq_policy != TXQ_DROP:
+            while len(self._txq) > first and self._txq_bytes + len(data) > self.txq:
+                self._txq_bytes -= len(self._txq.pop(first))
+                self.txq_dropped += 1
+        if self._txq_bytes + len(data) <= self.txq:
+            self._txq.append(data)
+            self._txq_bytes += len(data)
+        else:
+            self.txq_dropped += 1
 
     def run(self):
+        self._drain()
         data = b''
         try:
-            data = self.conn.read(self.buffin)
+            data = self._cread(self.buffin)
             #print('>', data)
         except KeyboardInterrupt:
             raise
@@ -262,4 +832,192 @@ class Blynk(BlynkProtocol):
         except: # TODO: handle disconnect
             return
         self.process(data)
+        self.flush()
+
+    def _conn_read(self):
+        # for when poll reports the socket readable: returns the data, None
+        # if there was nothing after all, b'' once the connection is gone
+        try:
+            data = self._cread(self.buffin)
+        except OSError as e:
+            code = e.args[0] if e.args else 0
+            if code == errno.EAGAIN or code == errno.ETIMEDOUT or not isinstance(code, int):
+                return None
+            print("Read failed: ", e)
+            data = b''
+        if data == b'':
+            self.disconnect()
+        return data
+
+    def _rx_pending(self):
+        # ssl sockets can hold decrypted bytes that poll does not see
+        pending = getattr(self.conn, 'pending', None)
+        return pending is not None and pending() > 0
+
+    def _reconnect(self, start=None):
+        if gettime() - self._retry_at < 0:
+            return
+        self._retry_at = gettime() + self.reconnect_ms
+        try:
+            (start or self.connect)()
+        except OSError as e:
+            print("Connect failed: ", e)
+
+    def _wait_ms(self, timer=None):
+        # how long the loops may sleep before something is due, None for ever
+        if self._opening is not None:
+            wait = max(0, self._open_until - gettime())
+        elif self.state == DISCONNECTED:
+            wait = max(0, self._retry_at - gettime())
+        else:
+            wait = self.time_until_next()
+        if timer is not None:
+            t = timer.time_until_next()
+            if t is not None and (wait is None or t < wait):
+                wait = t
+        return wait
+
+    def run_forever(self, timer=None):
+        '''Serves the connection and timer, sleeping in poll() between events
+
+        Never returns. Reconnects every reconnect_ms after a disconnect.
+        Nothing here blocks on the network but the server's name lookup,
+        done once: the connection is opened and secured in poll().
+        '''
+        self._nonblocking = True
+        poller = select.poll()
+        conn = None
+        key = None      # what conn is registered as, a closed socket has no fileno
+        more = False
+        while True:
+            if self.state == DISCONNECTED and self._opening is None:
+                self._reconnect(self._open)
+            sock = self._opening
+            if sock is None and self.state != DISCONNECTED:
+                sock = self.conn
+            if conn is not None and conn is not sock:
+                poller.unregister(key)
+                conn = None
+            if conn is None and sock is not None:
+                conn = sock
+                key = conn.fileno() if hasattr(conn, 'fileno') else conn
+                poller.register(key, select.POLLIN)
+            if self._opening is not None:
+                poller.modify(key, self._open_ev)
+            elif conn is not None:
+                poller.modify(key, select.POLLIN | select.POLLOUT if self._txq else select.POLLIN)
+
+            wait = 0 if more else self._wait_ms(timer)
+            events = poller.poll(-1 if wait is None else wait)
+
+            data = None
+            read = more     # decrypted bytes left in the TLS layer never poll readable
+            more = False
+            for obj, ev in events:
+                if self._opening is not None:
+                    self._open_step(ev)
+                    break
+                if ev & (select.POLLHUP | select.POLLERR):
+                    self.disconnect()
+                    read = False
+                    break
+                if ev & select.POLLOUT:
+                    self._drain()
+                if ev & select.POLLIN:
+                    read = True
+            if self._opening is not None and gettime() - self._open_until >= 0:
+                self._open_failed("timed out")
+            if read and self.state != DISCONNECTED:
+                data = self._conn_read()
+                more = data is not None and (len(data) == self.buffin or self._rx_pending())
+            self.process(data)
+            if timer is not None:
+                timer.run()
+            self.flush()
+
+    async def run_async(self, timer=None):
+        '''Serves the connection and timer as asyncio (or uasyncio) tasks
+
+        Receiving, keep-alive and the timer each get a task that sleeps
+        until its socket or deadline is ready. Runs until cancelled.
+        '''
+        try:
+            import asyncio
+        except ImportError:
+            import uasyncio as asyncio
+        self._wake = asyncio.Event()
+        tasks = [asyncio.create_task(self._rx_task(asyncio)),
+                 asyncio.create_task(self._keepalive_task(asyncio))]
+        if timer is not None:
+            tasks.append(asyncio.create_task(self._timer_task(asyncio, timer)))
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            self._wake = None
+
+    async def _rx_task(self, asyncio):
+        readable = _io_waiter(asyncio)
+        more = False
+        while True:
+            if self.state == DISCONNECTED:
+                await asyncio.sleep(self._wait_ms() / 1000)
+                self._reconnect()
+                self._wake.set()
+                continue
+            if not more:
+                await readable(self)
+            data = self._conn_read()
+            more = data is not None and (len(data) == self.buffin or self._rx_pending())
+            self.process(data)
+            self.flush()
+            # lastRecv moved, the keep-alive deadline has to be recomputed
+            self._wake.set()
+
+    async def _keepalive_task(self, asyncio):
+        while True:
+            self._wake.clear()
+            wait = self.time_until_next()
+            if self._txq:
+                # no writability wait here, retry the stalled queue regularly
+                wait = self.flush_ms if wait is None else min(wait, self.flush_ms)
+            if wait != 0:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), None if wait is None else wait / 1000)
+                except asyncio.TimeoutError:
+                    pass
+            if self.state != DISCONNECTED:
+                self._drain()
+                self.process()
+                self.flush()
+
+    async def _timer_task(self, asyncio, timer):
+        while True:
+            wait = timer.time_until_next()
+            # timers added from elsewhere are picked up within a second
+            await asyncio.sleep((1000 if wait is None else min(wait, 1000)) / 1000)
+            timer.run()
+            self.flush()
+
+def _io_waiter(asyncio):
+    # returns wait(blynk), which returns once blynk.conn is readable or closed
+    core = getattr(asyncio, 'core', None)
+    if core is not None and hasattr(core, '_io_queue'):
+        # uasyncio keeps its own poller, generators are awaitable there
+        def wait(blynk):
+            yield core._io_queue.queue_read(blynk.conn)
+        return wait
+
+    async def wait(blynk):
+        loop = asyncio.get_running_loop()
+        fut = blynk._rx_fut = loop.create_future()
+        fd = blynk.conn.fileno()
+        loop.add_reader(fd, lambda: fut.done() or fut.set_result(None))
+        try:
+            await fut
+        finally:
+            loop.remove_reader(fd)
+            blynk._rx_fut = None
+    return wait
 
@@ -5,86 +5,180 @@
     Module for launching timed Blynk actions
     with polling
 
+    Deadlines are kept in a min-heap on a monotonic
+    millisecond clock, so run() only looks at timers
+    that are due and time_until_next() tells the
+    caller how long it may sleep.
+
 """
 
-import time
+try:
+    import heapq
+except ImportError:
+    import uheapq as heapq
+
+from Ticks import ticks_ms, ticks_diff
+
+# what to do with runs missed because run() was polled late
+SKIP = 0        # drop the run if a whole interval was missed, keep the phase
+CATCH_UP = 1    # make up every missed run, back to back
+COALESCE = 2    # run once for all missed runs, keep the phase
+
+# the unwrapped clock is rebased before it outgrows a MicroPython small int
+_REBASE_MS = 1 << 28
 
 
 class BlynkTimer:
     '''Executes functions after a defined period of time'''
-    _MAX_TIMERS = 16
 
     def __init__(self):
+        # timers[id] is the timer with that id, None for a free slot
         self.timers = []
-        self.ids = self._get_unique_id()
-
-    def _get_unique_id(self, current=0):
-        '''yields unique id for new timer'''
-        numId = current
-        while numId < self._MAX_TIMERS:
-            yield numId
-            numId += 1
+        self._free = []
+        self._heap = []
+        self._dead = 0
+        self._seq = 0
+        self._ms = 0
+        self._last_tick = ticks_ms()
+
+    def _now(self):
+        '''Returns unwrapped milliseconds since the timer was created'''
+        t = ticks_ms()
+        self._ms += ticks_diff(t, self._last_tick)
+        self._last_tick = t
+        if self._ms >= _REBASE_MS:
+            for entry in self._heap:
+                entry[0] -= _REBASE_MS
+            self._ms -= _REBASE_MS
+        return self._ms
+
+    def _schedule(self, timer, deadline):
+        '''Pushes the next deadline of timer onto the heap'''
+        # the sequence number keeps ties in FIFO order and away from Timer
+        entry = [deadline, self._seq, timer]
+        self._seq += 1
+        timer.deadline = deadline
+        timer.entry = entry
+        heapq.heappush(self._heap, entry)
+
+    def _unschedule(self, timer):
+        '''Drops the pending deadline of timer, if any'''
+        if timer.entry is not None:
+            timer.entry[2] = None
+            timer.entry = None
+            self._dead += 1
+            if self._dead > 8 and self._dead > len(self._heap) // 2:
+                # in place: run() may be walking this list from a callback
+                heap = self._heap
+                heap[:] = [e for e in heap if e[2] is not None]
+                heapq.heapify(heap)
+                self._dead = 0
 
     def _add(self, func, **kwargs):
-        '''Inits Timer'''
-        timerId = next(self.ids)
+        '''Inits Timer in a free slot'''
+        if self._free:
+            timerId = self._free.pop()
+        else:
+            timerId = len(self.timers)
+            self.timers.append(None)
         timer = Timer(timerId, func, **kwargs)
-        self.timers.append(timer)
+        self.timers[timerId] = timer
         return timer
 
     def _get(self, timerId):
         '''Gets timer by id'''
-        timer = [t for t in self.timers if t.id == timerId]
-        if len(timer) <= 0:
-            return None
-        return timer[0]
+        if 0 <= timerId < len(self.timers):
+            return self.timers[timerId]
+        return None
 
     def _delete(self, timerId):
-        '''Deletes timer'''
+        '''Deletes timer and frees its slot'''
         timer = self._get(timerId)
+        if timer is None:
+            return None
+        self._unschedule(timer)
         timer.disable()
-        self.timers = [t for t in self.timers if t.id != timerId]
-        num_timers = self.get_num_timers()[0]
-        self.ids = self._get_unique_id(current=num_timers)
+        self.timers[timerId] = None
+        self._free.append(timerId)
         return timerId
 
     def get_num_timers(self):
-        '''Returns number of used timer slots'''
-        num_timers = len(self.timers)
-        return (num_timers, self._MAX_TIMERS)
+        '''Returns number of used timer slots and slots allocated'''
+        num_slots = len(self.timers)
+        return (num_slots - len(self._free), num_slots)
 
     def is_enabled(self, timerId):
         '''Returns true if timer is enabled'''
         timer = self._get(timerId)
         return timer.enabled
 
-    def set_interval(self, value, func):
-        '''Sets time interval for function'''
-        timer = self._add(func)
+    def set_interval(self, value, func, policy=COALESCE):
+        '''Sets time interval (seconds) for function'''
+        timer = self._add(func, policy=policy)
         timer.set_interval(value)
+        self._schedule(timer, self._now() + timer.interval)
         return timer.id
 
     def set_timeout(self, value, func):
-        '''Runs function once after timeout'''
-        timer = self._add(func, post_run=self._delete)
+        '''Runs function once after timeout (seconds)'''
+        timer = self._add(func, once=True, post_run=self._delete)
         timer.set_interval(value)
+        self._schedule(timer, self._now() + timer.interval)
         return timer.id
 
+    def cancel(self, timerId):
+        '''Deletes timer before it runs again, its id may then be reused'''
+        return self._delete(timerId)
+
     def enable(self, timerId):
         '''Enables timer'''
         timer = self._get(timerId)
-        timer.enable()
+        if not timer.enabled:
+            timer.enable()
+            self._schedule(timer, self._now() + timer.interval)
         return timerId
 
     def disable(self, timerId):
         '''Disables timer'''
         timer = self._get(timerId)
+        self._unschedule(timer)
         timer.disable()
         return timerId
 
+    def time_until_next(self):
+        '''Returns ms until the next timer is due, None if none is pending'''
+        heap = self._heap
+        while heap and heap[0][2] is None:
+            heapq.heappop(heap)
+            self._dead -= 1
+        if not heap:
+            return None
+        return max(0, heap[0][0] - self._now())
+
     def run(self):
-        '''Polls timers'''
-        [t.run() for t in self.timers]
+        '''Runs the timers that are due'''
+        now = self._now()
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            deadline, seq, timer = heapq.heappop(heap)
+            if timer is None:
+                self._dead -= 1
+                continue
+            timer.entry = None
+            late = now - deadline
+            due = True
+            if not timer.once:
+                if timer.policy == CATCH_UP:
+                    self._schedule(timer, deadline + timer.interval)
+                else:
+                    missed = late // timer.interval
+                    due = timer.policy != SKIP or missed == 0
+                    self._schedule(timer, deadline + (missed + 1) * timer.interval)
+            if due:
+                timer.func()
+            # func may have cancelled the timer and handed its id to another
+            if self.timers[timer.id] is timer:
+                timer._handle_post_run()
 
 
 class Timer:
@@ -94,36 +188,28 @@ class Timer:
         self.id = id
         self.func = func
         self.interval = None
-        self.start_time = None
+        self.deadline = None
         self.enabled = False
+        self.once = kwargs.get('once', False)
+        self.policy = kwargs.get('policy', COALESCE)
         self.on_post_run = kwargs.get('post_run', None)
+        self.entry = None
 
     def _handle_post_run(self):
         '''handles post run events'''
-        self.start_time += self.interval
         if self.on_post_run:
             return self.on_post_run(self.id)
 
     def enable(self):
         '''enables Timer'''
         self.enabled = True
-        self.start_time = time.time()
 
     def disable(self):
         '''disables timer'''
         self.enabled = False
-        self.start_time = None
+        self.deadline = None
 
     def set_interval(self, value):
-        '''Sets Time Interval for calling function'''
-        self.interval = value
+        '''Sets Time Interval (seconds) for calling function'''
+        self.interval = max(1, int(value * 1000))
         self.enable()
-
-    def run(self):
-        '''Runs function if interval has passed'''
-        if not self.enabled:
-            return
-        now = time.time()
-        if now - self.start_time > self.interval:
-            self.func()
-            self._handle_post_run()
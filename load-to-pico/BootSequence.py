@@ -0,0 +1,52 @@
+"""
+    BootSequence
+
+    Start and end times of the boot phases, in ms since
+    reset (ticks_ms starts at 0 on power-on). Phases may
+    overlap and finish on any thread: start() and done()
+    only record a timestamp, and done() ignores phases
+    that are not running, so it can be called from a
+    polling loop.
+
+"""
+
+from Ticks import ticks_ms, ticks_diff
+
+
+class BootSequence:
+    '''Per-phase boot timings'''
+
+    def __init__(self):
+        self._running = {}      # name -> start ms
+        self.phases = []        # (name, start ms, end ms), in finishing order
+
+    def start(self, name):
+        self._running[name] = ticks_ms()
+
+    def done(self, name):
+        '''Ends phase name, returns True if it was running'''
+        start = self._running.pop(name, None)
+        if start is None:
+            return False
+        self.phases.append((name, start, ticks_ms()))
+        return True
+
+    def mark(self, name):
+        '''A zero-length phase: the moment name was reached'''
+        self.start(name)
+        self.done(name)
+
+    def pending(self):
+        '''Names of the phases still running'''
+        return list(self._running)
+
+    def report(self):
+        lines = []
+        for name, start, end in self.phases:
+            if end == start:
+                lines.append("{:<12} at {:>6} ms".format(name, start))
+            else:
+                lines.append("{:<12} {:>6} - {:>6} ms ({} ms)".format(name, start, end, ticks_diff(end, start)))
+        for name in self._running:
+            lines.append("{:<12} from {:>4} ms, still running".format(name, self._running[name]))
+        return lines
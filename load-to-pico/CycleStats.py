@@ -0,0 +1,136 @@
+"""
+    CycleStats
+
+    Round-trip bookkeeping of store/generate cycles.
+    A cycle starts when the system switches to motor
+    mode (storing: energy in) and closes at the next
+    switch to motor mode, after its generate phase
+    (energy out). Each closed cycle goes into a fixed
+    ring of the last N, so memory stays constant
+    however long the system runs; lifetime totals are
+    kept alongside.
+
+    Nothing here touches samples: the caller hands
+    over each phase's energy when the mode changes
+    and the peak power of each statistics window.
+
+"""
+
+from array import array
+
+from Ticks import ticks_ms, ticks_diff
+
+
+def efficiency(energy_in, energy_out):
+    '''Round-trip efficiency in %, None without energy in'''
+    if energy_in <= 0:
+        return None
+    return 100 * energy_out / energy_in
+
+
+class CycleStats:
+    '''Energy in, energy out, duration and peak power of the last N cycles'''
+
+    def __init__(self, history=16, clock=None):
+        # clock: ms timestamps for the durations, ticks_ms by default
+        self.size = history
+        self._clock = clock or ticks_ms
+        self._in = array('f', (0 for _ in range(history)))
+        self._out = array('f', (0 for _ in range(history)))
+        self._secs = array('f', (0 for _ in range(history)))
+        self._peak = array('f', (0 for _ in range(history)))
+        self.closed = 0         # cycles closed so far, the last one is number closed
+        self.total_in = 0.0
+        self.total_out = 0.0
+        self.generating = True  # the system starts generating, with nothing stored
+        self._open = False
+        self._start_ms = 0
+        self._e_in = 0.0
+        self._e_out = 0.0
+        self._p = 0.0
+
+    def switch(self, generating, energy):
+        '''The mode changed to generating (True) or storing
+
+        energy is the joules of the phase that just ended. Returns
+        True if the change closed a cycle. A switch to the mode
+        already running is ignored.
+        '''
+        if generating == self.generating:
+            return False
+        self.generating = generating
+        if generating:
+            if self._open:
+                self._e_in += energy
+            return False
+        # storing again: the cycle that stored and generated is complete
+        done = False
+        if self._open:
+            self._e_out += energy
+            self._close()
+            done = True
+        self._open = True
+        self._start_ms = self._clock()
+        self._e_in = self._e_out = self._p = 0.0
+        return done
+
+    def power(self, w):
+        '''Folds in the peak power of one statistics window'''
+        if self._open and w > self._p:
+            self._p = w
+
+    def _close(self):
+        i = self.closed % self.size
+        self._in[i] = self._e_in
+        self._out[i] = self._e_out
+        self._secs[i] = ticks_diff(self._clock(), self._start_ms) / 1000
+        self._peak[i] = self._p
+        self.closed += 1
+        self.total_in += self._e_in
+        self.total_out += self._e_out
+
+    def cycle(self, n):
+        '''(n, energy in, energy out, seconds, peak W, efficiency %) of closed cycle n, None once it left the history'''
+        if not (self.closed - self.size < n <= self.closed) or n < 1:
+            return None
+        i = (n - 1) % self.size
+        e_in = self._in[i]
+        e_out = self._out[i]
+        return (n, e_in, e_out, self._secs[i], self._peak[i], efficiency(e_in, e_out))
+
+    def last(self):
+        '''the latest closed cycle, as cycle() returns it, None before the first'''
+        return self.cycle(self.closed)
+
+    def current(self, energy):
+        '''The open cycle with energy (joules) of the running phase added, None if none is open'''
+        if not self._open:
+            return None
+        e_in = self._e_in
+        e_out = self._e_out
+        if self.generating:
+            e_out += energy
+        else:
+            e_in += energy
+        return (self.closed + 1, e_in, e_out, ticks_diff(self._clock(), self._start_ms) / 1000, self._p, efficiency(e_in, e_out))
+
+    def report(self, energy=0.0):
+        '''Lines describing the history, the lifetime totals and the open cycle'''
+        lines = []
+        for n in range(max(1, self.closed - self.size + 1), self.closed + 1):
+            lines.append(self._line(self.cycle(n), ""))
+        live = self.current(energy)
+        if live is not None:
+            lines.append(self._line(live, " (running, {})".format("generating" if self.generating else "storing")))
+        if self.closed:
+            eff = efficiency(self.total_in, self.total_out)
+            lines.append("{n} cycles: {i:.3f} J in, {o:.3f} J out, {e}".format(n=self.closed, i=self.total_in, o=self.total_out,
+                e="-" if eff is None else "{:.2f} %".format(eff)))
+        elif live is None:
+            lines.append("no cycle yet")
+        return lines
+
+    def _line(self, c, note):
+        n, e_in, e_out, secs, peak, eff = c
+        return "cycle {n}: {i:.3f} J in, {o:.3f} J out, {e}, {s:.1f} s, peak {p:.3f} W{note}".format(n=n, i=e_in, o=e_out,
+            e="-" if eff is None else "{:.2f} %".format(eff), s=secs, p=peak, note=note)
@@ -0,0 +1,73 @@
+"""
+    EnergyMeter
+
+    Integrates instantaneous power over the real
+    sample timestamps with the trapezoidal rule.
+    Integration happens on raw read_u16 products
+    and ticks_us in integer (fixed point)
+    arithmetic, so nothing drifts however long the
+    run; conversion to joules happens on read.
+
+    Integrating every sample instead of multiplying
+    the mean voltage by the mean current keeps
+    ripple from skewing the result, since the mean
+    of a product is not the product of the means.
+
+"""
+
+from Ticks import ticks_diff
+
+FULL_SCALE = 65535  # read_u16 full scale
+
+
+class EnergyAccumulator:
+    '''Trapezoidal integral of adc0 * adc1 over time'''
+
+    def __init__(self, gain, max_gap_us=100000):
+        # gain: watts when both ADCs read full scale
+        self.gain = gain
+        self.max_gap_us = max_gap_us
+        self.reset()
+
+    def reset(self):
+        '''Zeroes the integral'''
+        self.acc = 0            # sum of (p[k-1] + p[k]) * dt_us, raw units
+        self.duration_us = 0
+        self.gap()
+
+    def gap(self):
+        '''Starts a new segment: the next sample is not joined to the last'''
+        self._p = -1
+        self._t = 0
+
+    def add_pairs(self, buf, times, start, end):
+        '''integrates the interleaved pairs buf[start:end]'''
+        acc = self.acc
+        duration = self.duration_us
+        max_gap = self.max_gap_us
+        p0 = self._p
+        t0 = self._t
+        for i in range(start, end, 2):
+            p = buf[i] * buf[i + 1]
+            t = times[i >> 1]
+            if p0 >= 0:
+                dt = ticks_diff(t, t0)
+                if 0 < dt <= max_gap:
+                    acc += (p0 + p) * dt
+                    duration += dt
+            p0 = p
+            t0 = t
+        self.acc = acc
+        self.duration_us = duration
+        self._p = p0
+        self._t = t0
+
+    def joules(self):
+        '''Energy integrated so far'''
+        return self.acc * self.gain / (2 * FULL_SCALE * FULL_SCALE * 1000000)
+
+    def mean_power(self):
+        '''Average power over the integrated time, in watts'''
+        if not self.duration_us:
+            return 0.0
+        return self.joules() * 1000000 / self.duration_us
@@ -0,0 +1,144 @@
+"""
+    Instrument
+
+    Latency instrumentation for the firmware hot paths:
+    fixed-size, linear-bin histograms of ticks_us
+    durations and timing errors, summarised on request.
+
+    Everything is decided at set-up time. Until enable()
+    is called, histogram() returns None and wrap() hands
+    back the function itself, so with instrumentation
+    off the hot paths run unchanged or pay a single
+    `is None` test. Adding a value never allocates, so
+    histograms can be fed from interrupt handlers.
+
+    Runs on MicroPython and CPython (the simulator).
+
+"""
+
+from array import array
+
+from Ticks import ticks_us, ticks_diff
+
+enabled = False
+_histograms = []
+
+
+def enable():
+    '''Turns instrumentation on for everything set up from now on'''
+    global enabled
+    enabled = True
+
+
+class Histogram:
+    '''Counts of microsecond values in bins of bin_us from lo_us up'''
+
+    def __init__(self, name, bin_us, bins=50, lo_us=0):
+        self.name = name
+        self.bin_us = bin_us
+        self.lo_us = lo_us
+        # the last bin also takes everything above the range
+        self.counts = array('I', (0 for _ in range(bins)))
+        self.reset()
+
+    def reset(self):
+        '''forgets every value'''
+        counts = self.counts
+        for i in range(len(counts)):
+            counts[i] = 0
+        self.n = 0
+        self.min = 0x3FFFFFFF
+        self.max = -0x3FFFFFFF
+
+    def add(self, us):
+        '''adds one value, no allocation'''
+        i = (us - self.lo_us) // self.bin_us
+        if i < 0:
+            i = 0
+        elif i >= len(self.counts):
+            i = len(self.counts) - 1
+        self.counts[i] += 1
+        self.n += 1
+        if us < self.min:
+            self.min = us
+        if us > self.max:
+            self.max = us
+
+    def percentile(self, p):
+        '''upper edge of the bin holding the p-th percentile'''
+        if not self.n:
+            return 0
+        want = self.n * p / 100
+        seen = 0
+        for i in range(len(self.counts)):
+            seen += self.counts[i]
+            if seen >= want:
+                if i == len(self.counts) - 1:
+                    return self.max
+                return min(self.max, self.lo_us + (i + 1) * self.bin_us)
+        return self.max
+
+    def summary(self):
+        if not self.n:
+            return "{}: no samples".format(self.name)
+        return "{}: n {}, min {}, p50 {}, p99 {}, max {} us".format(
+            self.name, self.n, self.min, self.percentile(50), self.percentile(99), self.max)
+
+
+def histogram(name, bin_us, bins=50, lo_us=0):
+    '''A new registered Histogram, or None while instrumentation is off'''
+    if not enabled:
+        return None
+    h = Histogram(name, bin_us, bins, lo_us)
+    _histograms.append(h)
+    return h
+
+
+def wrap(func, name, bin_us=1000, bins=50):
+    '''func with its run time recorded in a histogram, or func itself while off'''
+    h = histogram(name, bin_us, bins)
+    if h is None:
+        return func
+
+    def timed(*args, **kwargs):
+        start = ticks_us()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            h.add(ticks_diff(ticks_us(), start))
+    return timed
+
+
+class IntervalSink:
+    '''ADCSampler.drain() sink: how far each sample interval is off the period'''
+
+    def __init__(self, hist, period_us):
+        self.hist = hist
+        self.period_us = period_us
+        self._last = None
+
+    def gap(self):
+        '''the next sample does not follow the last one (samples were discarded)'''
+        self._last = None
+
+    def add_pairs(self, buf, times, start, end):
+        hist = self.hist
+        period = self.period_us
+        last = self._last
+        for i in range(start >> 1, end >> 1):
+            t = times[i]
+            if last is not None:
+                hist.add(ticks_diff(t, last) - period)
+            last = t
+        self._last = last
+
+
+def summary():
+    '''One line per histogram'''
+    return [h.summary() for h in _histograms]
+
+
+def reset():
+    '''Zeroes every histogram'''
+    for h in _histograms:
+        h.reset()
@@ -0,0 +1,59 @@
+"""
+    MotionProfile
+
+    Trapezoidal step timing for the stepper: the move
+    starts at a speed the motor can pull in from rest,
+    accelerates at a constant rate up to the cruise
+    speed and decelerates symmetrically into the last
+    step. Moves too short to reach cruise speed turn
+    into a triangle.
+
+    The ramp is computed once into an array of step
+    delays in microseconds and reused by every move, so
+    looking up the next delay is O(1) and allocates
+    nothing.
+
+"""
+
+import math
+from array import array
+
+
+class MotionProfile:
+    '''Step delays (us) of a trapezoidal move'''
+
+    def __init__(self, start_delay_us, cruise_delay_us, accel):
+        # start_delay_us: first and last step, slow enough to pull in from rest
+        # cruise_delay_us: shortest delay, the top speed
+        # accel: steps per second per second
+        if not 0 < cruise_delay_us <= start_delay_us <= 0xFFFF:
+            raise ValueError("need 0 < cruise_delay_us <= start_delay_us <= 65535")
+        if accel <= 0:
+            raise ValueError("accel must be positive")
+        self.start_delay_us = start_delay_us
+        self.cruise_delay_us = cruise_delay_us
+        self.accel = accel
+        # v(i)^2 = v0^2 + 2*a*i, up to the step that reaches cruise speed
+        v0 = 1000000 / start_delay_us
+        v1 = 1000000 / cruise_delay_us
+        n = int((v1 * v1 - v0 * v0) / (2 * accel)) + 1
+        self.ramp = array('H', (0 for _ in range(n)))
+        for i in range(n):
+            self.ramp[i] = max(cruise_delay_us, int(1000000 / math.sqrt(v0 * v0 + 2 * accel * i) + 0.5))
+
+    def delay_us(self, step, steps):
+        '''Delay after step (counting from 0) of a move of steps steps'''
+        k = steps - 1 - step
+        if step < k:
+            k = step
+        if k < len(self.ramp):
+            return self.ramp[k]
+        return self.cruise_delay_us
+
+    def duration_us(self, steps):
+        '''How long a move of steps steps takes'''
+        ramp = min(len(self.ramp), (steps + 1) // 2)
+        total = 2 * sum(self.ramp[k] for k in range(ramp))
+        if steps % 2 and ramp == (steps + 1) // 2:
+            total -= self.ramp[ramp - 1]    # the middle step was counted twice
+        return total + max(0, steps - 2 * ramp) * self.cruise_delay_us
@@ -0,0 +1,70 @@
+"""
+    Publisher
+
+    Change-detection filter in front of virtual_write:
+    a value is only sent when it moved by more than the
+    pin's deadband since the last one sent, no sooner
+    than min_interval after it, and at least every
+    max_interval so charts and stale dashboards still
+    get a point. refresh() makes the next value of every
+    pin go out regardless, for a fresh connection.
+
+    Pins without a policy are passed straight through.
+
+"""
+
+from Ticks import ticks_ms, ticks_diff
+
+
+class PinPolicy:
+    '''Deadband and publish interval limits of one pin, and what it last sent'''
+
+    def __init__(self, deadband=0, min_interval=0, max_interval=None):
+        self.deadband = deadband
+        self.min_ms = int(min_interval * 1000)
+        self.max_ms = None if max_interval is None else int(max_interval * 1000)
+        self.value = None       # last value sent, None forces the next one out
+        self.sent_ms = 0
+
+
+class Publisher:
+    '''Sends dashboard values through write(pin, value) only when they change'''
+
+    def __init__(self, write):
+        self._write = write
+        self._pins = {}
+        self.sent = 0
+        self.suppressed = 0
+
+    def policy(self, pin, deadband=0, min_interval=0, max_interval=None):
+        '''Sets the policy of pin: deadband in value units, intervals in seconds'''
+        self._pins[pin] = PinPolicy(deadband, min_interval, max_interval)
+
+    def refresh(self):
+        '''Makes the next publish() of every pin send'''
+        for p in self._pins.values():
+            p.value = None
+
+    def publish(self, pin, value):
+        '''Sends value to pin if its policy lets it through, returns True if sent'''
+        p = self._pins.get(pin)
+        if p is not None:
+            now = ticks_ms()
+            if p.value is not None:
+                elapsed = ticks_diff(now, p.sent_ms)
+                if p.deadband:
+                    changed = abs(value - p.value) > p.deadband
+                else:
+                    changed = value != p.value
+                if elapsed < p.min_ms or not (changed or (p.max_ms is not None and elapsed >= p.max_ms)):
+                    self.suppressed += 1
+                    return False
+            p.value = value
+            p.sent_ms = now
+        self._write(pin, value)
+        self.sent += 1
+        return True
+
+    def stats(self):
+        '''dict of sent and suppressed counts'''
+        return {'sent': self.sent, 'suppressed': self.suppressed}
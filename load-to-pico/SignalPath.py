@@ -0,0 +1,92 @@
+"""
+    SignalPath
+
+    Everything between the raw ADC sample pairs and the
+    dashboard numbers: windowed statistics, the energy
+    integral of the running mode, and the store/generate
+    cycle bookkeeping. It is a drain() sink, so the same
+    code runs on the Pico and in tools/replay_trace.py,
+    which pushes a recorded trace through it on the host.
+
+    Only the thread that drains may call it. A trace
+    recorder, if given, is fed exactly what the path is
+    fed, in the same order.
+
+"""
+
+import StreamStats, EnergyMeter, CycleStats
+
+FULL_SCALE = 65535  # read_u16 full scale
+
+
+class Reading:
+    '''The dashboard values of one statistics window'''
+
+    def __init__(self, window, generating, current_gain, voltage_gain, energy):
+        self.window = window    # StreamStats.Window, valid until the next window closes
+        self.n = window.n
+        self.generating = generating
+        # adc0 carries the current, adc1 the voltage
+        self.adc_avgs = [window.ch[0].mean/FULL_SCALE, window.ch[1].mean/FULL_SCALE]
+        self.current = current_gain*self.adc_avgs[0]
+        self.voltage = voltage_gain*self.adc_avgs[1]
+        self.power = self.voltage*self.current
+        self.max_power = current_gain*voltage_gain*window.peak_power/(FULL_SCALE*FULL_SCALE)
+        self.energy = energy    # joules of the running phase so far
+
+
+class SignalPath:
+    '''Turns (adc0, adc1) sample pairs into readings, phase energies and cycles'''
+
+    def __init__(self, generator_current_gain, motor_current_gain, voltage_gain, history=16, trace=None, clock=None):
+        # gains: amps (volts) when the ADC reads full scale; clock: ms for cycle durations
+        self.generator_current_gain = generator_current_gain
+        self.motor_current_gain = motor_current_gain
+        self.voltage_gain = voltage_gain
+        self.stats = StreamStats.StreamStats()
+        self.generator_energy = EnergyMeter.EnergyAccumulator(generator_current_gain*voltage_gain)
+        self.motor_energy = EnergyMeter.EnergyAccumulator(motor_current_gain*voltage_gain)
+        self.cycles = CycleStats.CycleStats(history, clock)
+        self.generating = True  # the system starts generating
+        self.trace = trace
+        self._meter = self.generator_energy
+
+    def add_pairs(self, buf, times, start, end):
+        '''drain() sink: interleaved raw pairs buf[start:end], ticks_us stamps in times'''
+        self.stats.add_pairs(buf, times, start, end)
+        self._meter.add_pairs(buf, times, start, end)
+        if self.trace is not None:
+            self.trace.add_pairs(buf, times, start, end)
+
+    def mode(self, generating):
+        '''The mode changed (or was set again): starts a new phase, returns True if a cycle closed'''
+        if self.trace is not None:
+            self.trace.mode(generating)
+        # the samples since the last drain were discarded either way
+        self.stats.discard()
+        self.generator_energy.gap()
+        self.motor_energy.gap()
+        if generating == self.generating:
+            return False        # set again: the running phase goes on, its energy with it
+        # the meter of the mode just left holds that whole phase
+        closed = self.cycles.switch(generating, self._meter.joules())
+        self.generating = generating
+        self._meter = self.generator_energy if generating else self.motor_energy
+        self._meter.reset()
+        return closed
+
+    def energy(self):
+        '''Joules of the running phase so far'''
+        return self._meter.joules()
+
+    def window(self):
+        '''Closes the statistics window, returns its Reading, None if it got no samples'''
+        if self.trace is not None:
+            self.trace.window()
+        window = self.stats.snapshot()
+        if window.n == 0:
+            return None
+        gain = self.generator_current_gain if self.generating else self.motor_current_gain
+        reading = Reading(window, self.generating, gain, self.voltage_gain, self._meter.joules())
+        self.cycles.power(reading.max_power)
+        return reading
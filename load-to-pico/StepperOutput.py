@@ -0,0 +1,86 @@
+"""
+    StepperOutput
+
+    Drives the stepper driver inputs (and optionally
+    mirrors them on the debug LEDs) with two writes to
+    the RP2040 SIO GPIO_OUT_CLR and GPIO_OUT_SET
+    registers instead of a Pin.value() call per pin.
+    Every pattern is compiled to a pair of masks up
+    front: the owned pins to clear, then the ones to
+    set. Nothing is read back, so a write can't undo a
+    pin another core or an ISR changed in between, and
+    every other GPIO is left alone. Pins go low before
+    any goes high, so two driver inputs are never on
+    together for longer than the pattern has them.
+
+    The register interface is anything indexable like
+    machine.mem32, so tests and benchmarks can pass a
+    simulated one.
+
+"""
+
+from array import array
+
+try:
+    from micropython import const
+except ImportError:
+    const = lambda x: x
+
+SIO_BASE = const(0xd0000000)
+GPIO_OUT = const(0xd0000010)        # SIO_BASE + 0x010
+GPIO_OUT_SET = const(0xd0000014)    # SIO_BASE + 0x014
+GPIO_OUT_CLR = const(0xd0000018)    # SIO_BASE + 0x018
+
+
+def pin_mask(pins, levels):
+    '''bitmask of the pins whose level is 1'''
+    mask = 0
+    for pin, level in zip(pins, levels):
+        if level:
+            mask |= 1 << pin
+    return mask
+
+
+class StepperOutput:
+    '''Compiled stepper phase table written through the GPIO set and clear registers'''
+
+    def __init__(self, pins, phases, leds=None, mirror=None, mem32=None):
+        # pins: GPIO numbers, in the order of the pattern lists
+        # phases: the step sequence, one pattern list per phase
+        # leds, mirror: LED GPIO leds[k] shows pattern column mirror[k],
+        #   leave them out to keep the LEDs off the hot path
+        if mem32 is None:
+            import machine
+            mem32 = machine.mem32
+        self.mem32 = mem32
+        self.pins = pins
+        self.leds = leds or ()
+        self.mirror = mirror or ()
+        self.owned = pin_mask(pins, [1] * len(pins)) | pin_mask(self.leds, [1] * len(self.leds))
+        masks = [self.compile(p) for p in phases]
+        self._set = array('I', masks)
+        self._clr = array('I', [self.owned & ~m for m in masks])
+
+    def compile(self, levels):
+        '''GPIO bitmask of one pattern list, LEDs included'''
+        mask = pin_mask(self.pins, levels)
+        for led, column in zip(self.leds, self.mirror):
+            if levels[column]:
+                mask |= 1 << led
+        return mask
+
+    def write(self, mask):
+        '''Drives every owned pin to its bit in mask, without reading the pins'''
+        mem32 = self.mem32
+        mem32[GPIO_OUT_CLR] = self.owned & ~mask
+        mem32[GPIO_OUT_SET] = mask & self.owned
+
+    def phase(self, i):
+        '''Drives phase i of the step sequence'''
+        mem32 = self.mem32
+        mem32[GPIO_OUT_CLR] = self._clr[i]
+        mem32[GPIO_OUT_SET] = self._set[i]
+
+    def pattern(self, levels):
+        '''Drives an arbitrary pattern list (disable, brake, ...)'''
+        self.write(self.compile(levels))
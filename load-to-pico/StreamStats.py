@@ -0,0 +1,177 @@
+"""
+    StreamStats
+
+    Streaming statistics for the two ADC channels:
+    min, max, mean, variance (Welford), RMS and
+    peak V*I product, kept per window and for the
+    whole run. Windows are double buffered, so
+    taking a snapshot is O(1) no matter how many
+    samples went in, and the snapshot interval is
+    independent of the sampling rate.
+
+    Runs on MicroPython and CPython.
+
+"""
+
+import math
+
+
+class ChannelStats:
+    '''Running statistics of one channel'''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        '''forgets every sample'''
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, x):
+        '''adds one sample'''
+        self.n += 1
+        d = x - self.mean
+        self.mean += d / self.n
+        self.m2 += d * (x - self.mean)
+        if self.min is None or x < self.min:
+            self.min = x
+        if self.max is None or x > self.max:
+            self.max = x
+
+    def add_strided(self, buf, start, end, step=2):
+        '''adds buf[start:end:step]'''
+        n = self.n
+        mean = self.mean
+        m2 = self.m2
+        lo = self.min
+        hi = self.max
+        if lo is None and start < end:
+            lo = hi = buf[start]
+        for i in range(start, end, step):
+            x = buf[i]
+            n += 1
+            d = x - mean
+            mean += d / n
+            m2 += d * (x - mean)
+            if x < lo:
+                lo = x
+            elif x > hi:
+                hi = x
+        self.n = n
+        self.mean = mean
+        self.m2 = m2
+        self.min = lo
+        self.max = hi
+
+    def merge(self, other):
+        '''folds the samples of other into this one (Chan et al.)'''
+        if other.n == 0:
+            return
+        if self.n == 0:
+            self.n, self.mean, self.m2 = other.n, other.mean, other.m2
+            self.min, self.max = other.min, other.max
+            return
+        n = self.n + other.n
+        d = other.mean - self.mean
+        self.mean += d * other.n / n
+        self.m2 += other.m2 + d * d * self.n * other.n / n
+        self.n = n
+        if other.min < self.min:
+            self.min = other.min
+        if other.max > self.max:
+            self.max = other.max
+
+    def variance(self):
+        '''population variance'''
+        return self.m2 / self.n if self.n else 0.0
+
+    def std(self):
+        '''population standard deviation'''
+        return math.sqrt(self.variance())
+
+    def rms(self):
+        '''root mean square'''
+        return math.sqrt(self.mean * self.mean + self.variance()) if self.n else 0.0
+
+
+class Window:
+    '''Statistics of both channels over one snapshot interval'''
+
+    def __init__(self):
+        self.ch = (ChannelStats(), ChannelStats())
+        self.reset()
+
+    def reset(self):
+        '''forgets every sample'''
+        self.ch[0].reset()
+        self.ch[1].reset()
+        self.peak_power = 0
+
+    @property
+    def n(self):
+        return self.ch[0].n
+
+    def merge(self, other):
+        '''folds other into this window'''
+        self.ch[0].merge(other.ch[0])
+        self.ch[1].merge(other.ch[1])
+        if other.peak_power > self.peak_power:
+            self.peak_power = other.peak_power
+
+
+class StreamStats:
+    '''Windowed and lifetime statistics of (ch0, ch1) sample pairs'''
+
+    def __init__(self):
+        self._windows = (Window(), Window())
+        self._cur = 0
+        self.total = Window()
+
+    @property
+    def window(self):
+        '''the window currently being filled'''
+        return self._windows[self._cur]
+
+    def add(self, a, b):
+        '''adds one sample pair'''
+        w = self._windows[self._cur]
+        w.ch[0].add(a)
+        w.ch[1].add(b)
+        if a * b > w.peak_power:
+            w.peak_power = a * b
+
+    def add_pairs(self, buf, times, start, end):
+        '''adds the interleaved pairs buf[start:end], times are not needed'''
+        w = self._windows[self._cur]
+        w.ch[0].add_strided(buf, start, end)
+        w.ch[1].add_strided(buf, start + 1, end)
+        peak = w.peak_power
+        for i in range(start, end, 2):
+            p = buf[i] * buf[i + 1]
+            if p > peak:
+                peak = p
+        w.peak_power = peak
+
+    def snapshot(self):
+        '''Closes the current window and returns it, O(1)
+
+        The returned window stays valid until the next snapshot().
+        '''
+        done = self._windows[self._cur]
+        self._cur ^= 1
+        self._windows[self._cur].reset()
+        self.total.merge(done)
+        return done
+
+    def discard(self):
+        '''Drops the samples of the current window'''
+        self._windows[self._cur].reset()
+
+    def reset(self):
+        '''Drops everything, including the lifetime totals'''
+        self._windows[0].reset()
+        self._windows[1].reset()
+        self.total.reset()
@@ -0,0 +1,160 @@
+"""
+    TelemetryLog
+
+    Store-and-forward telemetry for Wi-Fi outages: fixed
+    size binary records in a ring file on flash, replayed
+    to the server in batches once it is reachable again.
+
+    The file is preallocated to capacity records and
+    record seq always lives in slot seq % capacity, so
+    there is no header to rewrite: the write position is
+    found at boot by scanning for the highest valid seq.
+    Each record carries a checksum, so a write torn by a
+    reset is skipped instead of replayed. Flash is only
+    written at the record rate, spread evenly over the
+    whole file, and the small cursor file (last replayed
+    seq) is only written when a replay has caught up.
+    Replayed records only count as delivered once the
+    caller confirm()s them; until then rewind() sends
+    them again, so a write the connection lost (or a
+    full send queue threw away) is never skipped.
+
+    RAM use is fixed: one record buffer, whatever the
+    outage length. Past capacity records the oldest are
+    overwritten, so retention is capacity * interval.
+
+"""
+
+import struct
+
+from Ticks import ticks_ms, ticks_diff
+
+RECORD = "<IIHfffH"     # seq, time (0: unknown), mode, power, max power, energy, checksum
+RECORD_SIZE = struct.calcsize(RECORD)
+_FILL = b'\xff' * 64    # erased flash reads as 0xff
+
+
+def _checksum(buf):
+    return sum(memoryview(buf)[:RECORD_SIZE - 2]) & 0xFFFF
+
+
+class TelemetryLog:
+    '''Ring of fixed-size telemetry records in a flash file'''
+
+    def __init__(self, path='telemetry.bin', capacity=1440, interval_ms=10000):
+        # capacity: records kept; interval_ms: shortest time between records
+        self.path = path
+        self.cursor_path = path + '.cur'
+        self.capacity = capacity
+        self.interval_ms = interval_ms
+        self._buf = bytearray(RECORD_SIZE)
+        self._last_ms = None
+        self._open()
+        self.next_seq = self._scan() + 1
+        self.cursor = min(self._load_cursor(), self.next_seq - 1)
+        self._sent = self.cursor    # last seq passed to send(), not confirmed past cursor
+
+    def _open(self):
+        size = self.capacity * RECORD_SIZE
+        try:
+            self._f = open(self.path, 'r+b')
+            self._f.seek(0, 2)
+            if self._f.tell() == size:
+                return
+            self._f.close()
+        except OSError:
+            pass
+        # new (or resized) log: preallocate so writes never grow the file
+        self._f = open(self.path, 'w+b')
+        left = size
+        while left > 0:
+            n = min(left, len(_FILL))
+            self._f.write(_FILL[:n])
+            left -= n
+        self._f.flush()
+
+    def _scan(self):
+        # highest valid seq in the file, 0 if none
+        top = 0
+        self._f.seek(0)
+        for slot in range(self.capacity):
+            if self._f.readinto(self._buf) != RECORD_SIZE:
+                break
+            seq = struct.unpack_from("<I", self._buf)[0]
+            if seq > top and seq % self.capacity == slot and self._valid():
+                top = seq
+        return top
+
+    def _valid(self):
+        return struct.unpack_from("<H", self._buf, RECORD_SIZE - 2)[0] == _checksum(self._buf)
+
+    def _load_cursor(self):
+        try:
+            with open(self.cursor_path) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return 0
+
+    def _save_cursor(self):
+        with open(self.cursor_path, 'w') as f:
+            f.write(str(self.cursor))
+
+    def pending(self):
+        '''Records logged but not replayed yet, within retention'''
+        return self.next_seq - 1 - max(self.cursor, self.next_seq - 1 - self.capacity)
+
+    def append(self, t, mode, power, max_power, energy):
+        '''Logs one record unless the last one is less than interval_ms old
+
+        Returns True if the record was written.
+        '''
+        now = ticks_ms()
+        if self._last_ms is not None and ticks_diff(now, self._last_ms) < self.interval_ms:
+            return False
+        self._last_ms = now
+        seq = self.next_seq
+        struct.pack_into(RECORD, self._buf, 0, seq, t, mode, power, max_power, energy, 0)
+        struct.pack_into("<H", self._buf, RECORD_SIZE - 2, _checksum(self._buf))
+        self._f.seek((seq % self.capacity) * RECORD_SIZE)
+        self._f.write(self._buf)
+        self._f.flush()
+        self.next_seq = seq + 1
+        return True
+
+    def replay(self, send, batch=16):
+        '''Passes up to batch records not sent yet to send(seq, t, mode, power, max_power, energy)
+
+        Returns the number of records sent. They stay pending
+        until confirm().
+        '''
+        seq = max(self._sent, self.next_seq - 1 - self.capacity) + 1
+        sent = 0
+        while sent < batch and seq < self.next_seq:
+            self._f.seek((seq % self.capacity) * RECORD_SIZE)
+            if self._f.readinto(self._buf) == RECORD_SIZE and self._valid():
+                rec = struct.unpack_from(RECORD, self._buf)
+                if rec[0] == seq:
+                    send(*rec[:6])
+                    sent += 1
+            self._sent = seq
+            seq += 1
+        return sent
+
+    def unconfirmed(self):
+        '''Records sent by replay() and not confirmed yet'''
+        return self._sent - self.cursor
+
+    def confirm(self):
+        '''The records sent so far were delivered: moves the cursor past them
+
+        The cursor file is written once nothing is left to replay.
+        '''
+        if self._sent <= self.cursor:
+            return
+        self.cursor = self._sent
+        if self.cursor >= self.next_seq - 1:
+            self._save_cursor()
+
+    def rewind(self):
+        '''The records sent since the last confirm() may be lost: replay() sends them again'''
+        self._sent = self.cursor
@@ -0,0 +1,35 @@
+"""
+    Ticks
+
+    MicroPython's ticks_ms, ticks_us, ticks_diff and
+    ticks_add for every module here. On the board they
+    are time's own; under CPython (the host tools, the
+    replay and the benchmarks) they are emulated the way
+    the board behaves: both counters start near 0 and
+    wrap at 2**30, and ticks_diff is the signed distance
+    across the wrap, so host runs go through the same
+    code paths as the Pico.
+
+"""
+
+try:
+    from time import ticks_ms, ticks_us, ticks_diff, ticks_add
+except ImportError:
+    from time import perf_counter
+
+    PERIOD = 1 << 30
+    _MASK = PERIOD - 1
+    _HALF = PERIOD // 2
+    _t0 = perf_counter()    # the host's "reset": the first import
+
+    def ticks_ms():
+        return int((perf_counter() - _t0) * 1000) & _MASK
+
+    def ticks_us():
+        return int((perf_counter() - _t0) * 1000000) & _MASK
+
+    def ticks_diff(a, b):
+        return ((a - b + _HALF) & _MASK) - _HALF
+
+    def ticks_add(t, delta):
+        return (t + delta) & _MASK
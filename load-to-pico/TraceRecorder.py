@@ -0,0 +1,216 @@
+"""
+    TraceRecorder
+
+    Records what SignalPath is fed, in the order it is
+    fed: raw read_u16 (adc0, adc1) pairs with their
+    ticks_us stamps, mode changes and statistics window
+    boundaries. tools/replay_trace.py pushes such a trace
+    back through SignalPath on the host and gets the
+    numbers the run produced.
+
+    Nothing is recorded until enable() is called; until
+    then recorder() returns None. Records are packed into
+    a RAM buffer and written out a buffer at a time on
+    the draining thread, and at every window boundary.
+    Recording stops for good once the file would pass
+    max_bytes (by default the filesystem's free space
+    less keep_free, measured when recording starts) or
+    a write fails; what is in the file by then stays.
+
+    File layout, little endian:
+
+        header  "<4sBBHddd"  b'ADCT', version, 0, sample rate Hz,
+                             generator current, motor current and
+                             voltage gains
+        pair    "<HHH"       us since the previous stamp (< 0xFFFF), adc0, adc1
+        event   "<HBBI"      0xFFFF, kind, arg, ticks_us
+
+    A TIME event sets the stamp the next pair counts from:
+    it comes first and wherever a gap doesn't fit 16 bits.
+    MODE (arg 1 generating, 0 storing) and WINDOW mark
+    where the signal path got them; their stamps are only
+    informative.
+
+"""
+
+import os
+import struct
+
+from Ticks import ticks_us, ticks_diff
+
+MAGIC = b'ADCT'
+VERSION = 1
+HEADER = "<4sBBHddd"
+PAIR = "<HHH"
+EVENT = "<HBBI"
+HEADER_SIZE = struct.calcsize(HEADER)
+PAIR_SIZE = struct.calcsize(PAIR)
+EVENT_SIZE = struct.calcsize(EVENT)
+ESCAPE = 0xFFFF     # first field of an event, never a pair's delta
+
+# event kinds
+TIME = 1
+MODE = 2
+WINDOW = 3
+
+KEEP_FREE = 64 * 1024   # bytes of flash left for everything else by default
+
+enabled = False
+_path = None
+_max_bytes = None
+_keep_free = KEEP_FREE
+
+
+def enable(path, max_bytes=None, keep_free=KEEP_FREE):
+    '''Makes recorder() record to path, at most max_bytes, or all but keep_free of the free space'''
+    global enabled, _path, _max_bytes, _keep_free
+    enabled = True
+    _path = path
+    _max_bytes = max_bytes
+    _keep_free = keep_free
+
+
+def free_bytes(path):
+    '''Bytes free on the filesystem path is (to be) on'''
+    folder = path.rsplit('/', 1)[0] if '/' in path else '.'
+    st = os.statvfs(folder or '/')
+    return st[1] * st[4]    # f_frsize * f_bavail
+
+
+def recorder(rate, gains):
+    '''A TraceRecorder on the enabled file, None unless enable() was called
+
+    rate: nominal sample rate in Hz; gains: (generator current,
+    motor current, voltage) as SignalPath takes them.
+    '''
+    if not enabled:
+        return None
+    max_bytes = _max_bytes
+    if max_bytes is None:
+        max_bytes = free_bytes(_path) - _keep_free
+    if max_bytes <= HEADER_SIZE:
+        print("ADC trace: no room for {} on the filesystem".format(_path))
+        return None
+    try:
+        return TraceRecorder(_path, max_bytes, rate, gains)
+    except OSError as e:
+        print("ADC trace: can't open {}: {}".format(_path, e))
+        return None
+
+
+class TraceRecorder:
+    '''Appends sample pairs and events to a trace file'''
+
+    def __init__(self, path, max_bytes, rate, gains, buffer=1536):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._buf = bytearray(buffer)
+        self._mv = memoryview(self._buf)
+        self._last = None       # stamp the next pair counts from
+        self.written = 0        # bytes in the file
+        self.pairs = 0          # pairs taken in, a buffer still in RAM when the file fills is lost
+        self.full = False
+        self.error = None       # the OSError that stopped recording, if one did
+        self._f = open(path, 'wb')
+        struct.pack_into(HEADER, self._buf, 0, MAGIC, VERSION, 0, rate, gains[0], gains[1], gains[2])
+        self._pos = HEADER_SIZE
+
+    def add_pairs(self, buf, times, start, end):
+        '''drain() sink: records the interleaved pairs buf[start:end]'''
+        if self._f is None:
+            return
+        out = self._buf
+        pack_into = struct.pack_into
+        limit = len(out) - EVENT_SIZE - PAIR_SIZE  # room for a TIME event and its pair
+        pos = self._pos
+        last = self._last
+        n = 0
+        for i in range(start, end, 2):
+            if pos > limit:
+                self._pos = pos
+                if not self._write():
+                    break
+                pos = 0
+            t = times[i >> 1]
+            dt = ESCAPE if last is None else ticks_diff(t, last)
+            if not 0 <= dt < ESCAPE:
+                pack_into(EVENT, out, pos, ESCAPE, TIME, 0, t)
+                pos += EVENT_SIZE
+                dt = 0
+            pack_into(PAIR, out, pos, dt, buf[i], buf[i + 1])
+            pos += PAIR_SIZE
+            last = t
+            n += 1
+        self._pos = pos
+        self._last = last
+        self.pairs += n
+
+    def mode(self, generating):
+        '''Records a mode change'''
+        self._event(MODE, 1 if generating else 0)
+
+    def window(self):
+        '''Records a window boundary and writes everything buffered out'''
+        self._event(WINDOW, 0)
+        if self._f is not None and self._write():
+            try:
+                self._f.flush()
+            except OSError as e:
+                self._fail(e)
+
+    def _event(self, kind, arg):
+        if self._f is None:
+            return
+        if self._pos + EVENT_SIZE > len(self._buf) and not self._write():
+            return
+        struct.pack_into(EVENT, self._buf, self._pos, ESCAPE, kind, arg, ticks_us())
+        self._pos += EVENT_SIZE
+
+    def _write(self):
+        # empties the buffer into the file, returns False (and stops) once it's full
+        n = self._pos
+        if self.written + n > self.max_bytes:
+            self.full = True
+            self._pos = 0
+            self.close()
+            return False
+        if n:
+            try:
+                self._f.write(self._mv[:n])
+            except OSError as e:
+                self._fail(e)
+                return False
+            self.written += n
+            self._pos = 0
+        return True
+
+    def _fail(self, e):
+        # the filesystem is full (or gone): recording stops, the caller carries on
+        self.error = e
+        self.full = True
+        self._pos = 0
+        f = self._f
+        self._f = None
+        try:
+            f.close()
+        except OSError:
+            pass
+
+    def close(self):
+        '''Writes what is buffered (if it fits) and closes the file'''
+        if self._f is None:
+            return
+        try:
+            if self._pos and self.written + self._pos <= self.max_bytes:
+                self._f.write(self._mv[:self._pos])
+                self.written += self._pos
+        except OSError as e:
+            self._fail(e)
+            return
+        self._pos = 0
+        f = self._f
+        self._f = None
+        try:
+            f.close()
+        except OSError as e:
+            self.error = e
@@ -0,0 +1,125 @@
+"""
+    WifiLink
+
+    Non-blocking Wi-Fi station reconnect state machine.
+    poll() is called from the main loop; it never
+    sleeps, it only looks at the interface and moves
+    between states:
+
+        DOWN -> CONNECTING -> UP
+                    |          |
+                    v          v
+                 BACKOFF <---- (link lost)
+
+    A failed attempt (an error status or no IP within
+    attempt_ms) waits before the next one, doubling the
+    wait from base_ms up to max_ms with random jitter so
+    a roomful of boards doesn't retry in lockstep. The
+    last few state changes are kept with their interface
+    status for diagnostics.
+
+"""
+
+import random
+
+from Ticks import ticks_ms, ticks_diff
+
+DOWN = 0
+CONNECTING = 1
+UP = 2
+BACKOFF = 3
+
+STATE_NAMES = ('down', 'connecting', 'up', 'backoff')
+
+
+class WifiLink:
+    '''Keeps a WLAN station connected without blocking the caller'''
+
+    def __init__(self, wlan, ssid, password, base_ms=1000, max_ms=60000, attempt_ms=15000, history=16):
+        self.wlan = wlan
+        self.ssid = ssid
+        self.password = password
+        self.base_ms = base_ms
+        self.max_ms = max_ms
+        self.attempt_ms = attempt_ms
+        self.state = DOWN
+        self.failures = 0       # failed attempts since the link was last up
+        self.attempts = 0
+        self.history = []       # (ticks_ms, state, wlan status), oldest first
+        self._history_len = history
+        self._since = ticks_ms()
+        self._retry_ms = 0
+
+    def _set(self, state, status=None):
+        self.state = state
+        self._since = ticks_ms()
+        if status is None:
+            status = self.wlan.status()
+        self.history.append((self._since, state, status))
+        if len(self.history) > self._history_len:
+            self.history.pop(0)
+
+    def _connect(self):
+        self.attempts += 1
+        print('connecting to WiFi network "{}" (attempt {})...'.format(self.ssid, self.attempts))
+        try:
+            self.wlan.active(True)
+            self.wlan.connect(self.ssid, self.password)
+        except OSError as e:
+            print("WIFI CONNECT EXCEPTION - {}".format(e))
+            self._fail()
+            return
+        self._set(CONNECTING)
+
+    def _fail(self):
+        status = self.wlan.status()
+        try:
+            self.wlan.disconnect()
+        except OSError:
+            pass
+        self.failures += 1
+        wait = min(self.max_ms, self.base_ms << min(self.failures - 1, 16))
+        # "equal jitter": somewhere between half and all of the wait
+        self._retry_ms = wait // 2 + random.getrandbits(16) * (wait - wait // 2) // 65536
+        print("WiFi attempt failed (status {}), retrying in {:.1f} s".format(status, self._retry_ms / 1000))
+        self._set(BACKOFF, status)
+
+    def poll(self):
+        '''Advances the state machine, returns True while the link is up'''
+        state = self.state
+        if state == UP:
+            if self.wlan.isconnected():
+                return True
+            print("WiFi link lost")
+            self.failures = 0
+            self._connect()
+        elif state == CONNECTING:
+            if self.wlan.isconnected():
+                self.failures = 0
+                self._set(UP)
+                print("network connected!")
+                print('network configuration: ', self.wlan.ifconfig())
+                print()
+                return True
+            status = self.wlan.status()
+            if status < 0 or ticks_diff(ticks_ms(), self._since) >= self.attempt_ms:
+                self._fail()
+        elif state == BACKOFF:
+            if self.wlan.isconnected():
+                self.failures = 0
+                self._set(UP)
+                return True
+            if ticks_diff(ticks_ms(), self._since) >= self._retry_ms:
+                self._connect()
+        else:
+            self._connect()
+        return False
+
+    def isconnected(self):
+        return self.state == UP
+
+    def status_history(self):
+        '''The kept state changes as lines, oldest first'''
+        now = ticks_ms()
+        return ["{:>8.1f} s ago: {} (status {})".format(ticks_diff(now, t) / 1000, STATE_NAMES[s], status)
+                for t, s, status in self.history]
@@ -21,7 +21,15 @@
 
 """
 
-import utime, machine, BlynkLib, network, BlynkTimer, _thread, sys
+import utime, BootSequence
+
+# boot phases in ms since reset, printed once Blynk is first connected
+boot = BootSequence.BootSequence()
+boot.start("imports")
+
+import machine, BlynkLib, network, ntptime, BlynkTimer, _thread, sys, ADCSampler, SignalPath, MotionProfile, StepperOutput, TelemetryLog, Instrument, WifiLink, Publisher, TraceRecorder
+
+boot.done("imports")
 
 #########################################################################################
 ####################################### DEFINES #########################################
@@ -41,21 +49,58 @@ POWER_VPIN = 1
 KILLSWITCH_VPIN = 2
 MAX_POWER_VPIN = 3
 TOTAL_ENERGY_GENERATED_VPIN = 4
+TOTAL_ENERGY_USED_VPIN = 5
+TELEMETRY_REPLAY_VPIN = 6 # seq, time (0 if logged before the clock was set), mode (0 generate, 1 motor), power, max power, energy of logged records
+INSTRUMENT_VPIN = 7       # terminal: "stats" replies with the latency summary, "reset" clears it, "wifi" the link history, "boot" the boot timings, "cycles" the cycle history
+CYCLE_VPIN = 8            # number, energy in, energy out, efficiency %, duration s, peak power W of each closed store/generate cycle
 
 BLYNK_UPDATE_INTERVAL = 1 # seconds
+BLYNK_TX_BUFFER = 256     # bytes of outgoing frames coalesced into one socket write
+BLYNK_TX_QUEUE = 2048     # bytes of outgoing frames held while the socket is stalled
+
+#### Dashboard publishing (power and energy only go out when they change) ####
+PUBLISH_MIN_INTERVAL = 0.5 # seconds between sends of one pin, under BLYNK_UPDATE_INTERVAL so timer jitter can't hold a change back a whole update
+PUBLISH_MAX_INTERVAL = 60  # seconds, an unchanged value is still resent this often
+POWER_DEADBAND = 0.01      # W
+ENERGY_DEADBAND = 0.1      # J
+
+#### Telemetry log (dashboard updates made while offline, replayed on reconnect) ####
+TELEMETRY_LOG_FILE = "telemetry.bin"
+TELEMETRY_LOG_INTERVAL = 10      # seconds between logged records while offline
+TELEMETRY_LOG_RECORDS = 1440     # records kept on flash (4 hours at 10 s), 24 bytes each
+TELEMETRY_REPLAY_INTERVAL = 0.25 # seconds between replay batches
+TELEMETRY_REPLAY_BATCH = 16      # records per batch
+CLOCK_SYNC_RETRY = 60            # seconds between NTP attempts until the clock is set
 
 #### ADC globals ####
-ADC_UPDATE_INTERVAL = 20 # milliseconds
-N_adc_samples = 1        # number of ADC samples since last blynk update
-adc_sums = [0.0, 0.0]    # sums of ADC samples for averaging
+ADC_SAMPLE_RATE = 1000   # Hz
+ADC_RING_SIZE = 512      # raw sample pairs per block, two blocks swapped at each drain
+ADC_FULL_SCALE = 65535   # read_u16 full scale
+ADC_DRAIN_INTERVAL = 0.1 # seconds between drains, well inside ADC_RING_SIZE/ADC_SAMPLE_RATE
 adc_avgs = [0.0, 0.0]    # ADC averages
-adc_max = 0
-energy_generated = 0
+
+CYCLE_HISTORY = 16       # closed store/generate cycles kept for the "cycles" report
+
+# amps (adc0) and volts (adc1) when the ADCs read full scale
+GENERATOR_CURRENT_GAIN = 3.3/(0.55*5)
+MOTOR_CURRENT_GAIN = 3.3/(0.5*5)
+VOLTAGE_GAIN = 4*3.3
+
+#### Raw ADC trace (replayed on a computer by tools/replay_trace.py) ####
+TRACE_FILE = None            # e.g. "trace.bin" to record, about 6 kB per second of sampling
+TRACE_MAX_BYTES = None       # recording stops here, None for the free flash space less TRACE_KEEP_FREE
+TRACE_KEEP_FREE = 64*1024    # bytes of flash the trace leaves for the telemetry log and everything else
+
+#### Latency instrumentation (off: no timing code runs on the hot paths) ####
+INSTRUMENT = False
+INSTRUMENT_REPORT_INTERVAL = 0 # seconds between console summaries, 0 for on request only
 
 #### WiFi Stuff ####
 
-MAX_NETWORK_CONNECTION_ERRORS_ALLOWED = 5
-MAX_NETWORK_CONNECTION_ATTEMPTS_ALLOWED = 3
+# reconnects back off from WIFI_BACKOFF_BASE to WIFI_BACKOFF_MAX seconds, with jitter
+WIFI_BACKOFF_BASE = 1
+WIFI_BACKOFF_MAX = 60
+WIFI_ATTEMPT_TIMEOUT = 15 # seconds an attempt may take to get an IP
 
 WIFI_NAME =  'ssid'
 
@@ -68,6 +113,10 @@ known_wifi_passwords = {
 MIN_STEP_DELAY = 6
 MAX_STEP_DELAY = 20
 
+# stroke motion profile: starts and ends at MAX_STEP_DELAY, ramps to the cruise speed
+STEPPER_CRUISE_DELAY_US = MIN_STEP_DELAY*1000 # top speed, the fastest the hardware has been run at
+STEPPER_ACCEL = 400 # steps/s^2
+
 STEPS_TO_BOTTOM = 4800
 SPIN_CW = False
 
@@ -78,6 +127,8 @@ stepper_signals = {
     4 : [1, 1, 0, 1, 0, 1]
 }
 
+STEPPER_LED_MIRROR = True # show IN1-4 on the LEDs, in the same register write as the driver pins
+
 #########################################################################################
 ################################### PIN DEFINITIONS #####################################
 #########################################################################################
@@ -101,6 +152,13 @@ stepper_pins = [
     machine.Pin(5, machine.Pin.OUT)  # IN4
 ]
 
+# drives stepper_pins (and mirrors IN1-4 on LED_pins) with one SIO register write per step
+stepper_output = StepperOutput.StepperOutput(
+    [0, 2, 3, 1, 4, 5], # GPIO numbers of stepper_pins
+    [stepper_signals[s] for s in (1, 2, 3, 4)],
+    leds = [18, 19, 20, 21] if STEPPER_LED_MIRROR else None, # GPIO numbers of LED_pins
+    mirror = [1, 2, 4, 5])
+
 RELAY1 = machine.Pin(14, machine.Pin.OUT, machine.Pin.PULL_DOWN)
 RELAY2 = machine.Pin(15, machine.Pin.OUT, machine.Pin.PULL_DOWN)
 
@@ -109,17 +167,55 @@ RELAY2 = machine.Pin(15, machine.Pin.OUT, machine.Pin.PULL_DOWN)
 adc0 = machine.ADC(machine.Pin(26))
 adc1 = machine.ADC(machine.Pin(27))
 
+if INSTRUMENT:
+    Instrument.enable()
+
+# latency histograms, all None unless INSTRUMENT is set
+adc_isr_hist = Instrument.histogram("ADC ISR", 2)
+adc_jitter = Instrument.histogram("ADC interval error", 20, 50, -500)
+step_error_hist = Instrument.histogram("step lateness", 20)
+if adc_jitter is not None:
+    adc_jitter = Instrument.IntervalSink(adc_jitter, 1000000 // ADC_SAMPLE_RATE)
+
+# the timer ISR only stores raw readings, the Blynk thread drains them into signal_path
+adc_sampler = ADCSampler.ADCSampler(adc0, adc1, ADC_RING_SIZE)
+if adc_isr_hist is not None:
+    adc_sampler.instrument(adc_isr_hist)
+
+# records what signal_path is fed, None unless TRACE_FILE is set
+if TRACE_FILE:
+    TraceRecorder.enable(TRACE_FILE, TRACE_MAX_BYTES, TRACE_KEEP_FREE)
+adc_trace = TraceRecorder.recorder(ADC_SAMPLE_RATE, (GENERATOR_CURRENT_GAIN, MOTOR_CURRENT_GAIN, VOLTAGE_GAIN))
+
+# windowed statistics, per-mode energy integrals and store/generate cycles,
+# owned by the thread that drains (see drain_adcs)
+signal_path = SignalPath.SignalPath(GENERATOR_CURRENT_GAIN, MOTOR_CURRENT_GAIN, VOLTAGE_GAIN, CYCLE_HISTORY, adc_trace)
+cycles = signal_path.cycles
+
+# flash ring of the dashboard updates the server missed
+telemetry_log = TelemetryLog.TelemetryLog(TELEMETRY_LOG_FILE, TELEMETRY_LOG_RECORDS, TELEMETRY_LOG_INTERVAL*1000)
+
 #########################################################################################
 ################################### GLOBAL VARIABLES ####################################
 #########################################################################################
 
 stepper_state = 1
 
+stroke_profile = MotionProfile.MotionProfile(MAX_STEP_DELAY*1000, STEPPER_CRUISE_DELAY_US, STEPPER_ACCEL)
+
 generate = True
 was_generating = True
 
 kill = False
 
+adc_mode_changed = False # set by handle_generate_state_change, handled by drain_adcs
+switches_changed = False # set by the state change handlers, sent by send_switches on the Blynk thread
+
+replay_losses = 0 # tx queue drops and merges when the last telemetry batch was sent
+
+clock_set = False # the RTC restarts at 2021-01-01 on every boot, until sync_clock sets it
+clock_sync_at = utime.ticks_ms()
+
 #########################################################################################
 ###################################### FUNCTIONS ########################################
 #########################################################################################
@@ -166,10 +262,7 @@ def enable_generator():
 ### STEPPER COMMUNICATION ###
 
 def send_stepper_signal(list):
-    global stepper_pins
-    for pin, value in zip(stepper_pins, list):
-        pin.value(value)
-    show_on_LEDs([list[1], list[2], list[4], list[5]])
+    stepper_output.pattern(list)
 
 def disable_stepper():
     send_stepper_signal([0, 0, 0, 0, 0, 0])
@@ -181,7 +274,8 @@ def brake_stepper():
 
 ### SHORTCUTS ###
 
-def initialize_hardware(step_delay = 200):
+# step_delay: relay settling time between steps
+def initialize_hardware(step_delay = 10):
     print("beginning hardware setup process...")
     disable_generator()
     show_on_LEDs([1, 0, 0, 0])
@@ -193,8 +287,7 @@ def initialize_hardware(step_delay = 200):
     show_on_LEDs([1, 1, 1, 0])
     utime.sleep_ms(step_delay)
     print("\nhardware setup complete!\n")
-    show_on_LEDs([1, 1, 1, 1])
-    flash_LEDs(2)
+    show_on_LEDs([0, 0, 0, 0])
 
 # creates noticeable buffer time between killswitch triggers
 def killswitch_pause():
@@ -208,70 +301,43 @@ def killswitch_pause():
     print("kill switch re-enabled")
     show_on_LEDs([0, 0, 0, 0])
 
-def connect_to_WiFi_network(ssid = WIFI_NAME):
-
-    sta_if = network.WLAN(network.STA_IF)
-
-    print('connecting to WiFi network "{}"...'.format(WIFI_NAME))
-    sta_if.active(True)
-
-    errors_counted = 0
-    attempts = 1
-
+# advances the Wi-Fi reconnect state machine, never blocks
+def poll_wifi():
+    if wifi.poll():
+        boot.done("wifi")
+
+# sets the RTC from NTP once Wi-Fi is up, so logged telemetry carries the real time;
+# blocks up to a second, so only the main loop calls it, never a stroke
+def sync_clock():
+    global clock_set
+    global clock_sync_at
+    if clock_set or not wifi.isconnected() or utime.ticks_diff(utime.ticks_ms(), clock_sync_at) < 0:
+        return
+    clock_sync_at = utime.ticks_add(utime.ticks_ms(), CLOCK_SYNC_RETRY*1000)
     try:
-        sta_if.connect(ssid, known_wifi_passwords[ssid])
-    except:
-        print("WIFI CONNECT EXCEPTION - on attempt {}".format(attempts))
-
-    while not sta_if.isconnected():
-
-        stat = sta_if.status()
-
-        if stat is network.STAT_IDLE:
-            print("idle...")
-        elif stat is network.STAT_GOT_IP:
-            print("IP recieved...")
-        elif stat is network.STAT_CONNECTING:
-            print("connecting...")
-        elif stat is network.STAT_NO_AP_FOUND:
-            print("ERROR: AP not found...")
-        elif stat is network.STAT_CONNECT_FAIL:
-            print("ERROR: misc. connection failure...")
-        elif stat is network.STAT_WRONG_PASSWORD:
-            print("ERROR: incorrect password error recieved...")
-        else:
-            print("ERROR: unknown network status case...")
-
-        if stat is not (network.STAT_IDLE or network.STAT_GOT_IP or network.STAT_CONNECTING):
-            if errors_counted >= MAX_NETWORK_CONNECTION_ERRORS_ALLOWED:
-                print("too many ({}) errors in a row. restarting connection...".format(errors_counted))
-                attempts = attempts + 1
-                errors_counted = 0
-                try:
-                    print("begin connection attempt {}...".format(attempts))
-                    sta_if.connect(ssid, known_wifi_passwords[ssid])
-                except:
-                    print("WIFI CONNECT EXCEPTION - on attempt {}".format(attempts))
-            else:
-                errors_counted = errors_counted + 1
-
-        if attempts >= MAX_NETWORK_CONNECTION_ATTEMPTS_ALLOWED:
-            print("network connection attempt limit reached ({}). restarting system.".format(attempts))
-            sys.exit()
-
-        sweep_LEDs(7)
-
-    print("network connected!")
-    print('network configuration: ', sta_if.ifconfig())
-    print()
-    sweep_LEDs(1, False)
-
-    return sta_if
-
-def move_stepper(steps_to_move = 200, CW = True, delay = MIN_STEP_DELAY):
+        ntptime.settime()
+    except OSError as e:
+        print("clock sync failed: {e}\n".format(e=e))
+        return
+    clock_set = True
+    print("clock set from NTP: {t}\n".format(t=utime.localtime()))
+
+# sleeps until ticks_us reaches deadline, in ms while far enough away to let the other thread run
+def sleep_until_us(deadline):
+    wait = utime.ticks_diff(deadline, utime.ticks_us())
+    if wait >= 2000:
+        utime.sleep_ms(wait//1000 - 1)
+        wait = utime.ticks_diff(deadline, utime.ticks_us())
+    if wait > 0:
+        utime.sleep_us(wait)
+
+# steps at a fixed delay (ms), or along a MotionProfile if one is given;
+# steps are timed against deadlines, so the time spent driving the pins doesn't add up,
+# but a step that is already late restarts the timing instead of rushing the ones after it
+def move_stepper(steps_to_move = 200, CW = True, delay = MIN_STEP_DELAY, profile = None):
     global generate
     global stepper_state
-    global stepper_signals
+    deadline = utime.ticks_us()
     for step in range(steps_to_move):
         if generate is True:
             return False
@@ -281,11 +347,17 @@ def move_stepper(steps_to_move = 200, CW = True, delay = MIN_STEP_DELAY):
             stepper_state = (stepper_state - 1) if stepper_state > 1 else 4
         else:
             raise Exception("CW case error: {}".format(CW))
-        try:
-            send_stepper_signal(stepper_signals[stepper_state])
-        except:
-            raise Exception("stepper_state case error: {}".format(stepper_state))
-        utime.sleep_ms(delay)
+        stepper_output.phase(stepper_state - 1)
+        if step & 0xFF == 0xFF: # about once a second at cruise: a stroke mustn't hold up Wi-Fi
+            poll_wifi()
+        step_us = profile.delay_us(step, steps_to_move) if profile else delay*1000
+        deadline = utime.ticks_add(deadline, step_us)
+        now = utime.ticks_us()
+        if utime.ticks_diff(now, deadline) > 0: # stalled past it (kill switch, GC, Wi-Fi): time from this step, don't catch up
+            deadline = utime.ticks_add(now, step_us)
+        sleep_until_us(deadline)
+        if step_error_hist is not None:
+            step_error_hist.add(utime.ticks_diff(utime.ticks_us(), deadline))
 
     return True
 
@@ -325,21 +397,32 @@ def generate_handler(void):
 killswitch_button.irq(trigger = machine.Pin.IRQ_FALLING, handler = killswitch_handler)
 generate_button.irq(trigger = machine.Pin.IRQ_FALLING, handler = generate_handler)
 
+# start associating first, the radio gets on with it while everything else is set up;
+# the main loop polls wifi from here on, the Blynk thread connects once it is up
+wifi = WifiLink.WifiLink(network.WLAN(network.STA_IF), WIFI_NAME, known_wifi_passwords[WIFI_NAME],
+                         WIFI_BACKOFF_BASE*1000, WIFI_BACKOFF_MAX*1000, WIFI_ATTEMPT_TIMEOUT*1000)
+boot.start("wifi")
+wifi.poll()
+
 # set hardware to initial state
+boot.start("hardware")
 initialize_hardware()
-
-# connect to wifi
-sta_if = connect_to_WiFi_network(WIFI_NAME)
+boot.done("hardware")
 
 #########################################################################################
 #################################### SET UP BLYNK #######################################
 #########################################################################################
 
+# the connection is made by the Blynk thread once Wi-Fi is up, not here
 print("Initializing Blynk instance...")
-show_on_LEDs([1, 1, 1, 1])
-blynk_instance = BlynkLib.Blynk(BLYNK_AUTH_TOKEN, insecure = True)
-#blynk_instance = BlynkLib.Blynk(BLYNK_AUTH_TOKEN)
-show_on_LEDs([0, 0, 0, 0])
+blynk_instance = BlynkLib.Blynk(BLYNK_AUTH_TOKEN, insecure = True, buffout = BLYNK_TX_BUFFER, txq = BLYNK_TX_QUEUE, txq_policy = BlynkLib.TXQ_MERGE, autoconnect = False)
+#blynk_instance = BlynkLib.Blynk(BLYNK_AUTH_TOKEN, autoconnect = False)
+
+# power and energy pins only send changes beyond their deadband
+dashboard = Publisher.Publisher(blynk_instance.virtual_write)
+for vpin, deadband in ((POWER_VPIN, POWER_DEADBAND), (MAX_POWER_VPIN, POWER_DEADBAND),
+                       (TOTAL_ENERGY_GENERATED_VPIN, ENERGY_DEADBAND), (TOTAL_ENERGY_USED_VPIN, ENERGY_DEADBAND)):
+    dashboard.policy(vpin, deadband, PUBLISH_MIN_INTERVAL, PUBLISH_MAX_INTERVAL)
 
 # HANDLERS FOR DATA COMING FROM THE BLYNK DASHBOARD
 
@@ -350,91 +433,173 @@ def blynk_connected():
     global kill
     print("Blynk server connected!")
     print("Updating Blynk server...")
+    dashboard.refresh()
+    telemetry_log.rewind() # a batch sent before the disconnect may not have made it
     update_dashboard_power()
     blynk_instance.virtual_write(GENERATE_SWITCH_VPIN, 1 if generate is True else 0)
     blynk_instance.virtual_write(KILLSWITCH_VPIN, 1 if kill is True else 0)
+    if cycles.closed:
+        publish_cycle(cycles.last())
     print("Blynk server update complete. Starting system...\n")
+    if boot.done("blynk"):
+        print("boot:")
+        for line in boot.report():
+            print("  " + line)
+        print()
 
 # recieves killswitch commands from the dashboard
-@blynk_instance.on("V{}".format(KILLSWITCH_VPIN))
+@blynk_instance.on_virtual(KILLSWITCH_VPIN, parse=int)
 def v2_write_handler(value):
     global kill
     killswitch_pause()
-    if value[0] is "1":
+    if value == 1:
         kill = True
-    elif value[0] is "0":
+    elif value == 0:
         kill = False
     else:
-        raise Exception("kill case error on Blynk switch: {}".format(value[0]))
+        raise Exception("kill case error on Blynk switch: {}".format(value))
     handle_kill_state_change()
 
 # recieves generate switch commands from the dashboard
-@blynk_instance.on("V{}".format(GENERATE_SWITCH_VPIN))
+@blynk_instance.on_virtual(GENERATE_SWITCH_VPIN, parse=int)
 def v0_write_handler(value):
     global generate
     print("\ngenerate button pressed, switching modes...")
-    if value[0] is "0":
+    if value == 0:
         generate = False
-    elif value[0] is "1":
+    elif value == 1:
         generate = True
     else:
-        raise Exception("generate case error on Blynk switch: {}".format(value[0]))
+        raise Exception("generate case error on Blynk switch: {}".format(value))
     handle_generate_state_change()
 
+# replies to latency summary and Wi-Fi history requests from a terminal widget
+@blynk_instance.on_virtual(INSTRUMENT_VPIN, parse=str)
+def v7_write_handler(value):
+    if value == "boot":
+        for line in boot.report():
+            blynk_instance.virtual_write(INSTRUMENT_VPIN, line + "\n")
+    elif value == "wifi":
+        for line in wifi.status_history():
+            blynk_instance.virtual_write(INSTRUMENT_VPIN, line + "\n")
+    elif value == "cycles":
+        for line in report_cycles():
+            blynk_instance.virtual_write(INSTRUMENT_VPIN, line + "\n")
+    elif value == "reset":
+        Instrument.reset()
+        blynk_instance.virtual_write(INSTRUMENT_VPIN, "latency histograms reset\n")
+    elif not Instrument.enabled:
+        blynk_instance.virtual_write(INSTRUMENT_VPIN, "instrumentation off (INSTRUMENT = False)\n")
+    else:
+        for line in report_latency():
+            blynk_instance.virtual_write(INSTRUMENT_VPIN, line + "\n")
+
 # HANDLERS FOR DATA GOING TO THE BLYNK DASHBOARD
 
 # updates labels on the dashboard
 def update_dashboard_power():
 
-    global generate
-    global N_adc_samples
-    global adc_sums
     global adc_avgs
-    global adc_max
-    global energy_generated
 
-    if N_adc_samples is 0:
+    drain_adcs()
+    reading = signal_path.window()
+
+    if reading is None:
 
         print("ADC averaging incomplete - dashboard not updated\n")
 
     else:
 
-        adc_avgs = [sum/N_adc_samples for sum in adc_sums]
-        adc_sums = [0.0 for sum in adc_sums]
+        window = reading.window
+        adc_avgs = reading.adc_avgs
+        current = reading.current
+        voltage = reading.voltage
+        w = reading.max_power
+        energy = reading.energy
 
-        w = 0
-
-        if generate is True:
-
-            current = (3.3/(0.55*5))*adc_avgs[0]
-            voltage = 4*3.3*adc_avgs[1]
+        if reading.generating is True:
 
             print("GENERATOR:")
-
-            w = (3.3/(0.55*5))*4*3.3*adc_max
             print("max power generated: {p:.6f} W".format(p=w))
-
-            energy_generated = energy_generated + voltage*current*BLYNK_UPDATE_INTERVAL
-            print("total energy generated: {e:.6f} J".format(e=energy_generated))
-            blynk_instance.virtual_write(TOTAL_ENERGY_GENERATED_VPIN, energy_generated)
+            energy_vpin = TOTAL_ENERGY_GENERATED_VPIN
+            print("total energy generated: {e:.6f} J".format(e=energy))
 
         else:
 
-            current = (3.3/(0.5*5))*adc_avgs[0]
-            voltage = 4*3.3*adc_avgs[1]
-
             print("MOTOR:")
-
-            w = (3.3/(0.5*5))*4*3.3*adc_max
             print("max power used: {p:.6f} W".format(p=w))
+            energy_vpin = TOTAL_ENERGY_USED_VPIN
+            print("total energy used: {e:.6f} J".format(e=energy))
+
+        cycle = cycles.current(energy)
+        if cycle is not None and reading.generating is True and cycle[5] is not None:
+            print("cycle {n} efficiency so far: {r:.2f} %".format(n=cycle[0], r=cycle[5]))
 
         print("ADC0: {d:.6f}, voltage: {v:2.4f} V  ".format(d=adc_avgs[1], v=voltage))
         print("ADC1: {d:.6f}, current: {c:2.4f} mA".format(d=adc_avgs[0], c=current*1000))
-        print("{n} samples averaged\n" .format(n=N_adc_samples))
-
-        N_adc_samples = 0
-        blynk_instance.virtual_write(MAX_POWER_VPIN, w)
-        blynk_instance.virtual_write(POWER_VPIN, voltage*current)
+        for name, ch in (("ADC0", window.ch[1]), ("ADC1", window.ch[0])):
+            print("{name}: min {lo:.6f}, max {hi:.6f}, rms {rms:.6f}, std {std:.6f}".format(name=name,
+                lo=ch.min/ADC_FULL_SCALE, hi=ch.max/ADC_FULL_SCALE, rms=ch.rms()/ADC_FULL_SCALE, std=ch.std()/ADC_FULL_SCALE))
+        print("{n} samples averaged\n" .format(n=reading.n))
+        if adc_sampler.overruns:
+            print("{n} ADC samples lost to full blocks\n".format(n=adc_sampler.overruns))
+
+        tx = blynk_instance.tx_stats()
+        if tx['depth'] or tx['dropped']:
+            print("Blynk tx queue: {depth} writes / {bytes} B queued (peak {peak} B), {dropped} dropped, {merged} merged\n".format(**tx))
+
+        if blynk_instance.state == BlynkLib.CONNECTED:
+            dashboard.publish(energy_vpin, energy)
+            dashboard.publish(MAX_POWER_VPIN, w)
+            dashboard.publish(POWER_VPIN, reading.power)
+        elif telemetry_log.append(utime.time() if clock_set else 0, 0 if reading.generating is True else 1, reading.power, w, energy):
+            print("Blynk offline - logged telemetry record {n} ({p} to replay)\n".format(n=telemetry_log.next_seq - 1, p=telemetry_log.pending()))
+
+update_dashboard_power = Instrument.wrap(update_dashboard_power, "dashboard update", 500)
+
+# prints the latency summary, returns its lines
+def report_latency():
+    lines = Instrument.summary()
+    print("latency:")
+    for line in lines:
+        print("  " + line)
+    print()
+    return lines
+
+# prints the cycle history, returns its lines
+def report_cycles():
+    lines = cycles.report(signal_path.energy())
+    print("cycles:")
+    for line in lines:
+        print("  " + line)
+    print()
+    return lines
+
+# sends one closed cycle to the dashboard
+def publish_cycle(cycle):
+    n, e_in, e_out, secs, peak, eff = cycle
+    if blynk_instance.state == BlynkLib.CONNECTED:
+        blynk_instance.virtual_write(CYCLE_VPIN, n, e_in, e_out, 0 if eff is None else eff, secs, peak)
+
+# sends a batch of the telemetry logged while offline, once the last one has left the tx queue;
+# a batch is confirmed only if the queue dropped or merged nothing meanwhile, else it goes again
+def replay_telemetry():
+    global replay_losses
+    if blynk_instance.state != BlynkLib.CONNECTED or not telemetry_log.pending():
+        return
+    tx = blynk_instance.tx_stats()
+    if tx['depth']:
+        return
+    losses = tx['dropped'] + tx['merged']
+    if telemetry_log.unconfirmed():
+        if losses == replay_losses:
+            telemetry_log.confirm()
+        else:
+            telemetry_log.rewind()
+    replay_losses = losses
+    sent = telemetry_log.replay(lambda *record: blynk_instance.virtual_write(TELEMETRY_REPLAY_VPIN, *record), TELEMETRY_REPLAY_BATCH)
+    if sent:
+        print("replayed {n} telemetry records, {p} left\n".format(n=sent, p=telemetry_log.pending()))
 
 # sets up the system after a kill command is recieved / created
 def handle_kill_state_change():
@@ -442,8 +607,9 @@ def handle_kill_state_change():
     global kill
     global generate
     global was_generating
+    global switches_changed
 
-    blynk_instance.virtual_write(KILLSWITCH_VPIN, 1 if kill is True else 0)
+    switches_changed = True # the button IRQs run this on core 0, the Blynk thread sends it
 
     if kill is True:
 
@@ -463,12 +629,9 @@ def handle_generate_state_change():
 
     global generate
     global was_generating
-    global N_adc_samples
-    global adc_sums
-    global adc_max
-    global energy_generated
+    global switches_changed
 
-    blynk_instance.virtual_write(GENERATE_SWITCH_VPIN, 1 if generate is True else 0)
+    switches_changed = True # the button IRQs run this on core 0, the Blynk thread sends it
 
     if generate is False:
 
@@ -490,37 +653,36 @@ def handle_generate_state_change():
 
         print()
 
-    adc_sums[0] = 0
-    adc_sums[1] = 0
-    N_adc_samples = 0
-    adc_max = 0
-    energy_generated = 0
-
-# samples and sums ADC values for later averaging
-def sample_adcs(void):
-
-    global adc_sums
-    global N_adc_samples
-    global adc_max
-
-    try:
-
-        a0 = adc0.read_u16()/65535
-        a1 = adc1.read_u16()/65535
-
-        adc_sums[0] = adc_sums[0] + a0
-        adc_sums[1] = adc_sums[1] + a1
-
-        p = a0 * a1
-
-    except:
-
-        raise Exception("ADC error")
-
-    if p > adc_max:
-        adc_max = p
-
-    N_adc_samples = N_adc_samples + 1
+    # samples up to here belong to the old mode; the statistics are only
+    # touched by the thread that drains, so it resets them before the next drain
+    global adc_mode_changed
+    adc_sampler.discard()
+    adc_mode_changed = True
+
+# Blynk thread: sends the switch states after a change, the only thread that writes to blynk_instance
+def send_switches():
+    global switches_changed
+    if not switches_changed:
+        return
+    switches_changed = False
+    if blynk_instance.state == BlynkLib.CONNECTED:
+        blynk_instance.virtual_write(GENERATE_SWITCH_VPIN, 1 if generate is True else 0)
+        blynk_instance.virtual_write(KILLSWITCH_VPIN, 1 if kill is True else 0)
+
+# moves pending ADC samples into signal_path, starting a new phase first if the mode changed
+def drain_adcs():
+    global adc_mode_changed
+    if adc_mode_changed:
+        adc_mode_changed = False
+        if adc_jitter is not None:
+            adc_jitter.gap()
+        if signal_path.mode(generate is True):
+            report_cycles()
+            publish_cycle(cycles.last())
+    if adc_jitter is not None:
+        adc_sampler.drain(signal_path, adc_jitter)
+    else:
+        adc_sampler.drain(signal_path)
 
 #########################################################################################
 ############################## DEFINE AND START THREAD 2 ################################
@@ -531,13 +693,24 @@ def second_thread(bi, j):
     # SET UP BLYNK TIMER FOR PERIODIC EXECUTIONS
     blynk_update_timer = BlynkTimer.BlynkTimer()
     blynk_update_timer.set_interval(BLYNK_UPDATE_INTERVAL, update_dashboard_power)
+    blynk_update_timer.set_interval(ADC_DRAIN_INTERVAL, drain_adcs) # keep the sample ring short
+    blynk_update_timer.set_interval(ADC_DRAIN_INTERVAL, send_switches)
+    blynk_update_timer.set_interval(TELEMETRY_REPLAY_INTERVAL, replay_telemetry)
+    if Instrument.enabled and INSTRUMENT_REPORT_INTERVAL:
+        blynk_update_timer.set_interval(INSTRUMENT_REPORT_INTERVAL, report_latency)
+
+    # keep draining the ADCs while the main loop brings Wi-Fi up
+    while not wifi.isconnected():
+        blynk_update_timer.run()
+        wait = blynk_update_timer.time_until_next()
+        utime.sleep_ms(50 if wait is None else min(wait, 50))
 
-    # SET UP HARDWARE TIMER TO SAMPLE ADCS PERIODICALLY
-    ADC_timer = machine.Timer(period = ADC_UPDATE_INTERVAL, mode = machine.Timer.PERIODIC, callback = sample_adcs)
+    # sleeps in poll() until the socket or the next timer needs attention, connects first
+    boot.start("blynk")
+    bi.run_forever(blynk_update_timer)
 
-    while True:
-        bi.run()
-        blynk_update_timer.run()
+# SET UP HARDWARE TIMER TO SAMPLE ADCS PERIODICALLY
+adc_sampler.start(ADC_SAMPLE_RATE)
 
 _thread.start_new_thread(second_thread, (blynk_instance, 1))
 
@@ -545,11 +718,13 @@ _thread.start_new_thread(second_thread, (blynk_instance, 1))
 ###################################### MAIN LOOP ########################################
 #########################################################################################
 
+boot.mark("generating")
+
 while True:
 
-    # make sure Pico is connected to the internet
-    if not sta_if.isconnected():
-        sta_if = connect_to_WiFi_network(WIFI_NAME)
+    # keeps the Wi-Fi link up without stopping the stepper, Blynk reconnects on its own
+    poll_wifi()
+    sync_clock()
 
     if kill is True:
 
@@ -563,6 +738,9 @@ while True:
             calibrate_stepper()
 
             # store a bunch of power and wait for the generate signal
-            move_stepper(STEPS_TO_BOTTOM, SPIN_CW, MIN_STEP_DELAY)
+            print("stroke: {n} steps, about {t:.1f} s\n".format(n=STEPS_TO_BOTTOM, t=stroke_profile.duration_us(STEPS_TO_BOTTOM)/1000000))
+            stroke_start = utime.ticks_ms()
+            if move_stepper(STEPS_TO_BOTTOM, SPIN_CW, profile = stroke_profile):
+                print("stroke done in {t:.1f} s\n".format(t=utime.ticks_diff(utime.ticks_ms(), stroke_start)/1000))
 
             was_generating = False
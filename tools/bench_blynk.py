@@ -0,0 +1,283 @@
+"""
+    bench_blynk
+    protocol micro-benchmarks for BlynkLib
+
+    Drives BlynkProtocol through an in-memory loopback
+    transport and measures:
+
+        - virtual_write encode rate for several argument counts,
+          unbuffered and through the buffout coalescing buffer,
+          float and int values
+        - inbound HW frame decode rate for several read sizes,
+          and through typed per-pin handlers with few and many pins
+        - mixed PING/RSP traffic (inbound pings are answered)
+        - memory allocated per message
+
+    Results are printed and written as JSON, so two runs can
+    be compared case by case. Runs on CPython and MicroPython:
+
+        python3 tools/bench_blynk.py [-o FILE] [--baseline FILE] [--quick]
+        micropython tools/bench_blynk.py
+
+    Allocation figures are bytes per message: gc.mem_alloc()
+    growth with the collector off on MicroPython, and the
+    tracemalloc peak above the resting level on CPython (which
+    frees on refcount, so only the transient peak is visible).
+    Compare them within one platform only.
+
+"""
+
+import gc
+import json
+import struct
+import sys
+
+# no os.path on MicroPython
+sys.path.insert(0, (__file__.rsplit('/', 1)[0] if '/' in __file__ else '.') + '/../load-to-pico')
+
+import BlynkLib
+
+from Ticks import ticks_us, ticks_diff
+
+DEFAULT_OUTPUT = 'bench_blynk.json'
+REGRESSION = 0.10   # --baseline flags cases this much slower
+
+
+class LoopbackBlynk(BlynkLib.BlynkProtocol):
+    '''BlynkProtocol with the socket replaced by an in-memory sink
+
+    With a peer, everything written is handed to peer.process(),
+    so encode and decode can be checked against each other.
+    '''
+
+    def __init__(self, auth='bench', peer=None, **kwargs):
+        self.sent = 0
+        self.writes = 0
+        self.peer = None
+        BlynkLib.BlynkProtocol.__init__(self, auth, **kwargs)
+        self.state = BlynkLib.CONNECTED
+        self.peer = peer    # after the login frame, which has no place in the stream
+
+    def _write(self, data):
+        self.sent += len(data)
+        self.writes += 1
+        if self.peer is not None:
+            self.peer.lastRecv = BlynkLib.gettime()
+            self.peer.process(bytes(data))
+
+
+def frame(cmd, msg_id, *args):
+    '''Encodes one frame the way the server does'''
+    data = '\0'.join(map(str, args)).encode('utf8')
+    return struct.pack("!BHH", cmd, msg_id, len(data)) + data
+
+
+def rsp(msg_id, status=BlynkLib.STA_SUCCESS):
+    '''Encodes a response, its status travels in the length field'''
+    return struct.pack("!BHH", BlynkLib.MSG_RSP, msg_id, status)
+
+
+def chunked(stream, size):
+    '''Splits a byte stream into conn.read sized pieces'''
+    return [stream[i:i+size] for i in range(0, len(stream), size)]
+
+
+def alloc_per_call(op, calls):
+    '''Bytes allocated by one op() call, averaged over calls'''
+    if hasattr(gc, 'mem_alloc'):
+        gc.collect()
+        gc.disable()
+        try:
+            before = gc.mem_alloc()
+            for _ in range(calls):
+                op()
+            return (gc.mem_alloc() - before) / calls
+        finally:
+            gc.enable()
+    import tracemalloc
+    tracemalloc.start()
+    try:
+        total = 0
+        for _ in range(calls):
+            tracemalloc.reset_peak()
+            resting = tracemalloc.get_traced_memory()[0]
+            op()
+            total += tracemalloc.get_traced_memory()[1] - resting
+        return total / calls
+    finally:
+        tracemalloc.stop()
+
+
+def measure(name, op, msgs, min_us):
+    '''Calls op() until min_us have passed, returns a result record
+
+    msgs is the number of messages one op() call handles.
+    '''
+    op()    # warm up: first-call allocations are not steady state
+    calls = 0
+    gc.collect()
+    start = ticks_us()
+    while True:
+        op()
+        calls += 1
+        elapsed = ticks_diff(ticks_us(), start)
+        if elapsed >= min_us:
+            break
+    rate = calls * msgs * 1000000 / elapsed
+    alloc = alloc_per_call(op, min(calls, 200)) / msgs
+    print("{:<32} {:>10.0f} msg/s {:>8.1f} B/msg".format(name, rate, alloc))
+    return {'rate': rate, 'alloc': alloc, 'msgs': calls * msgs, 'us': elapsed}
+
+
+# -- cases -------------------------------------------------------------------
+
+def tx_case(nargs, buffout=0, ints=False):
+    '''virtual_write with nargs float (or int) values'''
+    blynk = LoopbackBlynk(buffout=buffout)
+    args = [1000 + i for i in range(nargs)] if ints else [1.5 + i for i in range(nargs)]
+
+    def op():
+        for pin in range(8):
+            blynk.virtual_write(pin, *args)
+    return op, 8
+
+
+def rx_case(frames, chunk):
+    '''the same inbound traffic read chunk bytes at a time'''
+    blynk = LoopbackBlynk()
+    hits = [0]
+
+    @blynk.on("V*")
+    def count(pin, value):
+        hits[0] += 1
+
+    reads = chunked(b''.join(frames), chunk)
+
+    def op():
+        blynk.lastRecv = BlynkLib.gettime()
+        for data in reads:
+            blynk.process(data)
+    return op, len(frames)
+
+
+def rx_pin_case(frames, pins, parse):
+    '''inbound HW frames to typed per-pin handlers, pins of them registered'''
+    blynk = LoopbackBlynk()
+    hits = [0]
+
+    def count(value):
+        hits[0] += 1
+
+    for pin in range(pins):
+        blynk.on_virtual(pin, count, parse)
+    reads = chunked(b''.join(frames), 1024)
+
+    def op():
+        blynk.lastRecv = BlynkLib.gettime()
+        for data in reads:
+            blynk.process(data)
+    return op, len(frames)
+
+
+def check_loopback():
+    '''Encodes with one instance and decodes with another'''
+    rx = LoopbackBlynk()
+    tx = LoopbackBlynk(peer=rx, buffout=256)
+    got = []
+
+    @rx.on("V*")
+    def collect(pin, value):
+        got.append((int(pin), value))
+
+    for n in range(1, 9):
+        tx.virtual_write(n, *range(n))
+    tx.flush()
+    want = [(n, [str(i) for i in range(n)]) for n in range(1, 9)]
+    assert got == want, "loopback mismatch: {}".format(got)
+
+
+def cases():
+    hw = [frame(BlynkLib.MSG_HW, i + 1, 'vw', i % 8, i) for i in range(100)]
+    wide = [frame(BlynkLib.MSG_HW, i + 1, 'vw', i * 37 % 256, i) for i in range(100)]
+    ping = [frame(BlynkLib.MSG_PING, i + 1) for i in range(100)]
+    ok = [rsp(i + 1) for i in range(100)]
+    mixed = [f for trio in zip(hw, ping, ok) for f in trio]
+    return [
+        ("tx vw 1 arg", lambda: tx_case(1)),
+        ("tx vw 2 args", lambda: tx_case(2)),
+        ("tx vw 4 args", lambda: tx_case(4)),
+        ("tx vw 8 args", lambda: tx_case(8)),
+        ("tx vw 2 args, buffout 1024", lambda: tx_case(2, buffout=1024)),
+        ("tx vw 2 int args", lambda: tx_case(2, ints=True)),
+        ("rx hw vw, 1024 B reads", lambda: rx_case(hw, 1024)),
+        ("rx hw vw, 7 B reads", lambda: rx_case(hw, 7)),
+        ("rx hw vw, 64 KiB reads", lambda: rx_case(hw * 40, 65536)),
+        ("rx vw int handler, 8 pins", lambda: rx_pin_case(hw, 8, int)),
+        ("rx vw int handler, 256 pins", lambda: rx_pin_case(wide, 256, int)),
+        ("rx vw list handler, 8 pins", lambda: rx_pin_case(hw, 8, None)),
+        ("rx ping (answered)", lambda: rx_case(ping, 1024)),
+        ("rx rsp", lambda: rx_case(ok, 1024)),
+        ("rx hw + ping + rsp", lambda: rx_case(mixed, 1024)),
+    ]
+
+
+def compare(results, path):
+    '''Prints the rate change of every case against an earlier run'''
+    with open(path) as f:
+        old = json.load(f)['results']
+    slower = 0
+    print()
+    print("against", path)
+    for name in results:
+        if name not in old:
+            continue
+        change = results[name]['rate'] / old[name]['rate'] - 1
+        flag = ''
+        if change < -REGRESSION:
+            flag = '  <-- slower'
+            slower += 1
+        print("{:<32} {:>+7.1f}% rate {:>+8.1f} B/msg{}".format(
+            name, change * 100, results[name]['alloc'] - old[name]['alloc'], flag))
+    return slower
+
+
+def main(argv):
+    output = DEFAULT_OUTPUT
+    baseline = None
+    min_us = 1000000
+    i = 0
+    while i < len(argv):
+        if argv[i] == '-o':
+            i += 1
+            output = argv[i]
+        elif argv[i] == '--baseline':
+            i += 1
+            baseline = argv[i]
+        elif argv[i] == '--quick':
+            min_us = 100000
+        else:
+            print("usage: bench_blynk.py [-o FILE] [--baseline FILE] [--quick]")
+            return 2
+        i += 1
+
+    check_loopback()
+    results = {}
+    for name, setup in cases():
+        op, msgs = setup()
+        results[name] = measure(name, op, msgs, min_us)
+
+    with open(output, 'w') as f:
+        json.dump({
+            'blynklib': BlynkLib.__version__,
+            'implementation': sys.implementation.name,
+            'platform': sys.platform,
+            'results': results,
+        }, f)
+    print("results written to", output)
+    if baseline and compare(results, baseline):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,76 @@
+"""
+    bench_stats
+    throughput benchmark for StreamStats
+
+    Pushes synthetic ADC sample pairs through StreamStats
+    the way the Blynk thread does (ring runs of a few ms
+    of samples) and reports how many samples per second
+    one core can absorb against the sample rates we want
+    to run at. Runs on CPython and MicroPython:
+
+        python3 tools/bench_stats.py
+        micropython tools/bench_stats.py
+
+"""
+
+import sys
+
+# no os.path on MicroPython
+sys.path.insert(0, (__file__.rsplit('/', 1)[0] if '/' in __file__ else '.') + '/../load-to-pico')
+
+from array import array
+
+import StreamStats
+
+from Ticks import ticks_us, ticks_diff
+
+SAMPLE_RATES = (1000, 5000, 20000)  # Hz
+
+
+def samples(n):
+    '''interleaved (adc0, adc1) pairs with some ripple'''
+    buf = array('H', (0 for _ in range(2 * n)))
+    for i in range(n):
+        buf[2 * i] = 20000 + (i * 7919) % 4000
+        buf[2 * i + 1] = 40000 + (i * 104729) % 6000
+    return buf
+
+
+def bench(name, run, n):
+    t0 = ticks_us()
+    run()
+    us = ticks_diff(ticks_us(), t0)
+    rate = n * 1000000 / us
+    load = " ".join("{}Hz:{:.1f}%".format(hz, 100 * hz / rate) for hz in SAMPLE_RATES)
+    print("{:<26} {:>10.0f} samples/s   core load {}".format(name, rate, load))
+
+
+def main():
+    n = 20000
+    run = 10    # samples per drain at 1 kHz and a 10 ms poll
+    buf = samples(n)
+    stats = StreamStats.StreamStats()
+
+    def pairs():
+        for start in range(0, 2 * n, 2 * run):
+            stats.add_pairs(buf, None, start, start + 2 * run)
+
+    def single():
+        for i in range(0, 2 * n, 2):
+            stats.add(buf[i], buf[i + 1])
+
+    def snapshots():
+        for start in range(0, 2 * n, 2 * run):
+            stats.add_pairs(buf, None, start, start + 2 * run)
+            stats.snapshot()
+
+    bench("add_pairs, 10 per run", pairs, n)
+    bench("add, one pair per call", single, n)
+    bench("add_pairs + snapshot", snapshots, n)
+    w = stats.total
+    print("lifetime: n={} mean0={:.1f} std0={:.1f} rms1={:.1f} peak={}".format(
+        w.n, w.ch[0].mean, w.ch[0].std(), w.ch[1].rms(), w.peak_power))
+
+
+if __name__ == '__main__':
+    main()
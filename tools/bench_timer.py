@@ -0,0 +1,101 @@
+"""
+    bench_timer
+    stress benchmark for BlynkTimer
+
+    Creates and cancels thousands of short-lived timeouts
+    the way debouncing and retry code does, checks that no
+    id is ever handed out twice while in use and reports
+    operations per second. Also checks that a callback which
+    cancels most of the pending timers (compacting the heap
+    while run() walks it) runs nothing twice. Runs on CPython:
+
+        python3 tools/bench_timer.py
+
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'load-to-pico'))
+
+import BlynkTimer
+
+
+def churn(n, live=64, seed=1):
+    '''Keeps about `live` timeouts pending while creating n in total'''
+    rnd = random.Random(seed)
+    timer = BlynkTimer.BlynkTimer()
+    pending = {}
+    fired = [0]
+
+    def make(tag):
+        def f():
+            fired[0] += 1
+            del pending[tag[0]]
+        return f
+
+    start = time.perf_counter()
+    for k in range(n):
+        tag = [None]
+        tid = timer.set_timeout(rnd.randint(1, 20) / 1000, make(tag))
+        assert tid not in pending, "id {} handed out while in use".format(tid)
+        tag[0] = tid
+        pending[tid] = tag
+        if len(pending) > live:
+            victim = rnd.choice(list(pending))
+            timer.cancel(victim)
+            del pending[victim]
+        if k % 16 == 0:
+            timer.run()
+    while pending:
+        timer.run()
+        time.sleep((timer.time_until_next() or 0) / 1000)
+    elapsed = time.perf_counter() - start
+    used, slots = timer.get_num_timers()
+    assert used == 0, "{} timers leaked".format(used)
+    print("{:>7} timeouts, {:>4} live: {:>9.0f} ops/s, {} fired, {} slots".format(
+        n, live, n / elapsed, fired[0], slots))
+
+
+def cancel_in_callback(victims=20, seconds=1.0):
+    '''A callback cancels victims pending timeouts while run() is iterating'''
+    timer = BlynkTimer.BlynkTimer()
+    ids = [timer.set_timeout(60, lambda: None) for _ in range(victims)]
+    counts = {'once': 0, 'tick': 0}
+
+    def cancel_all():
+        for tid in ids:
+            timer.cancel(tid)
+
+    def once():
+        counts['once'] += 1
+
+    def tick():
+        counts['tick'] += 1
+
+    timer.set_timeout(0.001, cancel_all)
+    timer.set_timeout(0.002, once)
+    timer.set_interval(0.05, tick)
+    time.sleep(0.005)
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        timer.run()
+        time.sleep((timer.time_until_next() or 0) / 1000)
+    expected = int(seconds / 0.05)
+    print("cancel in callback: timeout fired {} times, 50 ms interval {} times in {:.0f} s".format(
+        counts['once'], counts['tick'], seconds))
+    assert counts['once'] == 1, "timeout fired {} times".format(counts['once'])
+    assert counts['tick'] <= expected + 1, "interval fired {} times, expected about {}".format(counts['tick'], expected)
+
+
+def main():
+    cancel_in_callback()
+    churn(2000)
+    churn(10000)
+    churn(10000, live=1000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,474 @@
+"""
+    blynk_gateway
+    multiplexes many BlynkLib devices over a few upstream connections
+
+    Local storage units connect to the gateway exactly as they
+    would to the Blynk server (insecure=True, server=<gateway>,
+    port=8080). The gateway answers their logins and pings
+    itself and carries their traffic over a small pool of
+    upstream connections, one per stride-wide block of pins:
+
+        device in slot k of a link, pin p  <->  upstream pin k*stride + p
+
+    so one upstream device (one token, one TLS session, one
+    heartbeat) stands for 256/stride units. Dashboard writes to
+    upstream pin k*stride + p come back down as writes to V<p>
+    of the device in slot k. Pins at or past the stride are
+    refused, so the stride must cover every pin the firmware
+    uses: V0-V8 (main.py's *_VPIN), hence the default of 16,
+    16 units per upstream device.
+
+    Device tokens are mapped to slots with --device TOKEN=SLOT
+    (global slot s is slot s % (256/stride) of link s // (256/stride));
+    without any --device, every token is accepted and given the
+    next free slot, freed again when it disconnects. Writes
+    from all devices of a link are coalesced into one socket
+    write per --batch-ms window by the link's BlynkProtocol
+    buffout buffer. While a link is down its devices are turned
+    away, so they keep their own offline logs.
+
+        python3 tools/blynk_gateway.py --upstream blynk.cloud:443 \\
+            --upstream-token TOKEN_A --upstream-token TOKEN_B \\
+            --device UNIT1=0 --device UNIT2=1
+        python3 tools/blynk_gateway.py --soak 1000 --seconds 30
+
+    --soak N runs a self test: a local blynk_server.py upstream,
+    the gateway in front of it and N soak clients behind it,
+    with a dashboard write to every slot half way through.
+
+"""
+
+import argparse
+import asyncio
+import os
+import ssl
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'load-to-pico'))
+
+import BlynkLib
+from blynk_server import BlynkServer, Fleet, frame, raise_fd_limit
+
+MSG_RSP = BlynkLib.MSG_RSP
+MSG_LOGIN = BlynkLib.MSG_LOGIN
+MSG_PING = BlynkLib.MSG_PING
+MSG_HW = BlynkLib.MSG_HW
+MSG_HW_SYNC = BlynkLib.MSG_HW_SYNC
+MSG_INTERNAL = BlynkLib.MSG_INTERNAL
+MSG_PROPERTY = BlynkLib.MSG_PROPERTY
+MSG_HW_LOGIN = BlynkLib.MSG_HW_LOGIN
+STA_SUCCESS = BlynkLib.STA_SUCCESS
+STA_INVALID_TOKEN = BlynkLib.STA_INVALID_TOKEN
+STA_NOT_ALLOWED = 6     # upstream link down, try again later
+
+PINS = 256              # virtual pins of one upstream device
+
+
+class DeviceSession(asyncio.Protocol):
+    '''Gateway end of one local device connection'''
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+        self.transport = None
+        self.token = None
+        self.slot = None
+        self.link = None
+        self.base = 0           # upstream pin of this device's V0
+        self.heartbeat = 50
+        self.last_rx = 0.0
+        self._rx = bytearray()
+        self._msg_id = 1
+        self.frames_in = self.writes_in = self.writes_out = 0
+        self.pings = 0          # answered here, never forwarded
+        self.refused = 0        # frames with nowhere to go
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.last_rx = time.monotonic()
+        self.gateway.sessions.add(self)
+
+    def data_received(self, data):
+        self.last_rx = time.monotonic()
+        self._rx.extend(data)
+        while len(self._rx) >= 5:
+            cmd, msg_id, dlen = struct.unpack_from("!BHH", self._rx)
+            size = 5 if cmd == MSG_RSP else 5 + dlen
+            if len(self._rx) < size:
+                break
+            payload = bytes(self._rx[5:size])
+            del self._rx[:size]
+            self.frames_in += 1
+            self.handle(cmd, msg_id, payload)
+            if self.transport is None or self.transport.is_closing():
+                break
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self.gateway.sessions.discard(self)
+        self.gateway.detach(self)
+
+    def respond(self, msg_id, status):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.write(struct.pack("!BHH", MSG_RSP, msg_id, status))
+
+    def close(self):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.close()
+
+    def handle(self, cmd, msg_id, payload):
+        if cmd in (MSG_LOGIN, MSG_HW_LOGIN):
+            return self.login(msg_id, payload.decode('utf8', 'replace'))
+        if self.link is None:
+            return self.close()
+        if cmd == MSG_PING:
+            self.pings += 1
+            self.respond(msg_id, STA_SUCCESS)
+            return
+        if cmd == MSG_RSP:
+            return
+        args = payload.split(b'\0')
+        if cmd == MSG_HW and args[0] == b'vw' and len(args) > 1:
+            pin = self.pin(args[1])
+            if pin is not None:
+                self.writes_in += 1
+                self.link.virtual_write(self.base + pin, *args[2:])
+                return
+        elif cmd == MSG_HW_SYNC and args[0] == b'vr':
+            pins = [self.pin(p) for p in args[1:]]
+            if None not in pins:
+                self.link.sync_virtual(*[self.base + p for p in pins])
+                return
+        elif cmd == MSG_PROPERTY and len(args) > 2:
+            pin = self.pin(args[0])
+            if pin is not None:
+                self.link.set_property(self.base + pin, *args[1:])
+                return
+        elif cmd == MSG_INTERNAL:
+            info = payload.decode('utf8', 'replace').split('\0')
+            info = dict(zip(info[0::2], info[1::2]))
+            try:
+                self.heartbeat = int(info.get('h-beat', self.heartbeat))
+            except ValueError:
+                pass
+            return
+        # malformed or out of range: counted, the session stays up
+        self.refused += 1
+
+    def pin(self, field):
+        '''Local pin number of a frame field, None if it isn't one of ours'''
+        try:
+            pin = int(field)
+        except ValueError:
+            return None
+        return pin if 0 <= pin < self.gateway.stride else None
+
+    def login(self, msg_id, token):
+        slot = self.gateway.assign(token)
+        if slot is None:
+            self.respond(msg_id, STA_INVALID_TOKEN)
+            return self.close()
+        link = self.gateway.link_for(slot)
+        if link.state != BlynkLib.CONNECTED:
+            self.gateway.release(token)
+            self.respond(msg_id, STA_NOT_ALLOWED)
+            return self.close()
+        self.token = token
+        self.slot = slot
+        self.link = link
+        self.base = (slot % self.gateway.slots_per_link) * self.gateway.stride
+        self.gateway.attach(self)
+        self.respond(msg_id, STA_SUCCESS)
+
+    def write(self, pin, values):
+        '''Dashboard write to V<pin> of this device'''
+        if self.transport is None or self.transport.is_closing():
+            return
+        self.transport.write(frame(MSG_HW, self._msg_id, 'vw', pin, *values))
+        self._msg_id = self._msg_id % 0xFFFF + 1
+        self.writes_out += 1
+
+
+class UpstreamLink(BlynkLib.BlynkProtocol, asyncio.Protocol):
+    '''One upstream device connection carrying up to slots_per_link local devices'''
+
+    def __init__(self, gateway, index, token):
+        self.gateway = gateway
+        self.index = index
+        self.server = gateway.host
+        self.port = gateway.port
+        self.transport = None
+        self.devices = {}       # slot within this link -> DeviceSession
+        self.connects = 0
+        self.socket_writes = 0
+        self.bytes_out = 0
+        self._opening = False
+        BlynkLib.BlynkProtocol.__init__(self, token, heartbeat=gateway.heartbeat,
+                                        buffout=gateway.buffout, flush_ms=gateway.batch_ms)
+        self.on('V*', self._dashboard)
+        self.on('redirect', self._redirect)
+        self.on('connected', lambda **kw: print("upstream {}: connected to {}:{}".format(
+            self.index, self.server, self.port)))
+
+    def _dashboard(self, pin, values):
+        try:
+            pin = int(pin)
+        except ValueError:
+            return
+        device = self.devices.get(pin // self.gateway.stride)
+        if device is not None:
+            device.write(pin % self.gateway.stride, values)
+
+    def _redirect(self, server, port):
+        self.server = server
+        self.port = port
+        self.disconnect()
+
+    def connect(self):
+        # BlynkProtocol.connect() runs once the transport is up
+        if self.transport is None and not self._opening and not self.gateway.stopping:
+            self._opening = True
+            asyncio.ensure_future(self._open())
+
+    async def _open(self):
+        loop = asyncio.get_running_loop()
+        try:
+            if self.gateway.ssl:
+                await loop.create_connection(lambda: self, self.server, self.port,
+                                             ssl=ssl.create_default_context(), server_hostname=self.server)
+            else:
+                await loop.create_connection(lambda: self, self.server, self.port)
+        except OSError as e:
+            print("upstream {}: connect to {}:{} failed: {}".format(self.index, self.server, self.port, e))
+            self._opening = False
+            loop.call_later(self.gateway.reconnect_s, self.connect)
+
+    def disconnect(self):
+        BlynkLib.BlynkProtocol.disconnect(self)
+        if self.transport is not None:
+            self.transport.close()
+
+    def _write(self, data):
+        if self.transport is not None:
+            self.transport.write(bytes(data))
+            self.socket_writes += 1
+            self.bytes_out += len(data)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self._opening = False
+        self.connects += 1
+        BlynkLib.BlynkProtocol.connect(self)
+
+    def data_received(self, data):
+        self.process(data)
+
+    def connection_lost(self, exc):
+        self.transport = None
+        BlynkLib.BlynkProtocol.disconnect(self)
+        # its devices fall back to their own offline handling until it is back
+        for device in list(self.devices.values()):
+            device.close()
+        if not self.gateway.stopping:
+            print("upstream {}: connection lost, reconnecting in {} s".format(self.index, self.gateway.reconnect_s))
+            asyncio.get_running_loop().call_later(self.gateway.reconnect_s, self.connect)
+
+
+class Gateway:
+    '''Local device server in front of a pool of UpstreamLinks'''
+
+    def __init__(self, host, port, tokens, devices=None, stride=16, batch_ms=50,
+                 buffout=1024, heartbeat=50, use_ssl=True, reconnect_s=5.0):
+        if PINS % stride:
+            raise ValueError("stride must divide {}".format(PINS))
+        self.host = host
+        self.port = port
+        self.stride = stride
+        self.slots_per_link = PINS // stride
+        self.batch_ms = batch_ms
+        self.buffout = buffout
+        self.heartbeat = heartbeat
+        self.ssl = use_ssl
+        self.reconnect_s = reconnect_s
+        self.tokens = tokens
+        self.slots = dict(devices or {})    # device token -> global slot
+        self.fixed = bool(devices)          # only the mapped tokens get in
+        self.links = []
+        self.sessions = set()
+        self.stopping = False
+        self._server = None
+        self._tasks = []
+
+    def assign(self, token):
+        '''Global slot of token, None if it isn't let in'''
+        slot = self.slots.get(token)
+        if slot is None and not self.fixed:
+            used = set(self.slots.values())
+            slot = next(s for s in range(len(used) + 1) if s not in used)
+            self.slots[token] = slot
+        if slot is None or slot >= len(self.tokens) * self.slots_per_link:
+            self.release(token)
+            return None
+        return slot
+
+    def release(self, token):
+        '''Frees the slot given to token by assign() while no device holds it'''
+        slot = self.slots.get(token)
+        if self.fixed or slot is None:
+            return
+        if slot < len(self.links) * self.slots_per_link and \
+                self.link_for(slot).devices.get(slot % self.slots_per_link) is not None:
+            return
+        del self.slots[token]
+
+    def link_for(self, slot):
+        return self.links[slot // self.slots_per_link]
+
+    def attach(self, device):
+        local = device.slot % self.slots_per_link
+        old = device.link.devices.get(local)
+        if old is not None and old is not device:
+            old.close()     # the same unit logging in again
+        device.link.devices[local] = device
+
+    def detach(self, device):
+        if device.link is not None and device.link.devices.get(device.slot % self.slots_per_link) is device:
+            del device.link.devices[device.slot % self.slots_per_link]
+            self.release(device.token)
+
+    async def start(self, listen_host, listen_port):
+        loop = asyncio.get_running_loop()
+        self.links = [UpstreamLink(self, i, token) for i, token in enumerate(self.tokens)]
+        self._server = await loop.create_server(lambda: DeviceSession(self), listen_host, listen_port, backlog=4096)
+        self._tasks.append(asyncio.ensure_future(self._service()))
+
+    async def stop(self):
+        self.stopping = True
+        for task in self._tasks:
+            task.cancel()
+        self._server.close()
+        await self._server.wait_closed()
+        for s in list(self.sessions):
+            s.close()
+        for link in self.links:
+            link.flush()
+            link.disconnect()
+
+    async def _service(self):
+        '''Flushes batches and keeps the upstream links alive, drops silent devices'''
+        last_check = time.monotonic()
+        while True:
+            await asyncio.sleep(self.batch_ms / 2000)
+            for link in self.links:
+                link.process()
+            now = time.monotonic()
+            if now - last_check >= 1.0:
+                last_check = now
+                for s in list(self.sessions):
+                    if now - s.last_rx > s.heartbeat * 1.5:
+                        s.close()
+
+    def report(self):
+        devices = [d for link in self.links for d in link.devices.values()]
+        writes_in = sum(d.writes_in for d in devices)
+        socket_writes = sum(link.socket_writes for link in self.links)
+        lines = [
+            "gateway: {} devices on {} upstream links ({} slots each, stride {}), {} connected".format(
+                len(devices), len(self.links), self.slots_per_link, self.stride,
+                sum(link.state == BlynkLib.CONNECTED for link in self.links)),
+            "gateway: {} device writes up in {} upstream socket writes / {} B, {} dashboard writes down".format(
+                writes_in, socket_writes, sum(link.bytes_out for link in self.links),
+                sum(d.writes_out for d in devices)),
+            "gateway: {} device pings answered locally, {} frames refused".format(
+                sum(d.pings for d in devices), sum(d.refused for d in devices)),
+        ]
+        return lines
+
+
+def parse_devices(specs):
+    devices = {}
+    for spec in specs:
+        token, slot = spec.rsplit('=', 1)
+        devices[token] = int(slot)
+    return devices
+
+
+async def run(args):
+    fleet = server = None
+    tokens = args.upstream_token
+    host, port = args.upstream.rsplit(':', 1)
+    use_ssl = not args.insecure
+    if args.soak:
+        # self test: upstream server on the next port, soak clients on the gateway
+        host, port, use_ssl = args.host, args.port + 1, False
+        server = BlynkServer(ping_interval=args.heartbeat)
+        await server.start(host, [port])
+        slots = 256 // args.stride
+        tokens = tokens or ['gateway-{}'.format(i) for i in range((args.soak + slots - 1) // slots)]
+
+    gw = Gateway(host, int(port), tokens, parse_devices(args.device), stride=args.stride,
+                 batch_ms=args.batch_ms, heartbeat=args.heartbeat, use_ssl=use_ssl)
+    await gw.start(args.host, args.port)
+    for link in gw.links:
+        link.connect()
+    print("gateway on {}:{}, {} upstream links to {}:{}".format(args.host, args.port, len(gw.links), host, port))
+
+    try:
+        if args.soak:
+            await asyncio.sleep(0.5)
+            fleet = Fleet(args.soak, args.host, args.port, period=args.period, heartbeat=10)
+            # every slot of every link, half way through
+            for k in range(gw.slots_per_link):
+                server.schedule(args.seconds / 2, server.write, k * args.stride, 1)
+            await fleet.run(args.seconds)
+        elif args.seconds:
+            await asyncio.sleep(args.seconds)
+        else:
+            await asyncio.Event().wait()
+    finally:
+        lines = gw.report()
+        if fleet:
+            lines = fleet.report() + lines
+            fleet.stop()
+        await asyncio.sleep(0.2)
+        await gw.stop()
+        if server:
+            await asyncio.sleep(0.2)
+            await server.stop()
+            lines += server.report()
+        await asyncio.sleep(0.1)
+        print()
+        print("\n".join(lines))
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Multiplexes BlynkLib devices over a few upstream connections.")
+    ap.add_argument('--host', default='127.0.0.1', help="address devices connect to")
+    ap.add_argument('--port', type=int, default=8080)
+    ap.add_argument('--upstream', default='blynk.cloud:443', metavar='HOST:PORT')
+    ap.add_argument('--insecure', action='store_true', help="plain TCP upstream")
+    ap.add_argument('--upstream-token', action='append', default=[], metavar='TOKEN',
+                    help="auth token of one upstream link, repeat for a pool")
+    ap.add_argument('--device', action='append', default=[], metavar='TOKEN=SLOT',
+                    help="device token and its global slot (default: any token, next free slot)")
+    ap.add_argument('--stride', type=int, default=16, help="virtual pins per device, above the firmware's highest pin")
+    ap.add_argument('--batch-ms', type=int, default=50, help="upstream write coalescing window")
+    ap.add_argument('--heartbeat', type=int, default=50, help="upstream heartbeat, seconds")
+    ap.add_argument('--seconds', type=float, default=0, help="run time (default: forever, 30 with --soak)")
+    ap.add_argument('--soak', type=int, default=0, metavar='N', help="self test with N local clients")
+    ap.add_argument('--period', type=float, default=2.0, help="soak publish period per client, seconds")
+    args = ap.parse_args(argv)
+    if args.soak and not args.seconds:
+        args.seconds = 30
+    if not args.soak and not args.upstream_token:
+        ap.error("at least one --upstream-token is needed")
+    raise_fd_limit()
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,538 @@
+"""
+    blynk_server
+    local asyncio stand-in for the Blynk server
+
+    Speaks the server side of the binary protocol (HW_LOGIN,
+    RSP, PING, HW, INTERNAL, REDIRECT) to any number of devices,
+    pings every device to measure round trip latency, counts
+    traffic per connection, and can script dashboard writes,
+    redirects and dropped connections. Devices connect with
+
+        BlynkLib.Blynk(token, insecure=True, server='<host>', port=8080)
+
+    With --soak N it also starts N BlynkLib clients in the same
+    process, each publishing like main.py does and following
+    redirects and reconnecting after drops, then reports how
+    the fleet held up:
+
+        python3 tools/blynk_server.py --port 8080
+        python3 tools/blynk_server.py --soak 2000 --seconds 60 \\
+            --write 0=1@10 --write 2=1@12 --redirect 8081@20 \\
+            --disconnect 0.1@30 --json soak.json
+
+    --write V=X@T        dashboard writes X to V<V> on every device at T
+    --redirect PORT@T    sends every device to PORT on this server at T
+    --disconnect F@T     drops a fraction F of the connections at T
+
+    Each soak client needs two file descriptors, so thousands of
+    them need the open file limit raised (done here up to the
+    hard limit).
+
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'load-to-pico'))
+
+import BlynkLib
+
+MSG_RSP = BlynkLib.MSG_RSP
+MSG_LOGIN = BlynkLib.MSG_LOGIN
+MSG_PING = BlynkLib.MSG_PING
+MSG_HW = BlynkLib.MSG_HW
+MSG_INTERNAL = BlynkLib.MSG_INTERNAL
+MSG_HW_LOGIN = BlynkLib.MSG_HW_LOGIN
+MSG_REDIRECT = BlynkLib.MSG_REDIRECT
+STA_SUCCESS = BlynkLib.STA_SUCCESS
+STA_INVALID_TOKEN = BlynkLib.STA_INVALID_TOKEN
+
+RTT_SAMPLES = 256   # ping round trips kept per connection
+
+
+def frame(cmd, msg_id, *args):
+    '''Encodes one frame'''
+    data = '\0'.join(map(str, args)).encode('utf8')
+    return struct.pack("!BHH", cmd, msg_id, len(data)) + data
+
+
+def percentile(values, p):
+    '''p-th percentile of an already sorted list'''
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+class Session(asyncio.Protocol):
+    '''Server end of one device connection'''
+
+    def __init__(self, server, port):
+        self.server = server
+        self.port = port
+        self.transport = None
+        self.peer = None
+        self.token = None
+        self.info = {}
+        self.heartbeat = 50
+        self.closed_by = None
+        self._rx = bytearray()
+        self._pings = {}        # msg id -> time sent
+        self.rtt = []           # last RTT_SAMPLES round trips, seconds
+        self.opened = self.closed = None
+        self.last_rx = 0.0
+        self.frames_in = self.frames_out = 0
+        self.bytes_in = self.bytes_out = 0
+        self.writes_in = 0      # virtual writes from the device
+        self.writes_out = 0     # dashboard writes to the device
+
+    # -- asyncio.Protocol ----------------------------------------------------
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.peer = transport.get_extra_info('peername')
+        self.opened = self.last_rx = time.monotonic()
+        self.server.accepted += 1
+        self.server.sessions.add(self)
+
+    def data_received(self, data):
+        self.last_rx = time.monotonic()
+        self.bytes_in += len(data)
+        self._rx.extend(data)
+        while len(self._rx) >= 5:
+            cmd, msg_id, dlen = struct.unpack_from("!BHH", self._rx)
+            size = 5 if cmd == MSG_RSP else 5 + dlen
+            if len(self._rx) < size:
+                break
+            payload = bytes(self._rx[5:size])
+            del self._rx[:size]
+            self.frames_in += 1
+            self.handle(cmd, msg_id, dlen, payload)
+            if self.transport is None or self.transport.is_closing():
+                break
+
+    def connection_lost(self, exc):
+        self.closed = time.monotonic()
+        self.transport = None
+        self.server.sessions.discard(self)
+        self.server.finished.append(self)
+
+    # -- protocol ------------------------------------------------------------
+
+    def send(self, cmd, *args, msg_id=None):
+        if self.transport is None or self.transport.is_closing():
+            return None
+        if msg_id is None:
+            msg_id = self.server.next_id()
+        data = frame(cmd, msg_id, *args)
+        self.transport.write(data)
+        self.frames_out += 1
+        self.bytes_out += len(data)
+        return msg_id
+
+    def respond(self, msg_id, status):
+        if self.transport is None or self.transport.is_closing():
+            return
+        self.transport.write(struct.pack("!BHH", MSG_RSP, msg_id, status))
+        self.frames_out += 1
+        self.bytes_out += 5
+
+    def handle(self, cmd, msg_id, dlen, payload):
+        if self.token is None and cmd not in (MSG_LOGIN, MSG_HW_LOGIN):
+            return self.close('no login')
+        if cmd in (MSG_LOGIN, MSG_HW_LOGIN):
+            token = payload.decode('utf8', 'replace')
+            if not self.server.accepts(token):
+                self.server.rejected += 1
+                self.respond(msg_id, STA_INVALID_TOKEN)
+                return self.close('invalid token')
+            self.token = token
+            self.server.logins += 1
+            self.respond(msg_id, STA_SUCCESS)
+        elif cmd == MSG_PING:
+            self.respond(msg_id, STA_SUCCESS)
+        elif cmd == MSG_RSP:
+            sent = self._pings.pop(msg_id, None)
+            if sent is not None:
+                if len(self.rtt) >= RTT_SAMPLES:
+                    del self.rtt[0]
+                self.rtt.append(time.monotonic() - sent)
+        elif cmd == MSG_HW:
+            args = payload.split(b'\0')
+            if args[0] == b'vw' and len(args) > 1:
+                self.writes_in += 1
+                self.server.values[args[1].decode()] = args[2:]
+        elif cmd == MSG_INTERNAL:
+            args = payload.decode('utf8', 'replace').split('\0')
+            self.info.update(zip(args[0::2], args[1::2]))
+            try:
+                self.heartbeat = int(self.info.get('h-beat', self.heartbeat))
+            except ValueError:
+                pass
+
+    def ping(self):
+        msg_id = self.send(MSG_PING)
+        if msg_id is not None:
+            self._pings[msg_id] = time.monotonic()
+            # a device that never answers must not grow this forever
+            if len(self._pings) > 16:
+                del self._pings[next(iter(self._pings))]
+
+    def write(self, pin, *values):
+        if self.send(MSG_HW, 'vw', pin, *values) is not None:
+            self.writes_out += 1
+
+    def redirect(self, host, port):
+        self.send(MSG_REDIRECT, host, port)
+
+    def close(self, why):
+        if self.transport is not None and not self.transport.is_closing():
+            self.closed_by = why
+            self.transport.close()
+
+    def stats(self):
+        t = (self.closed or time.monotonic()) - self.opened
+        rtt = sorted(self.rtt)
+        return {
+            'peer': '{}:{}'.format(*self.peer[:2]) if self.peer else None,
+            'port': self.port,
+            'token': self.token,
+            'seconds': t,
+            'frames_in': self.frames_in,
+            'frames_out': self.frames_out,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'frames_in_per_s': self.frames_in / t if t > 0 else 0.0,
+            'writes_in': self.writes_in,
+            'writes_out': self.writes_out,
+            'rtt_ms_p50': percentile(rtt, 50) * 1000,
+            'rtt_ms_max': rtt[-1] * 1000 if rtt else 0.0,
+            'closed_by': self.closed_by,
+        }
+
+
+class BlynkServer:
+    '''Accepts device connections on one or more ports'''
+
+    def __init__(self, tokens=None, ping_interval=1.0, seed=0):
+        self.tokens = tokens            # None accepts any token
+        self.ping_interval = ping_interval
+        self.rnd = random.Random(seed)
+        self.sessions = set()
+        self.finished = []
+        self.values = {}                # vpin -> last values from any device
+        self.accepted = self.logins = self.rejected = 0
+        self.redirects = self.dropped = 0
+        self.host = None
+        self._servers = []
+        self._msg_id = 1
+        self._tasks = []
+
+    def accepts(self, token):
+        return self.tokens is None or token in self.tokens
+
+    def next_id(self):
+        i = self._msg_id
+        self._msg_id = self._msg_id % 0xFFFF + 1
+        return i
+
+    def logged_in(self):
+        return [s for s in self.sessions if s.token is not None]
+
+    async def start(self, host, ports):
+        self.host = host
+        loop = asyncio.get_running_loop()
+        for port in ports:
+            server = await loop.create_server(lambda port=port: Session(self, port), host, port, backlog=4096)
+            self._servers.append(server)
+        self._tasks.append(asyncio.ensure_future(self._keepalive()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
+        for s in list(self.sessions):
+            s.close('shutdown')
+
+    async def _keepalive(self):
+        '''Pings every device and drops the ones that went silent'''
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            now = time.monotonic()
+            for s in list(self.sessions):
+                if now - s.last_rx > s.heartbeat * 1.5:
+                    s.close('heartbeat')
+                elif s.token is not None:
+                    s.ping()
+
+    # -- scripted events -----------------------------------------------------
+
+    def write(self, pin, *values):
+        '''Dashboard write to V<pin> on every logged in device'''
+        for s in self.logged_in():
+            s.write(pin, *values)
+
+    def redirect(self, port, host=None):
+        '''Sends every logged in device to another port'''
+        for s in self.logged_in():
+            s.redirect(host or self.host, port)
+            self.redirects += 1
+
+    def drop(self, fraction):
+        '''Closes a random fraction of the connections'''
+        live = sorted(self.sessions, key=id)
+        for s in self.rnd.sample(live, int(len(live) * fraction)):
+            s.close('dropped')
+            self.dropped += 1
+
+    def schedule(self, at_s, func, *args):
+        '''Runs func(*args) at_s seconds from now'''
+        asyncio.get_running_loop().call_later(at_s, func, *args)
+
+    # -- reporting -----------------------------------------------------------
+
+    def stats(self):
+        return [s.stats() for s in self.finished] + [s.stats() for s in self.sessions]
+
+    def report(self):
+        conns = self.stats()
+        rtt = sorted(r for s in list(self.sessions) + self.finished for r in s.rtt)
+        rates = sorted(c['frames_in_per_s'] for c in conns if c['token'])
+        closed = {}
+        for s in self.finished:
+            closed[s.closed_by or 'by device'] = closed.get(s.closed_by or 'by device', 0) + 1
+        lines = [
+            "server: {} accepted, {} logins, {} rejected, {} live, {} redirects sent, {} dropped".format(
+                self.accepted, self.logins, self.rejected, len(self.sessions), self.redirects, self.dropped),
+            "closed: " + (", ".join("{} {}".format(n, why) for why, n in sorted(closed.items())) or "none"),
+            "traffic: {} frames / {} B in, {} frames / {} B out".format(
+                sum(c['frames_in'] for c in conns), sum(c['bytes_in'] for c in conns),
+                sum(c['frames_out'] for c in conns), sum(c['bytes_out'] for c in conns)),
+        ]
+        if rates:
+            lines.append("per connection in: min {:.2f}, median {:.2f}, max {:.2f} frames/s".format(
+                rates[0], percentile(rates, 50), rates[-1]))
+        if rtt:
+            lines.append("ping rtt: {} samples, p50 {:.2f} ms, p90 {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms".format(
+                len(rtt), percentile(rtt, 50) * 1000, percentile(rtt, 90) * 1000,
+                percentile(rtt, 99) * 1000, rtt[-1] * 1000))
+        return lines
+
+
+class SoakClient(BlynkLib.BlynkProtocol, asyncio.Protocol):
+    '''A BlynkLib device on an asyncio transport'''
+
+    def __init__(self, fleet, token, port):
+        self.fleet = fleet
+        self.server = fleet.host
+        self.port = port
+        self.transport = None
+        self.connects = 0
+        self.redirects = 0
+        self.received = 0
+        self.next_write = 0
+        self._opening = False
+        BlynkLib.BlynkProtocol.__init__(self, token, heartbeat=fleet.heartbeat)
+        self.on('V0', self._dashboard)
+        self.on('V2', self._dashboard)
+        self.on('redirect', self._redirect)
+
+    def _dashboard(self, value):
+        self.received += 1
+
+    def _redirect(self, server, port):
+        self.server = server
+        self.port = port
+        self.redirects += 1
+        self.disconnect()
+
+    def connect(self):
+        # BlynkProtocol.connect() runs once the transport is up
+        if self.transport is None and not self._opening and not self.fleet.stopping:
+            self._opening = True
+            asyncio.ensure_future(self._open())
+
+    async def _open(self):
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.create_connection(lambda: self, self.server, self.port)
+        except OSError:
+            self.fleet.connect_errors += 1
+            self._opening = False
+            loop.call_later(self.fleet.backoff(), self.connect)
+
+    def disconnect(self):
+        BlynkLib.BlynkProtocol.disconnect(self)
+        if self.transport is not None:
+            self.transport.close()
+
+    def _write(self, data):
+        if self.transport is not None:
+            self.transport.write(bytes(data))
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self._opening = False
+        self.connects += 1
+        BlynkLib.BlynkProtocol.connect(self)
+
+    def data_received(self, data):
+        self.process(data)
+
+    def connection_lost(self, exc):
+        self.transport = None
+        BlynkLib.BlynkProtocol.disconnect(self)
+        if not self.fleet.stopping:
+            asyncio.get_running_loop().call_later(self.fleet.backoff(), self.connect)
+
+
+class Fleet:
+    '''N soak clients publishing like main.py does'''
+
+    def __init__(self, n, host, port, period=2.0, ramp=500, heartbeat=10, seed=0):
+        self.n = n
+        self.host = host
+        self.port = port
+        self.period = period        # seconds between each client's publishes
+        self.ramp = ramp            # new connections per second
+        self.heartbeat = heartbeat
+        self.rnd = random.Random(seed)
+        self.clients = []
+        self.stopping = False
+        self.connect_errors = 0
+        self.sent = 0
+
+    def backoff(self):
+        return self.rnd.uniform(0.5, 2.0)
+
+    async def run(self, seconds):
+        start = time.monotonic()
+        for i in range(self.n):
+            self.clients.append(SoakClient(self, 'soak-{:05d}'.format(i), self.port))
+            if self.ramp and (i + 1) % max(1, self.ramp // 10) == 0:
+                await asyncio.sleep(0.1)
+        while time.monotonic() - start < seconds:
+            await asyncio.sleep(0.1)
+            now = time.monotonic()
+            for c in self.clients:
+                if c.state != BlynkLib.CONNECTED:
+                    continue
+                c.process()     # heartbeat pings
+                if now >= c.next_write:
+                    c.next_write = now + self.period * self.rnd.uniform(0.9, 1.1)
+                    c.virtual_write(1, round(self.rnd.uniform(0, 5), 6))
+                    c.virtual_write(3, round(self.rnd.uniform(0, 5), 6))
+                    self.sent += 2
+
+    def stop(self):
+        self.stopping = True
+        for c in self.clients:
+            c.disconnect()
+
+    def report(self):
+        connected = sum(c.state == BlynkLib.CONNECTED for c in self.clients)
+        connects = sum(c.connects for c in self.clients)
+        return ["soak: {} clients, {} connected at the end, {} connects ({} reconnects), "
+                "{} redirects followed, {} connect errors".format(
+                    len(self.clients), connected, connects, connects - len(self.clients),
+                    sum(c.redirects for c in self.clients), self.connect_errors),
+                "soak: {} virtual writes sent, {} dashboard writes received".format(
+                    self.sent, sum(c.received for c in self.clients))]
+
+
+def raise_fd_limit():
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def at(spec):
+    what, t = spec.rsplit('@', 1)
+    return what, float(t)
+
+
+async def serve(args):
+    server = BlynkServer(tokens=set(args.token) or None, ping_interval=args.ping_interval, seed=args.seed)
+    ports = [args.port]
+    for spec in args.redirect:
+        port, t = at(spec)
+        if int(port) not in ports:
+            ports.append(int(port))
+        server.schedule(t, server.redirect, int(port))
+    await server.start(args.host, ports)
+    print("listening on {} port {}".format(args.host, ", ".join(map(str, ports))))
+
+    for spec in args.write:
+        assignment, t = at(spec)
+        pin, value = assignment.split('=', 1)
+        server.schedule(t, server.write, int(pin.lstrip('Vv')), value)
+    for spec in args.disconnect:
+        fraction, t = at(spec)
+        server.schedule(t, server.drop, float(fraction))
+
+    fleet = None
+    try:
+        if args.soak:
+            fleet = Fleet(args.soak, args.host, args.port, period=args.period,
+                          ramp=args.ramp, heartbeat=args.heartbeat, seed=args.seed)
+            await fleet.run(args.seconds)
+        elif args.seconds:
+            await asyncio.sleep(args.seconds)
+        else:
+            await asyncio.Event().wait()
+    finally:
+        if fleet:
+            lines = fleet.report()
+            fleet.stop()
+        await asyncio.sleep(0.2)
+        await server.stop()
+        await asyncio.sleep(0.1)
+        print()
+        if fleet:
+            print("\n".join(lines))
+        print("\n".join(server.report()))
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'connections': server.stats()}, f, indent=1)
+            print("per connection stats written to", args.json)
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Local Blynk server emulator and soak tester.")
+    ap.add_argument('--host', default='127.0.0.1')
+    ap.add_argument('--port', type=int, default=8080)
+    ap.add_argument('--token', action='append', default=[], help="accepted token (default: any)")
+    ap.add_argument('--seconds', type=float, default=0, help="run time (default: forever, 30 with --soak)")
+    ap.add_argument('--ping-interval', type=float, default=1.0, help="seconds between server pings")
+    ap.add_argument('--write', action='append', default=[], metavar='V=X@T')
+    ap.add_argument('--redirect', action='append', default=[], metavar='PORT@T')
+    ap.add_argument('--disconnect', action='append', default=[], metavar='F@T')
+    ap.add_argument('--soak', type=int, default=0, metavar='N', help="in-process BlynkLib clients")
+    ap.add_argument('--period', type=float, default=2.0, help="soak publish period per client, seconds")
+    ap.add_argument('--ramp', type=int, default=500, help="soak connections opened per second")
+    ap.add_argument('--heartbeat', type=int, default=10, help="soak client heartbeat, seconds")
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--json', metavar='FILE', help="write per connection stats here")
+    args = ap.parse_args(argv)
+    if args.soak and not args.seconds:
+        args.seconds = 30
+    raise_fd_limit()
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+"""
+    replay_trace
+    pushes a recorded raw ADC trace back through SignalPath
+
+    Reads a trace written by TraceRecorder.py (on the Pico
+    with TRACE_FILE set in main.py, or by simulate.py
+    --trace) and feeds it to the firmware's own SignalPath:
+    the samples in drain-sized chunks, the mode changes and
+    window boundaries where the run had them. The readings,
+    phase energies and cycles come out as the run computed
+    them (in double precision here, the Pico uses single),
+    only as fast as the host goes.
+
+        python3 tools/replay_trace.py trace.bin [--windows] [--repeat N]
+            [--json FILE] [--baseline FILE] [--chunk N]
+
+    --windows          print every window reading
+    --repeat N         replay N times and report the best rate
+    --json FILE        write the readings, cycles and totals
+    --baseline FILE    compare with an earlier --json, exit 1
+                       on any difference (signal path changes)
+    --chunk N          pairs per add_pairs() call (default: one
+                       drain interval at the recorded rate)
+
+"""
+
+import argparse
+import json
+import os
+import struct
+import sys
+import time
+from array import array
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'load-to-pico'))
+
+import SignalPath
+import TraceRecorder as T
+
+DRAIN_INTERVAL = 0.1    # seconds, main.py's ADC_DRAIN_INTERVAL
+TOLERANCE = 1e-9        # relative, for --baseline
+
+PAIRS = 0               # op kinds, besides the trace's MODE and WINDOW
+
+
+class Trace:
+    '''A decoded trace: header fields and the ops to replay'''
+
+    def __init__(self, path, chunk=None):
+        with open(path, 'rb') as f:
+            data = f.read()
+        if len(data) < T.HEADER_SIZE:
+            raise ValueError("{}: too short for a trace".format(path))
+        magic, version, _, self.rate, g, m, v = struct.unpack_from(T.HEADER, data, 0)
+        if magic != T.MAGIC or version != T.VERSION:
+            raise ValueError("{}: not a version {} trace".format(path, T.VERSION))
+        self.gains = (g, m, v)
+        self.bytes = len(data)
+        self.chunk = chunk or max(1, int(self.rate * DRAIN_INTERVAL))
+        self.pairs = 0
+        self.modes = 0
+        self.windows = 0
+        self.ops = self._decode(data)
+        self.seconds = self.end_ms / 1000
+
+    def _decode(self, data):
+        # ops: (PAIRS, buf, times, n, ms), (MODE, generating, ms), (WINDOW, ms)
+        # ms is trace time since the first sample, as the cycle clock sees it
+        ops = []
+        buf = array('H')
+        times = array('I')
+        elapsed = 0         # unwrapped us since the first sample
+        last = None
+        pos = T.HEADER_SIZE
+        end = len(data) - T.PAIR_SIZE
+        unpack_from = struct.unpack_from
+        while pos <= end:
+            dt, a, b = unpack_from(T.PAIR, data, pos)
+            if dt != T.ESCAPE:
+                pos += T.PAIR_SIZE
+                t = (last + dt) & 0x3FFFFFFF
+                if dt:
+                    elapsed += dt
+                buf.append(a)
+                buf.append(b)
+                times.append(t)
+                last = t
+                if len(times) == self.chunk:
+                    ops.append((PAIRS, buf, times, len(times), elapsed // 1000))
+                    buf = array('H')
+                    times = array('I')
+                continue
+            if pos + T.EVENT_SIZE > len(data):
+                break
+            _, kind, arg, stamp = unpack_from(T.EVENT, data, pos)
+            pos += T.EVENT_SIZE
+            if kind == T.TIME:
+                if last is not None:
+                    elapsed += (stamp - last) & 0x3FFFFFFF
+                last = stamp
+                continue
+            if len(times):
+                ops.append((PAIRS, buf, times, len(times), elapsed // 1000))
+                buf = array('H')
+                times = array('I')
+            if kind == T.MODE:
+                ops.append((T.MODE, arg == 1, elapsed // 1000))
+                self.modes += 1
+            elif kind == T.WINDOW:
+                ops.append((T.WINDOW, elapsed // 1000))
+                self.windows += 1
+        if len(times):
+            ops.append((PAIRS, buf, times, len(times), elapsed // 1000))
+        self.pairs = sum(op[3] for op in ops if op[0] == PAIRS)
+        self.end_ms = elapsed // 1000
+        return ops
+
+
+def replay(trace, history, on_reading=None):
+    '''Runs the trace through a fresh SignalPath, returns (path, readings, cycles)'''
+    now = [0]
+    path = SignalPath.SignalPath(trace.gains[0], trace.gains[1], trace.gains[2], history, clock=lambda: now[0])
+    readings = []
+    closed = []
+    for op in trace.ops:
+        kind = op[0]
+        if kind == PAIRS:
+            path.add_pairs(op[1], op[2], 0, 2 * op[3])
+            now[0] = op[4]
+        elif kind == T.MODE:
+            now[0] = op[2]
+            if path.mode(op[1]):
+                closed.append(path.cycles.last())
+        else:
+            now[0] = op[1]
+            reading = path.window()
+            readings.append((op[1], reading))
+            if on_reading is not None:
+                on_reading(op[1], reading)
+    return path, readings, closed
+
+
+def reading_record(ms, r):
+    if r is None:
+        return {'ms': ms, 'n': 0}
+    return {'ms': ms, 'mode': 'generate' if r.generating else 'motor', 'n': r.n,
+            'voltage': r.voltage, 'current': r.current, 'power': r.power,
+            'max_power': r.max_power, 'energy': r.energy}
+
+
+def print_reading(ms, r):
+    if r is None:
+        print("{:8.1f} s  no samples".format(ms / 1000))
+        return
+    print("{:8.1f} s  {:<9} {:>5} samples  {:8.4f} V {:9.4f} mA  {:8.4f} W  max {:8.4f} W  {:11.6f} J".format(
+        ms / 1000, "GENERATOR" if r.generating else "MOTOR", r.n, r.voltage, r.current * 1000, r.power, r.max_power, r.energy))
+
+
+def results(trace, path, readings, closed):
+    return {
+        'trace': {'pairs': trace.pairs, 'seconds': trace.seconds, 'rate': trace.rate, 'gains': list(trace.gains)},
+        'readings': [reading_record(ms, r) for ms, r in readings],
+        'cycles': [list(c) for c in closed],
+        'energy': {'generator': path.generator_energy.joules(), 'motor': path.motor_energy.joules()},
+    }
+
+
+def differences(new, old, where=''):
+    '''Paths at which two results differ beyond TOLERANCE'''
+    if isinstance(new, dict) and isinstance(old, dict):
+        out = []
+        for k in sorted(set(new) | set(old)):
+            if k not in new or k not in old:
+                out.append("{}.{} only in {}".format(where, k, 'new' if k in new else 'baseline'))
+            else:
+                out.extend(differences(new[k], old[k], "{}.{}".format(where, k)))
+        return out
+    if isinstance(new, list) and isinstance(old, list):
+        out = []
+        if len(new) != len(old):
+            out.append("{}: {} entries, baseline has {}".format(where, len(new), len(old)))
+        for i, (a, b) in enumerate(zip(new, old)):
+            out.extend(differences(a, b, "{}[{}]".format(where, i)))
+        return out
+    if isinstance(new, float) and isinstance(old, (int, float)) and not isinstance(old, bool):
+        if abs(new - old) > TOLERANCE * max(abs(new), abs(old)):
+            return ["{}: {!r}, baseline {!r}".format(where, new, old)]
+        return []
+    return [] if new == old else ["{}: {!r}, baseline {!r}".format(where, new, old)]
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Replay a raw ADC trace through SignalPath.")
+    ap.add_argument('trace')
+    ap.add_argument('--windows', action='store_true', help="print every window reading")
+    ap.add_argument('--repeat', type=int, default=1, metavar='N', help="replays, the best rate is reported")
+    ap.add_argument('--json', metavar='FILE', help="write the results")
+    ap.add_argument('--baseline', metavar='FILE', help="compare with an earlier --json")
+    ap.add_argument('--chunk', type=int, metavar='N', help="pairs per add_pairs() call")
+    ap.add_argument('--history', type=int, default=16, help="cycles kept, main.py's CYCLE_HISTORY")
+    args = ap.parse_args(argv)
+
+    trace = Trace(args.trace, args.chunk)
+    print("{}: {:.1f} s, {} pairs at {} Hz, {} mode changes, {} windows, {:.2f} B/pair".format(
+        args.trace, trace.seconds, trace.pairs, trace.rate, trace.modes, trace.windows,
+        trace.bytes / trace.pairs if trace.pairs else 0))
+
+    best = None
+    for i in range(args.repeat):
+        start = time.perf_counter()
+        out = replay(trace, args.history, print_reading if args.windows and i == 0 else None)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    path, readings, closed = out
+
+    print()
+    for line in path.cycles.report(path.energy()):
+        print(line)
+    print("energy: {:.6f} J generated, {:.6f} J used in the last phases".format(
+        path.generator_energy.joules(), path.motor_energy.joules()))
+    print("replay: {:.3f} s, {:.0f} pairs/s, {:.0f}x real time (chunks of {})".format(
+        best, trace.pairs / best if best else 0, trace.seconds / best if best else 0, trace.chunk))
+
+    res = results(trace, path, readings, closed)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(res, f, indent=1)
+        print("results written to", args.json)
+    if args.baseline:
+        with open(args.baseline) as f:
+            old = json.load(f)
+        diff = differences(res, old)
+        print()
+        if diff:
+            print("{} differences from {}:".format(len(diff), args.baseline))
+            for line in diff[:20]:
+                print("  " + line)
+            sys.exit(1)
+        print("same results as", args.baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+"""
+    sim
+    host-side simulator for the load-to-pico firmware
+
+    Runs main.py unmodified under CPython with simulated
+    machine, network, utime, ntptime and _thread modules, all
+    driven by one deterministic virtual clock (see
+    sim.kernel). Idle time is skipped, so a run is usually
+    much faster than real time, and the same scenario
+    always produces the same run.
+
+        import sim
+        s = sim.Simulator(seconds=30)
+        s.board.press(17, at_s=5)              # mode button
+        s.board.blynk.dashboard_write(12, 0, 1) # V0 <- 1
+        s.board.wifi.outage(15, 18)
+        s.run()
+
+"""
+
+import builtins
+import importlib.util
+import os
+import random
+import sys
+import tempfile
+import time as _time
+
+from sim.kernel import Kernel
+from sim.hardware import Board
+from sim.netapi import SelectModule, SocketModule
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIRMWARE = os.path.normpath(os.path.join(HERE, '..', '..', 'load-to-pico'))
+MODULES = os.path.join(HERE, 'modules')
+
+# the board the firmware-facing modules talk to, set by Simulator
+board = None
+
+_FAKE_MODULES = ('machine', 'network', 'utime', 'ntptime', '_thread')
+_TIME_NAMES = ('ticks_ms', 'ticks_us', 'ticks_cpu', 'ticks_diff', 'ticks_add', 'sleep_ms', 'sleep_us')
+_MISSING = object()
+
+
+class Simulator:
+    '''One simulated power-on of the firmware'''
+
+    def __init__(self, seconds, seed=0, profile=False, quiet=False, firmware=FIRMWARE, flash=None, instrument=False, trace=None):
+        self.kernel = Kernel(seconds, profile=profile, quiet=quiet)
+        self.board = Board(self.kernel, seed)
+        self.seed = seed
+        self.firmware = firmware
+        # the firmware's working directory stands in for the flash filesystem
+        self.flash = flash or tempfile.mkdtemp(prefix='sim-flash-')
+        self.namespace = None
+        # turn on the firmware's latency histograms, whatever main.py's INSTRUMENT says
+        self.instrument = instrument
+        self.instrument_module = None
+        # record an ADC trace (TraceRecorder.py) to this path, whatever main.py's TRACE_FILE says
+        self.trace = trace
+        self.wall_s = 0.0
+        self._saved = {}
+        self._patched = []      # (object, attribute, value before install)
+        self._random_state = None
+
+    def _patch(self, obj, name, value):
+        self._patched.append((obj, name, getattr(obj, name, _MISSING)))
+        setattr(obj, name, value)
+
+    def install(self):
+        '''Makes the simulated modules the ones the firmware imports'''
+        global board
+        board = self.board
+        import threading    # noqa: F401 - bind the real _thread before shadowing it
+        if self.firmware not in sys.path:
+            sys.path.insert(0, self.firmware)
+        # _thread is built in, so it can't be shadowed through sys.path
+        for name in _FAKE_MODULES:
+            self._saved[name] = sys.modules.get(name)
+            spec = importlib.util.spec_from_file_location(name, os.path.join(MODULES, name + '.py'))
+            module = importlib.util.module_from_spec(spec)
+            sys.modules[name] = module
+            spec.loader.exec_module(module)
+        # the firmware's own randomness (backoff jitter) repeats with the seed
+        self._random_state = random.getstate()
+        random.seed(self.seed)
+        # MicroPython builtins the firmware relies on
+        self._patch(builtins, 'const', lambda x: x)
+        import utime
+        for name in _TIME_NAMES:
+            self._patch(_time, name, getattr(utime, name))
+        # firmware modules are re-imported so they bind the fake ones
+        for name in list(sys.modules):
+            mod = sys.modules[name]
+            path = getattr(mod, '__file__', None) or ''
+            if path.startswith(self.firmware + os.sep):
+                del sys.modules[name]
+        import BlynkLib
+        BlynkLib.socket = SocketModule(self.board)
+        BlynkLib.select = SelectModule(self.board)
+        if self.instrument:
+            import Instrument
+            Instrument.enable()
+            self.instrument_module = Instrument
+        if self.trace:
+            import TraceRecorder
+            TraceRecorder.enable(self.trace)
+
+    def run(self, script='main.py', wall_timeout=None):
+        '''Runs script from the firmware directory until the clock runs out'''
+        self.install()
+        path = os.path.join(self.firmware, script)
+        self.namespace = {'__name__': '__main__', '__file__': path}
+        code = compile(open(path).read(), path, 'exec')
+
+        def main():
+            exec(code, self.namespace)
+
+        cwd = os.getcwd()
+        os.makedirs(self.flash, exist_ok=True)
+        os.chdir(self.flash)
+        start = _time.perf_counter()
+        try:
+            self.kernel.run(main, wall_timeout=wall_timeout)
+        finally:
+            self.wall_s = _time.perf_counter() - start
+            # the firmware never stops, so its trace is closed for it
+            recorder = self.namespace.get('adc_trace')
+            if recorder is not None:
+                recorder.close()
+            os.chdir(cwd)
+            self.uninstall()
+        return self
+
+    def uninstall(self):
+        '''Puts the host's own modules, time functions, builtins and random state back'''
+        for name, module in self._saved.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+        self._saved = {}
+        for obj, name, value in reversed(self._patched):
+            if value is _MISSING:
+                delattr(obj, name)
+            else:
+                setattr(obj, name, value)
+        self._patched = []
+        if self._random_state is not None:
+            random.setstate(self._random_state)
+            self._random_state = None
+
+    def profile_stats(self):
+        '''pstats.Stats merged over every firmware thread, if profiling'''
+        import pstats
+        stats = None
+        for task in self.kernel.tasks:
+            if task.profile is None:
+                continue
+            if stats is None:
+                stats = pstats.Stats(task.profile)
+            else:
+                stats.add(task.profile)
+        return stats
+
+    def report(self):
+        virtual_s = self.kernel.now_us / 1000000
+        lines = ["simulated {:.3f} s in {:.3f} s wall ({:.1f}x real time)".format(
+            virtual_s, self.wall_s, virtual_s / self.wall_s if self.wall_s else 0)]
+        lines.extend(self.board.report())
+        for task in self.kernel.tasks:
+            if task.error is not None:
+                lines.append("{} died: {!r}".format(task.name, task.error))
+        if self.instrument_module is not None:
+            lines.append("latency (virtual time):")
+            lines.extend("  " + line for line in self.instrument_module.summary())
+        return "\n".join(lines)
@@ -0,0 +1,359 @@
+"""
+    sim.hardware
+    the simulated Pico W and everything wired to it
+
+    Holds pin levels, ADC waveforms, the Wi-Fi link and
+    an in-process Blynk server, all driven by the kernel's
+    virtual clock. The firmware-facing modules in
+    sim/modules (machine, network, utime, _thread) are
+    thin wrappers around this.
+
+"""
+
+import errno
+import math
+import random
+import struct
+
+from sim.kernel import IO_COST_US
+
+# rp2 port values
+IRQ_FALLING = 4
+IRQ_RISING = 8
+
+STAT_IDLE = 0
+STAT_CONNECTING = 1
+STAT_WRONG_PASSWORD = -3
+STAT_NO_AP_FOUND = -2
+STAT_CONNECT_FAIL = -1
+STAT_GOT_IP = 3
+
+FULL_SCALE = 65535
+
+# Blynk message types the server side needs
+MSG_RSP = 0
+MSG_LOGIN = 2
+MSG_PING = 6
+MSG_INTERNAL = 17
+MSG_HW = 20
+MSG_HW_LOGIN = 29
+MSG_REDIRECT = 41
+
+
+class PinState:
+    '''Level and wiring of one GPIO'''
+
+    def __init__(self, id):
+        self.id = id
+        self.level = 0
+        self.mode = None
+        self.pull = None
+        self.trigger = 0
+        self.handler = None
+        self.owner = None
+        self.writes = 0
+        self.edges = 0
+
+
+class Board:
+    '''Everything outside the firmware'''
+
+    def __init__(self, kernel, seed=0):
+        self.kernel = kernel
+        self.rng = random.Random(seed)
+        self.pins = {}
+        self.adc_waves = {
+            26: lambda t: 0.30 + 0.05 * math.sin(2 * math.pi * 50 * t),
+            27: lambda t: 0.50 + 0.02 * math.sin(2 * math.pi * 50 * t + 1.0),
+        }
+        self.adc_noise = 0.002
+        self.wifi = WiFi(self)
+        self.blynk = BlynkServer(self)
+
+    def pin(self, id):
+        if id not in self.pins:
+            self.pins[id] = PinState(id)
+        return self.pins[id]
+
+    # -- inputs -------------------------------------------------------------
+
+    def drive(self, id, level):
+        '''Sets an input level from outside, firing the pin IRQ on an edge'''
+        p = self.pin(id)
+        if level == p.level:
+            return
+        p.level = level
+        p.edges += 1
+        edge = IRQ_RISING if level else IRQ_FALLING
+        if p.handler and p.trigger & edge:
+            self.kernel.call_later(0, lambda: p.handler(p.owner))
+
+    def press(self, id, at_s, hold_s=0.2, active_low=True):
+        '''Scripts a button press on pin id at at_s seconds'''
+        down, up = (0, 1) if active_low else (1, 0)
+        t = int(at_s * 1000000)
+        self.kernel.call_at(t, lambda: self.drive(id, down))
+        self.kernel.call_at(t + int(hold_s * 1000000), lambda: self.drive(id, up))
+
+    # -- SIO GPIO registers --------------------------------------------------
+
+    def gpio_out(self):
+        '''GPIO_OUT as a 30-bit word of the pin levels'''
+        word = 0
+        for id, p in self.pins.items():
+            if id < 30 and p.level:
+                word |= 1 << id
+        return word
+
+    def write_gpio_out(self, word):
+        '''Sets every pin to its bit in word, counting a write on each pin that changes'''
+        changed = (word ^ self.gpio_out()) & 0x3FFFFFFF
+        id = 0
+        while changed:
+            if changed & 1:
+                p = self.pin(id)
+                p.level ^= 1
+                p.writes += 1
+            changed >>= 1
+            id += 1
+
+    def set_adc(self, id, wave):
+        '''wave(t_seconds) -> fraction of full scale seen by the ADC on pin id'''
+        self.adc_waves[id] = wave
+
+    def read_adc(self, id):
+        self.kernel.advance(IO_COST_US)
+        wave = self.adc_waves.get(id)
+        v = wave(self.kernel.now_us / 1000000) if wave else 0.0
+        if self.adc_noise:
+            v += self.rng.gauss(0, self.adc_noise)
+        return max(0, min(FULL_SCALE, int(v * FULL_SCALE)))
+
+    def report(self):
+        lines = []
+        outs = sorted((p for p in self.pins.values() if p.writes), key=lambda p: p.id)
+        if outs:
+            lines.append("output pins (id: level, writes): " + ", ".join(
+                "{}: {}, {}".format(p.id, p.level, p.writes) for p in outs))
+        lines.extend(self.wifi.report())
+        lines.extend(self.blynk.report())
+        return lines
+
+
+class WiFi:
+    '''Station interface with scripted association time, failures and outages'''
+
+    def __init__(self, board):
+        self.board = board
+        self.kernel = board.kernel
+        self.assoc_ms = 1500
+        self.failures = []          # status for attempt i, STAT_GOT_IP once exhausted
+        self.outages = []           # (start_us, end_us)
+        self.active = False
+        self.status = STAT_IDLE
+        self.attempts = 0
+        self.epoch = 0              # bumped whenever the link drops
+        self._pending = None
+
+    def fail(self, *statuses):
+        '''The next connect() attempts end with these statuses'''
+        self.failures.extend(statuses)
+
+    def outage(self, start_s, end_s):
+        '''Drops the link between start_s and end_s'''
+        start, end = int(start_s * 1000000), int(end_s * 1000000)
+        self.outages.append((start, end))
+        self.kernel.call_at(start, self._drop)
+
+    def in_outage(self):
+        now = self.kernel.now_us
+        return any(s <= now < e for s, e in self.outages)
+
+    def _drop(self):
+        self.epoch += 1
+        if self.status == STAT_GOT_IP:
+            self.status = STAT_NO_AP_FOUND
+        self.kernel.log("wifi: link lost")
+
+    def connect(self):
+        self.kernel.advance(IO_COST_US)
+        if self._pending:
+            self.kernel.cancel(self._pending)
+        self.attempts += 1
+        self.status = STAT_CONNECTING
+        attempt = self.attempts
+        self._pending = self.kernel.call_later(self.assoc_ms * 1000, lambda: self._associated(attempt))
+
+    def _associated(self, attempt):
+        self._pending = None
+        if self.in_outage():
+            self.status = STAT_NO_AP_FOUND
+        elif attempt <= len(self.failures):
+            self.status = self.failures[attempt - 1]
+        else:
+            self.status = STAT_GOT_IP
+            self.kernel.log("wifi: associated (attempt {})".format(attempt))
+
+    def disconnect(self):
+        if self._pending:
+            self.kernel.cancel(self._pending)
+            self._pending = None
+        if self.status == STAT_GOT_IP:
+            self.epoch += 1
+        self.status = STAT_IDLE
+
+    def isconnected(self):
+        self.kernel.advance(IO_COST_US)
+        return self.status == STAT_GOT_IP and not self.in_outage()
+
+    def report(self):
+        return ["wifi: {} connect attempts, {} outages, status {}".format(
+            self.attempts, len(self.outages), self.status)]
+
+
+class BlynkServer:
+    '''Server side of the Blynk protocol, in process, for sim sockets'''
+
+    def __init__(self, board):
+        self.board = board
+        self.kernel = board.kernel
+        self.latency_us = 20000
+        self.syn_timeout_us = 5000000   # a blocking connect to a server that doesn't answer gives up after this
+        self.outages = []           # (start_us, end_us) the server doesn't answer
+        self.token = None           # None accepts any token
+        self.values = {}            # vpin -> last values written by the device
+        self.counts = {}            # vpin -> number of writes
+        self.connections = []
+        self.logins = 0
+        self.frames_in = 0
+        self._msg_id = 1
+
+    def open(self, host, port):
+        conn = Connection(self, host, port)
+        self.connections.append(conn)
+        return conn
+
+    def outage(self, start_s, end_s):
+        '''Makes the server unreachable between start_s and end_s: connections drop, connects go unanswered'''
+        start, end = int(start_s * 1000000), int(end_s * 1000000)
+        self.outages.append((start, end))
+        self.kernel.call_at(start, self._drop_all)
+
+    def in_outage(self):
+        now = self.kernel.now_us
+        return any(s <= now < e for s, e in self.outages)
+
+    def _drop_all(self):
+        self.kernel.log("blynk: server unreachable")
+        for conn in self.connections:
+            if not conn.closed:
+                conn.close()
+                for task in conn.waiters:
+                    self.kernel.notify(task)
+
+    def dashboard_write(self, at_s, pin, *values):
+        '''Scripts a dashboard widget write to V<pin> at at_s seconds'''
+        self.kernel.call_at(int(at_s * 1000000), lambda: self._broadcast(MSG_HW, 'vw', pin, *values))
+
+    def redirect(self, at_s, host, port):
+        '''Scripts a server redirect at at_s seconds'''
+        self.kernel.call_at(int(at_s * 1000000), lambda: self._broadcast(MSG_REDIRECT, host, port))
+
+    def _broadcast(self, cmd, *args):
+        for conn in self.connections:
+            if conn.logged_in and not conn.closed:
+                conn.push(self._frame(cmd, self._next_id(), *args))
+
+    def _next_id(self):
+        i = self._msg_id
+        self._msg_id = self._msg_id % 0xFFFF + 1
+        return i
+
+    @staticmethod
+    def _frame(cmd, msg_id, *args):
+        data = '\0'.join(map(str, args)).encode('utf8')
+        return struct.pack("!BHH", cmd, msg_id, len(data)) + data
+
+    def handle(self, conn, cmd, msg_id, payload):
+        self.frames_in += 1
+        if cmd in (MSG_LOGIN, MSG_HW_LOGIN):
+            ok = self.token is None or payload.decode() == self.token
+            conn.logged_in = ok
+            self.logins += ok
+            conn.push(struct.pack("!BHH", MSG_RSP, msg_id, 200 if ok else 9))
+        elif cmd == MSG_PING:
+            conn.push(struct.pack("!BHH", MSG_RSP, msg_id, 200))
+        elif cmd == MSG_HW:
+            args = payload.split(b'\0')
+            if args[0] == b'vw' and len(args) > 1:
+                pin = int(args[1])
+                self.values[pin] = [a.decode() for a in args[2:]]
+                self.counts[pin] = self.counts.get(pin, 0) + 1
+
+    def report(self):
+        lines = ["blynk: {} connections, {} logins, {} frames from device".format(
+            len(self.connections), self.logins, self.frames_in)]
+        for pin in sorted(self.values):
+            lines.append("  V{:<3} {:>6} writes, last {}".format(pin, self.counts[pin], ",".join(self.values[pin])))
+        return lines
+
+
+class Connection:
+    '''Device end of one TCP connection to the simulated server'''
+
+    def __init__(self, server, host, port):
+        self.server = server
+        self.kernel = server.kernel
+        self.wifi = server.board.wifi
+        self.host = host
+        self.port = port
+        self.epoch = self.wifi.epoch
+        self.logged_in = False
+        self.closed = False
+        self._rx = bytearray()      # server -> device, readable now
+        self.waiters = []           # tasks blocked in poll() on this connection
+        self._tx = bytearray()      # device -> server, not yet parsed
+
+    def _check(self):
+        self.kernel.advance(IO_COST_US)
+        if self.closed:
+            raise OSError(errno.EBADF)
+        if self.epoch != self.wifi.epoch or not self.wifi.isconnected():
+            raise OSError(errno.ECONNRESET)
+
+    def push(self, data):
+        '''Queues server data, readable after the link latency'''
+        def arrive():
+            if not self.closed:
+                self._rx.extend(data)
+                for task in self.waiters:
+                    self.kernel.notify(task)
+        self.kernel.call_later(self.server.latency_us, arrive)
+
+    def write(self, data):
+        self._check()
+        self._tx.extend(data)
+        while len(self._tx) >= 5:
+            cmd, msg_id, dlen = struct.unpack_from("!BHH", self._tx)
+            size = 5 if cmd == MSG_RSP else 5 + dlen
+            if len(self._tx) < size:
+                break
+            payload = bytes(self._tx[5:size])
+            del self._tx[:size]
+            self.server.handle(self, cmd, msg_id, payload)
+        return len(data)
+
+    def read(self, n=-1):
+        self._check()
+        if not self._rx:
+            return None
+        n = len(self._rx) if n < 0 else n
+        data = bytes(self._rx[:n])
+        del self._rx[:n]
+        return data
+
+    def readable(self):
+        return bool(self._rx) or self.closed or self.epoch != self.wifi.epoch
+
+    def close(self):
+        self.closed = True
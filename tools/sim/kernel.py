@@ -0,0 +1,277 @@
+"""
+    sim.kernel
+    deterministic virtual clock and scheduler
+
+    Every firmware thread runs on a real CPython thread,
+    but only one of them holds the CPU at any time. A
+    thread gives the CPU up when it sleeps; the kernel
+    then jumps the clock straight to the next wake-up or
+    interrupt, so idle time costs nothing and runs are
+    repeatable. Interrupt callbacks (machine.Timer, pin
+    IRQs, scripted events) run on whichever thread is
+    switching when they fall due.
+
+    Simulated hardware calls cost a little virtual time
+    (READ_COST_US for clock reads, IO_COST_US for pins,
+    ADCs and the radio), so busy loops make progress,
+    interrupts keep firing, and a thread that has held
+    the CPU for SLICE_US while another one is due gets
+    preempted at its next hardware call, standing in
+    for the Pico's second core.
+
+"""
+
+import heapq
+import sys
+import threading
+import traceback
+
+READ_COST_US = 1
+IO_COST_US = 5
+SLICE_US = 1000
+TICKS_PERIOD = 1 << 30
+
+
+class SimulationEnd(BaseException):
+    '''Raised inside firmware threads to unwind them when the run is over'''
+
+
+class Task:
+    '''One firmware thread'''
+
+    def __init__(self, kernel, name, func, args):
+        self.kernel = kernel
+        self.name = name
+        self.func = func
+        self.args = args
+        self.wake = threading.Event()
+        self.error = None
+        self.profile = None
+        self.wait_seq = None        # seq of the live _sleepers entry
+        self.blocked = False        # in block_us(), notify() can wake it
+        self.thread = threading.Thread(target=self._main, name=name, daemon=True)
+
+    def _main(self):
+        k = self.kernel
+        self.wake.wait()
+        self.wake.clear()
+        try:
+            if k.profile:
+                import cProfile
+                self.profile = cProfile.Profile()
+                self.profile.enable()
+            if not k.ended:
+                self.func(*self.args)
+        except SimulationEnd:
+            pass
+        except SystemExit:
+            k.log("{} called sys.exit()".format(self.name))
+        except BaseException as e:
+            self.error = e
+            k.log("unhandled exception in {}:".format(self.name))
+            traceback.print_exc()
+        finally:
+            if self.profile:
+                self.profile.disable()
+            k._exit(self)
+
+
+class Kernel:
+    '''Virtual microsecond clock shared by every simulated module'''
+
+    def __init__(self, until_s=None, profile=False, quiet=False):
+        self.now_us = 0
+        self.until_us = None if until_s is None else int(until_s * 1000000)
+        self.profile = profile
+        self.quiet = quiet
+        self.tasks = []
+        self.current = None
+        self.ended = False
+        self.irq_masked = 0
+        self._in_irq = False
+        self._slice_start = 0
+        self._seq = 0
+        self._sleepers = []     # (wake_us, seq, task)
+        self._events = []       # (due_us, seq, [callback]) - callback None once cancelled
+        self._done = threading.Event()
+
+    # -- clock ---------------------------------------------------------------
+
+    def log(self, msg):
+        if not self.quiet:
+            sys.stderr.write("[sim {:10.6f}] {}\n".format(self.now_us / 1000000, msg))
+
+    def read_us(self):
+        '''Reads the clock; the read itself costs READ_COST_US'''
+        self.advance(READ_COST_US)
+        return self.now_us
+
+    def advance(self, us):
+        '''Burns us of CPU time in the running thread, serving due interrupts'''
+        target = self.now_us + us
+        while not self._in_irq and not self.irq_masked and self._events and self._events[0][0] <= target:
+            due, seq, handle = heapq.heappop(self._events)
+            if handle[0] is None:
+                continue
+            if due > self.now_us:
+                self.now_us = due
+            self._fire(handle)
+        if target > self.now_us:
+            self.now_us = target
+        if self._in_irq or self.current is None:
+            return
+        if self.until_us is not None and self.now_us > self.until_us:
+            self.sleep_us(0)
+        elif self.now_us - self._slice_start >= SLICE_US and self._sleepers \
+                and self._sleepers[0][0] <= self.now_us:
+            self.sleep_us(0)
+
+    # -- events --------------------------------------------------------------
+
+    def call_at(self, due_us, callback):
+        '''Schedules an interrupt callback, returns a handle for cancel()'''
+        handle = [callback]
+        heapq.heappush(self._events, (max(due_us, self.now_us), self._seq, handle))
+        self._seq += 1
+        return handle
+
+    def call_later(self, delay_us, callback):
+        return self.call_at(self.now_us + delay_us, callback)
+
+    def cancel(self, handle):
+        handle[0] = None
+
+    def _fire(self, handle):
+        cb = handle[0]
+        if cb is None:
+            return
+        self._in_irq = True
+        try:
+            cb()
+        except SimulationEnd:
+            raise
+        except Exception:
+            self.log("exception in interrupt handler:")
+            traceback.print_exc()
+        finally:
+            self._in_irq = False
+
+    def unmask(self):
+        '''Serves interrupts that fell due while they were masked'''
+        if not self.irq_masked:
+            self.advance(0)
+
+    # -- threads -------------------------------------------------------------
+
+    def spawn(self, func, args=(), name=None):
+        '''Starts a firmware thread, it first runs when the caller yields'''
+        task = Task(self, name or "thread-{}".format(len(self.tasks)), func, args)
+        self.tasks.append(task)
+        task.thread.start()
+        self._push_sleeper(self.now_us, task)
+        return task
+
+    def _push_sleeper(self, wake_us, task):
+        task.wait_seq = self._seq
+        heapq.heappush(self._sleepers, (wake_us, self._seq, task))
+        self._seq += 1
+
+    def sleep_us(self, us):
+        '''Suspends the running thread for us of virtual time'''
+        if self.ended:
+            raise SimulationEnd()
+        if self._in_irq:
+            # sleeping inside an interrupt handler stalls the whole chip
+            self.now_us += max(0, int(us))
+            return
+        me = self.current
+        self._push_sleeper(self.now_us + max(0, int(us)), me)
+        self._switch(me)
+        if self.ended:
+            raise SimulationEnd()
+
+    def block_us(self, us=None):
+        '''Like sleep_us, but notify() ends it early; None blocks until notified'''
+        me = self.current
+        me.blocked = True
+        try:
+            self.sleep_us(1 << 62 if us is None else us)
+        finally:
+            me.blocked = False
+
+    def notify(self, task):
+        '''Wakes a thread parked in block_us() (from an interrupt, say)'''
+        if task.blocked and task is not self.current:
+            task.blocked = False
+            # the old entry goes stale and is skipped when it surfaces
+            self._push_sleeper(self.now_us, task)
+
+    def _switch(self, me):
+        '''Runs interrupts until the next thread is due, then hands it the CPU'''
+        while True:
+            if not self._sleepers or (self.until_us is not None and self._next_time() > self.until_us):
+                self._finish(me)
+                return
+            if self._events and (not self._sleepers or self._events[0][0] <= self._sleepers[0][0]) \
+                    and not self.irq_masked:
+                due, seq, handle = heapq.heappop(self._events)
+                if handle[0] is not None:
+                    self.now_us = max(self.now_us, due)
+                    self._fire(handle)
+                continue
+            wake, seq, task = heapq.heappop(self._sleepers)
+            if seq != task.wait_seq:
+                continue
+            self.now_us = max(self.now_us, wake)
+            self._resume(task)
+            if task is me:
+                return
+            task.wake.set()
+            if me is not None:
+                me.wake.wait()
+                me.wake.clear()
+            return
+
+    def _resume(self, task):
+        self.current = task
+        self._slice_start = self.now_us
+
+    def _next_time(self):
+        t = None
+        if self._sleepers:
+            t = self._sleepers[0][0]
+        if self._events and not self.irq_masked and (t is None or self._events[0][0] < t):
+            t = self._events[0][0]
+        return self.until_us + 1 if t is None else t
+
+    def _exit(self, task):
+        '''A firmware thread returned: pass the CPU on'''
+        if self.ended:
+            return
+        self.current = None
+        self._switch(None)
+
+    def _finish(self, me):
+        '''Stops the run: every parked thread unwinds with SimulationEnd'''
+        if self.until_us is not None:
+            self.now_us = max(self.now_us, min(self.until_us, self._next_time()))
+        self.ended = True
+        for wake, seq, task in self._sleepers:
+            if task is not me:
+                task.wake.set()
+        self._sleepers = []
+        self._done.set()
+
+    def run(self, func, args=(), name="main", wall_timeout=None):
+        '''Runs func as the firmware main thread until the clock reaches until_s'''
+        task = self.spawn(func, args, name)
+        self._switch_from_host()
+        self._done.wait(wall_timeout)
+        for t in self.tasks:
+            t.thread.join(1.0)
+        return task
+
+    def _switch_from_host(self):
+        wake, seq, task = heapq.heappop(self._sleepers)
+        self._resume(task)
+        task.wake.set()
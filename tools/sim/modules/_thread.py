@@ -0,0 +1,54 @@
+"""
+    _thread for the simulator: threads are kernel tasks
+"""
+
+import sim
+
+
+def start_new_thread(func, args, kwargs=None):
+    if kwargs:
+        return sim.board.kernel.spawn(lambda: func(*args, **kwargs)).name
+    return sim.board.kernel.spawn(func, args).name
+
+
+def get_ident():
+    task = sim.board.kernel.current
+    return id(task)
+
+
+def stack_size(size=None):
+    return 0
+
+
+class LockType:
+    '''Lock that waits by sleeping, so the holder gets the CPU back'''
+
+    def __init__(self):
+        self._held = False
+
+    def acquire(self, waitflag=1, timeout=-1):
+        k = sim.board.kernel
+        deadline = None if timeout < 0 else k.now_us + int(timeout * 1000000)
+        while self._held:
+            if not waitflag or (deadline is not None and k.now_us >= deadline):
+                return False
+            k.sleep_us(10)
+        self._held = True
+        return True
+
+    def release(self):
+        if not self._held:
+            raise RuntimeError("release unlocked lock")
+        self._held = False
+
+    def locked(self):
+        return self._held
+
+    __enter__ = acquire
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def allocate_lock():
+    return LockType()
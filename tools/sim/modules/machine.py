@@ -0,0 +1,191 @@
+"""
+    machine for the simulator: Pin, ADC, Timer and mem32 on the board model
+"""
+
+import sim
+from sim.hardware import IRQ_FALLING, IRQ_RISING
+from sim.kernel import IO_COST_US
+
+
+def _board():
+    return sim.board
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+    OPEN_DRAIN = 2
+    ALT = 3
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_FALLING = IRQ_FALLING
+    IRQ_RISING = IRQ_RISING
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self.id = id
+        self._state = _board().pin(id)
+        self._state.owner = self
+        self.init(mode, pull, value)
+
+    def init(self, mode=-1, pull=-1, value=None):
+        s = self._state
+        if mode != -1:
+            s.mode = mode
+        if pull != -1:
+            s.pull = pull
+            if s.mode == Pin.IN and s.writes == 0 and s.edges == 0:
+                s.level = 1 if pull == Pin.PULL_UP else 0
+        if value is not None:
+            self.value(value)
+
+    def value(self, v=None):
+        _board().kernel.advance(IO_COST_US)
+        s = self._state
+        if v is None:
+            return s.level
+        s.level = 1 if v else 0
+        s.writes += 1
+
+    __call__ = value
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+    def toggle(self):
+        self.value(not self._state.level)
+
+    def low(self):
+        self.value(0)
+
+    def high(self):
+        self.value(1)
+
+    def irq(self, handler=None, trigger=IRQ_FALLING | IRQ_RISING, hard=False):
+        self._state.handler = handler
+        self._state.trigger = trigger if handler else 0
+        return self
+
+    def __repr__(self):
+        return "Pin({})".format(self.id)
+
+
+class _Mem32:
+    '''machine.mem32: the SIO GPIO registers act on the board pins,
+    any other address just reads back what was written'''
+
+    GPIO_IN = 0xd0000004
+    GPIO_OUT = 0xd0000010
+    GPIO_OUT_SET = 0xd0000014
+    GPIO_OUT_CLR = 0xd0000018
+    GPIO_OUT_XOR = 0xd000001c
+
+    def __init__(self):
+        self._words = {}
+
+    def __getitem__(self, addr):
+        b = _board()
+        b.kernel.advance(IO_COST_US)
+        if addr == self.GPIO_OUT or addr == self.GPIO_IN:
+            return b.gpio_out()
+        return self._words.get(addr, 0)
+
+    def __setitem__(self, addr, value):
+        b = _board()
+        b.kernel.advance(IO_COST_US)
+        if addr == self.GPIO_OUT:
+            b.write_gpio_out(value)
+        elif addr == self.GPIO_OUT_SET:
+            b.write_gpio_out(b.gpio_out() | value)
+        elif addr == self.GPIO_OUT_CLR:
+            b.write_gpio_out(b.gpio_out() & ~value)
+        elif addr == self.GPIO_OUT_XOR:
+            b.write_gpio_out(b.gpio_out() ^ value)
+        else:
+            self._words[addr] = value & 0xFFFFFFFF
+
+
+mem32 = _Mem32()
+
+
+class ADC:
+    CORE_TEMP = 4
+
+    def __init__(self, pin):
+        # ADC(0..3) are GP26..GP29
+        self._pin = pin.id if isinstance(pin, Pin) else 26 + pin
+
+    def read_u16(self):
+        return _board().read_adc(self._pin)
+
+
+class Timer:
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    def __init__(self, id=-1, **kwargs):
+        self._handle = None
+        if kwargs:
+            self.init(**kwargs)
+
+    def init(self, mode=PERIODIC, freq=-1, period=-1, callback=None, tick_hz=1000):
+        self.deinit()
+        if freq > 0:
+            self._period_us = 1000000 / freq
+        else:
+            self._period_us = period * 1000000 / tick_hz
+        self._mode = mode
+        self._callback = callback
+        self._start = _board().kernel.now_us
+        self._n = 0
+        self._arm()
+
+    def _arm(self):
+        self._n += 1
+        due = self._start + int(round(self._n * self._period_us))
+        self._handle = _board().kernel.call_at(due, self._fire)
+
+    def _fire(self):
+        if self._mode == Timer.PERIODIC:
+            self._arm()
+        else:
+            self._handle = None
+        if self._callback:
+            self._callback(self)
+
+    def deinit(self):
+        if self._handle is not None:
+            _board().kernel.cancel(self._handle)
+            self._handle = None
+
+
+def disable_irq():
+    k = _board().kernel
+    state = k.irq_masked
+    k.irq_masked = 1
+    return state
+
+
+def enable_irq(state=0):
+    k = _board().kernel
+    k.irq_masked = state
+    k.unmask()
+
+
+def freq(hz=None):
+    return 125000000
+
+
+def idle():
+    _board().kernel.advance(IO_COST_US)
+
+
+def reset():
+    _board().kernel.log("machine.reset()")
+    raise SystemExit
+
+
+def unique_id():
+    return b'\xe6\x61\x41\x04\x03\x53\x2a\x2b'
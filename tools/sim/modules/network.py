@@ -0,0 +1,52 @@
+"""
+    network for the simulator: a station interface on the board's Wi-Fi model
+"""
+
+import sim
+from sim.hardware import (STAT_IDLE, STAT_CONNECTING, STAT_WRONG_PASSWORD,
+                       STAT_NO_AP_FOUND, STAT_CONNECT_FAIL, STAT_GOT_IP)
+
+STA_IF = 0
+AP_IF = 1
+
+
+class WLAN:
+    def __init__(self, interface=STA_IF):
+        self._wifi = sim.board.wifi
+        self._ssid = None
+
+    def active(self, flag=None):
+        if flag is None:
+            return self._wifi.active
+        self._wifi.active = bool(flag)
+        if not flag:
+            self._wifi.disconnect()
+
+    def connect(self, ssid=None, key=None, **kwargs):
+        if not self._wifi.active:
+            raise OSError("STA required")
+        self._ssid = ssid
+        self._wifi.connect()
+
+    def disconnect(self):
+        self._wifi.disconnect()
+
+    def isconnected(self):
+        return self._wifi.isconnected()
+
+    def status(self, param=None):
+        if param == 'rssi':
+            return -60
+        if self._wifi.status == STAT_GOT_IP and self._wifi.in_outage():
+            return STAT_NO_AP_FOUND
+        return self._wifi.status
+
+    def ifconfig(self, config=None):
+        return ('192.168.4.20', '255.255.255.0', '192.168.4.1', '192.168.4.1')
+
+    def config(self, *args, **kwargs):
+        if args == ('essid',):
+            return self._ssid
+        if args == ('mac',):
+            return b'\x28\xcd\xc1\x00\x00\x01'
+        return None
@@ -0,0 +1,20 @@
+"""
+    ntptime for the simulator: settime() takes a server round
+    trip and sets the clock to the real time, if Wi-Fi is up
+"""
+
+import errno
+
+import sim
+import utime
+
+host = "pool.ntp.org"
+timeout = 1
+
+
+def settime():
+    board = sim.board
+    if not board.wifi.isconnected():
+        raise OSError(errno.ETIMEDOUT)
+    board.kernel.sleep_us(2 * board.blynk.latency_us)
+    utime.set_rtc(utime.REAL_EPOCH + board.kernel.read_us() // 1000000)
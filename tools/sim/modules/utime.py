@@ -0,0 +1,73 @@
+"""
+    utime for the simulator, on the kernel's virtual clock
+"""
+
+import time as _host_time
+
+import sim
+from sim.kernel import TICKS_PERIOD
+
+BOOT_EPOCH = 1609459200 # time() at power-on: the Pico's RTC restarts at 2021-01-01
+REAL_EPOCH = 1700000000 # the real time at power-on, what ntptime.settime() finds
+
+_rtc = BOOT_EPOCH       # time() at virtual time 0, moved by set_rtc()
+
+_HALF = TICKS_PERIOD // 2
+_MASK = TICKS_PERIOD - 1
+
+
+def _kernel():
+    return sim.board.kernel
+
+
+def ticks_us():
+    return _kernel().read_us() & _MASK
+
+
+def ticks_ms():
+    return (_kernel().read_us() // 1000) & _MASK
+
+
+ticks_cpu = ticks_us
+
+
+def ticks_diff(a, b):
+    return ((a - b + _HALF) & _MASK) - _HALF
+
+
+def ticks_add(t, delta):
+    return (t + delta) & _MASK
+
+
+def sleep_us(us):
+    _kernel().sleep_us(us)
+
+
+def sleep_ms(ms):
+    _kernel().sleep_us(ms * 1000)
+
+
+def sleep(s):
+    _kernel().sleep_us(int(s * 1000000))
+
+
+def time():
+    return _rtc + _kernel().read_us() // 1000000
+
+
+def time_ns():
+    return (_rtc * 1000000 + _kernel().read_us()) * 1000
+
+
+def localtime(secs=None):
+    t = _host_time.gmtime(time() if secs is None else secs)
+    return (t.tm_year, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec, t.tm_wday, t.tm_yday)
+
+
+gmtime = localtime
+
+
+def set_rtc(secs):
+    '''Sets the clock so that time() returns secs now'''
+    global _rtc
+    _rtc = secs - _kernel().read_us() // 1000000
@@ -0,0 +1,180 @@
+"""
+    sim.netapi
+    stand-in for the socket and select modules used by BlynkLib
+
+    Sockets connect to the board's in-process Blynk server
+    over the simulated Wi-Fi link, blocking for the round
+    trip or, after setblocking(False), raising EINPROGRESS
+    and turning writable in poll() once the round trip is
+    over. A server in an outage never answers. Reads never
+    block: with no data they return None, like a MicroPython
+    socket with a zero timeout. poll() parks the calling
+    thread on the virtual clock until data arrives, a
+    connect finishes or the timeout runs out.
+
+"""
+
+import errno
+
+from sim.kernel import IO_COST_US
+
+POLLIN = 1
+POLLOUT = 4
+POLLERR = 8
+POLLHUP = 16
+
+
+class timeout(OSError):
+    pass
+
+
+class SimSocket:
+    '''One TCP socket'''
+
+    def __init__(self, board):
+        self.board = board
+        self.conn = None
+        self.blocking = True
+        self.waiters = []           # tasks blocked in poll() on the connect
+
+    def connect(self, addr):
+        k = self.board.kernel
+        server = self.board.blynk
+        if not self.board.wifi.isconnected():
+            raise OSError(errno.EHOSTUNREACH)
+        if self.blocking:
+            if server.in_outage():
+                k.sleep_us(server.syn_timeout_us)
+                raise OSError(errno.ETIMEDOUT)
+            # SYN / SYN-ACK
+            k.sleep_us(2 * server.latency_us)
+            self.conn = server.open(addr[0], addr[1])
+            return
+        if not server.in_outage():
+            k.call_later(2 * server.latency_us, lambda: self._connected(addr))
+        raise OSError(errno.EINPROGRESS)
+
+    def _connected(self, addr):
+        if self.board.blynk.in_outage():
+            return
+        self.conn = self.board.blynk.open(addr[0], addr[1])
+        for task in self.waiters:
+            self.board.kernel.notify(task)
+
+    def setsockopt(self, *args):
+        pass
+
+    def settimeout(self, t):
+        pass
+
+    def setblocking(self, flag):
+        self.blocking = flag
+
+    def write(self, data):
+        if self.conn is None:
+            raise OSError(errno.ENOTCONN)
+        return self.conn.write(data)
+
+    def read(self, n=-1):
+        if self.conn is None:
+            raise OSError(errno.ENOTCONN)
+        return self.conn.read(n)
+
+    send = write
+    recv = read
+
+    def readable(self):
+        return self.conn is not None and self.conn.readable()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+
+
+class SocketModule:
+    '''The parts of the socket module BlynkLib touches'''
+
+    AF_INET = 2
+    SOCK_STREAM = 1
+    IPPROTO_TCP = 6
+    TCP_NODELAY = 1
+    timeout = timeout
+
+    def __init__(self, board):
+        self.board = board
+
+    def socket(self, *args):
+        return SimSocket(self.board)
+
+    def getaddrinfo(self, host, port, *args):
+        if not self.board.wifi.isconnected():
+            raise OSError(-2)
+        self.board.kernel.sleep_us(self.board.blynk.latency_us)
+        return [(self.AF_INET, self.SOCK_STREAM, 0, '', (host, port))]
+
+
+class Poll:
+    '''select.poll() over SimSockets'''
+
+    def __init__(self, board):
+        self.board = board
+        self.masks = {}
+
+    def register(self, sock, mask=POLLIN | POLLOUT):
+        self.masks[sock] = mask
+
+    modify = register
+
+    def unregister(self, sock):
+        self.masks.pop(sock, None)
+
+    def _ready(self):
+        ready = []
+        for sock, mask in self.masks.items():
+            conn = sock.conn
+            if conn is None:
+                continue
+            ev = 0
+            if conn.closed:
+                ev |= POLLHUP
+            elif mask & POLLIN and conn.readable():
+                ev |= POLLIN
+            if mask & POLLOUT:
+                ev |= POLLOUT    # writes never stall
+            if ev:
+                ready.append((sock, ev))
+        return ready
+
+    def poll(self, timeout=-1):
+        k = self.board.kernel
+        k.advance(IO_COST_US)
+        deadline = None if timeout is None or timeout < 0 else k.now_us + int(timeout) * 1000
+        while True:
+            ready = self._ready()
+            if ready or (deadline is not None and k.now_us >= deadline):
+                return ready
+            me = k.current
+            # a socket still connecting is woken by the socket, a connected one by its connection
+            waits = [sock.waiters if sock.conn is None else sock.conn.waiters for sock in self.masks]
+            for waiters in waits:
+                waiters.append(me)
+            try:
+                k.block_us(None if deadline is None else deadline - k.now_us)
+            finally:
+                for waiters in waits:
+                    waiters.remove(me)
+
+
+class SelectModule:
+    '''The parts of the select module BlynkLib touches'''
+
+    POLLIN = POLLIN
+    POLLOUT = POLLOUT
+    POLLERR = POLLERR
+    POLLHUP = POLLHUP
+
+    def __init__(self, board):
+        self.board = board
+
+    def poll(self):
+        return Poll(self.board)
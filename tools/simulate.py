@@ -0,0 +1,96 @@
+"""
+    simulate
+    runs load-to-pico/main.py on the host simulator
+
+        python3 tools/simulate.py --seconds 60
+        python3 tools/simulate.py --seconds 90 --press 17@5 --dashboard 0=1@40 \\
+            --wifi-outage 20:25 --profile
+
+    --press PIN@T        button on PIN pressed at T seconds (active low)
+    --dashboard V=X@T    dashboard writes X to virtual pin V at T seconds
+    --wifi-fail N        the first N association attempts fail
+    --wifi-outage A:B    the Wi-Fi link is down from A to B seconds
+    --server-outage A:B  the Blynk server doesn't answer from A to B
+                         seconds (connections drop, connects hang)
+    --adc PIN=EXPR       ADC waveform on PIN as a python expression of t
+                         (seconds) giving a fraction of full scale
+    --scenario FILE      python file whose setup(sim) scripts the run
+    --flash DIR          directory used as the flash filesystem, kept
+                         between runs (default: a fresh temporary one)
+    --instrument         record the firmware's latency histograms and
+                         print their summary after the run
+    --trace FILE         record the raw ADC trace (TraceRecorder.py) to
+                         FILE, for tools/replay_trace.py
+
+"""
+
+import argparse
+import math
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import sim
+from sim.hardware import STAT_NO_AP_FOUND
+
+
+def at(spec):
+    what, t = spec.rsplit('@', 1)
+    return what, float(t)
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Run the firmware on a virtual clock.")
+    ap.add_argument('--seconds', type=float, default=30, help="virtual seconds to run")
+    ap.add_argument('--seed', type=int, default=0, help="ADC noise seed")
+    ap.add_argument('--press', action='append', default=[], metavar='PIN@T')
+    ap.add_argument('--dashboard', action='append', default=[], metavar='V=X@T')
+    ap.add_argument('--wifi-fail', type=int, default=0, metavar='N')
+    ap.add_argument('--wifi-outage', action='append', default=[], metavar='A:B')
+    ap.add_argument('--server-outage', action='append', default=[], metavar='A:B')
+    ap.add_argument('--adc', action='append', default=[], metavar='PIN=EXPR')
+    ap.add_argument('--scenario', metavar='FILE')
+    ap.add_argument('--flash', metavar='DIR', help="flash filesystem directory")
+    ap.add_argument('--instrument', action='store_true', help="latency histograms (Instrument.py)")
+    ap.add_argument('--trace', metavar='FILE', help="record the raw ADC trace for tools/replay_trace.py")
+    ap.add_argument('--profile', action='store_true', help="cProfile every firmware thread")
+    ap.add_argument('--quiet', action='store_true', help="hide simulator log lines")
+    args = ap.parse_args(argv)
+
+    s = sim.Simulator(args.seconds, seed=args.seed, profile=args.profile, quiet=args.quiet,
+                      flash=os.path.abspath(args.flash) if args.flash else None, instrument=args.instrument,
+                      trace=os.path.abspath(args.trace) if args.trace else None)
+    for spec in args.press:
+        pin, t = at(spec)
+        s.board.press(int(pin), t)
+    for spec in args.dashboard:
+        assignment, t = at(spec)
+        pin, value = assignment.split('=', 1)
+        s.board.blynk.dashboard_write(t, int(pin.lstrip('Vv')), value)
+    s.board.wifi.fail(*[STAT_NO_AP_FOUND] * args.wifi_fail)
+    for spec in args.wifi_outage:
+        a, b = spec.split(':')
+        s.board.wifi.outage(float(a), float(b))
+    for spec in args.server_outage:
+        a, b = spec.split(':')
+        s.board.blynk.outage(float(a), float(b))
+    for spec in args.adc:
+        pin, expr = spec.split('=', 1)
+        s.board.set_adc(int(pin), eval('lambda t: ' + expr, {'math': math, 'sin': math.sin, 'pi': math.pi}))
+    if args.scenario:
+        env = {'__file__': args.scenario}
+        exec(compile(open(args.scenario).read(), args.scenario, 'exec'), env)
+        env['setup'](s)
+
+    s.run()
+    print()
+    print(s.report())
+    if args.profile:
+        stats = s.profile_stats()
+        if stats:
+            stats.sort_stats('cumulative').print_stats(25)
+
+
+if __name__ == '__main__':
+    main()
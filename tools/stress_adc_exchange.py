@@ -0,0 +1,213 @@
+"""
+    stress_adc_exchange
+    checks ADCSampler's double-buffered handoff for lost samples
+
+    Every simulated ADC read returns the number of the sample
+    being taken, so the consumer can check that what it gets
+    is exactly the sequence produced, in order. The consumer
+    drains at the firmware's pace: about rate x interval
+    samples between drains (main.py's ADC_SAMPLE_RATE and
+    ADC_DRAIN_INTERVAL, with ADC_RING_SIZE blocks), now and
+    then a few intervals late. A sample dropped to a full
+    block (an overrun) is a lost sample, and the run fails
+    on more than --max-overruns of them. Two ways of
+    interleaving the ISR with drain():
+
+        preempt   the ISR runs at random bytecode boundaries
+                  inside the consumer (sys.settrace opcode
+                  events), the way a timer interrupt cuts into
+                  a MicroPython thread
+        threads   the ISR and the consumer are OS threads with
+                  a tiny switch interval
+
+        python3 tools/stress_adc_exchange.py [--samples N] [--block N] [--rate HZ]
+            [--interval S] [--late N] [--max-overruns N] [--seed N]
+
+"""
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'load-to-pico'))
+
+import ADCSampler
+
+# main.py's ADC_RING_SIZE, ADC_SAMPLE_RATE and ADC_DRAIN_INTERVAL
+BLOCK = 512
+RATE = 1000
+INTERVAL = 0.1
+LATE = 3            # drains at most this many intervals late
+
+
+class CountingADC:
+    '''read_u16 returns a 16-bit half of the current sample number'''
+
+    def __init__(self, source, shift):
+        self.source = source
+        self.shift = shift
+
+    def read_u16(self):
+        return (self.source.seq >> self.shift) & 0xFFFF
+
+
+class Checker:
+    '''Sink that rebuilds the sample numbers and checks they only ever increase'''
+
+    def __init__(self):
+        self.last = -1
+        self.received = 0
+        self.gaps = 0           # samples skipped between consecutive ones received
+        self.errors = []
+
+    def add_pairs(self, buf, times, start, end):
+        for i in range(start, end, 2):
+            seq = buf[i] | (buf[i + 1] << 16)
+            if seq <= self.last:
+                self.errors.append("sample {} after {}".format(seq, self.last))
+            else:
+                self.gaps += seq - self.last - 1
+            self.last = seq
+            self.received += 1
+
+
+class Producer:
+    def __init__(self, sampler):
+        self.sampler = sampler
+        self.seq = 0
+
+    def tick(self):
+        self.sampler._sample(None)
+        self.seq += 1
+
+
+def make(block):
+    producer = Producer(None)
+    sampler = ADCSampler.ADCSampler(CountingADC(producer, 0), CountingADC(producer, 16), block)
+    producer.sampler = sampler
+    return producer, sampler
+
+
+def finish(producer, sampler, checker):
+    # enough flips to hand over whatever is still in the blocks
+    for _ in range(3):
+        sampler.drain(checker)
+        producer.tick()
+    sampler.drain(checker)
+    # what the last flip left in the filling block was never drained
+    return producer.seq - sampler._count[sampler._fill]
+
+
+def verify(name, produced, sampler, checker, seconds, max_overruns):
+    # every sample not received must be an overrun, and overruns are lost samples
+    lost = produced - checker.received
+    ok = (not checker.errors and lost == sampler.overruns and checker.gaps == sampler.overruns
+          and sampler.overruns <= max_overruns)
+    print("{:<8} {:>9} samples in {:.2f} s ({:.0f}/s): {} received, {} lost ({:.3f} %, {} overruns), {} order errors -> {}".format(
+        name, produced, seconds, produced / seconds if seconds else 0, checker.received,
+        lost, 100 * lost / produced if produced else 0, sampler.overruns, len(checker.errors), "ok" if ok else "FAIL"))
+    if lost != sampler.overruns:
+        print("    {} samples missing that the sampler did not count as overruns".format(lost - sampler.overruns))
+    for e in checker.errors[:5]:
+        print("    " + e)
+    return ok
+
+
+def between_drains(rnd, per_drain, late):
+    '''Samples the ISR takes before the next drain: one interval, give or take, now and then late'''
+    if rnd.random() < 0.02:
+        return int(per_drain * rnd.uniform(1, late))
+    return int(per_drain * rnd.uniform(0.9, 1.1))
+
+
+def preempt(samples, block, per_drain, late, max_overruns, seed):
+    '''ISR ticks at random opcodes of the draining thread, one interval of samples between drains'''
+    rnd = random.Random(seed)
+    producer, sampler = make(block)
+    checker = Checker()
+    budget = [samples]
+    drain_code = ADCSampler.ADCSampler.drain.__code__
+
+    def tracer(frame, event, arg):
+        if frame.f_code is not drain_code:
+            return None         # the sinks are not where the race is
+        frame.f_trace_opcodes = True
+        # far more often than 1 kHz would in a drain's time, to hit every opcode
+        if event == 'opcode' and budget[0] > 0 and rnd.random() < 0.3:
+            producer.tick()
+            budget[0] -= 1
+        return tracer
+
+    start = time.perf_counter()
+    while budget[0] > 0:
+        sys.settrace(tracer)
+        sampler.drain(checker)
+        sys.settrace(None)
+        for _ in range(min(budget[0], between_drains(rnd, per_drain, late))):
+            producer.tick()
+            budget[0] -= 1
+    elapsed = time.perf_counter() - start
+    return verify("preempt", finish(producer, sampler, checker), sampler, checker, elapsed, max_overruns)
+
+
+def threads(samples, block, per_drain, late, max_overruns, seed):
+    '''ISR and consumer on OS threads, switching as often as CPython allows
+
+    The consumer drains once an interval of samples has come in;
+    the ISR stands for real time, so it waits rather than run more
+    than late intervals ahead of the last drain.
+    '''
+    rnd = random.Random(seed)
+    producer, sampler = make(block)
+    checker = Checker()
+    done = threading.Event()
+    drained_at = [0]        # producer.seq when the last drain started
+
+    def isr():
+        for _ in range(samples):
+            while producer.seq - drained_at[0] >= late * per_drain:
+                time.sleep(0)
+            producer.tick()
+        done.set()
+
+    old = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    start = time.perf_counter()
+    t = threading.Thread(target=isr)
+    t.start()
+    try:
+        while not done.is_set():
+            due = drained_at[0] + between_drains(rnd, per_drain, late)
+            while producer.seq < due and not done.is_set():
+                time.sleep(0)
+            drained_at[0] = producer.seq
+            sampler.drain(checker)
+    finally:
+        t.join()
+        sys.setswitchinterval(old)
+    elapsed = time.perf_counter() - start
+    return verify("threads", finish(producer, sampler, checker), sampler, checker, elapsed, max_overruns)
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Stress test of the ADCSampler ISR to thread handoff.")
+    ap.add_argument('--samples', type=int, default=200000)
+    ap.add_argument('--block', type=int, default=BLOCK, help="pairs per block, main.py's ADC_RING_SIZE")
+    ap.add_argument('--rate', type=int, default=RATE, help="sample rate in Hz, main.py's ADC_SAMPLE_RATE")
+    ap.add_argument('--interval', type=float, default=INTERVAL, help="seconds between drains, main.py's ADC_DRAIN_INTERVAL")
+    ap.add_argument('--late', type=float, default=LATE, help="intervals the latest drain comes after the last one")
+    ap.add_argument('--max-overruns', type=int, default=0, metavar='N', help="lost samples allowed before failing")
+    ap.add_argument('--seed', type=int, default=1)
+    args = ap.parse_args(argv)
+    per_drain = max(1, int(args.rate * args.interval))
+    print("{} pairs per block, {} samples per drain, up to {:g} intervals late".format(args.block, per_drain, args.late))
+    ok = preempt(args.samples, args.block, per_drain, args.late, args.max_overruns, args.seed)
+    ok = threads(args.samples, args.block, per_drain, args.late, args.max_overruns, args.seed) and ok
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()